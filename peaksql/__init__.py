@@ -4,6 +4,9 @@ from .database import DataBase
 from .datasets.bed import BedDataSet
 from .datasets.bedgraph import BedGraphDataSet
 from .datasets.narrowpeak import NarrowPeakDataSet
+from .datasets.loader import BatchLoader
+from .datasets.sampler import BlockShuffleSampler
+from .datasets.sharded import ShardedDataSet
 
 __all__ = [
     "database",
@@ -12,4 +15,7 @@ __all__ = [
     "NarrowPeakDataSet",
     "BedDataSet",
     "BedGraphDataSet",
+    "BatchLoader",
+    "BlockShuffleSampler",
+    "ShardedDataSet",
 ]
@@ -0,0 +1,443 @@
+"""
+Benchmarks of the peaksql data pipeline.
+
+Generates a synthetic assembly and bed, narrowPeak and bedgraph files of a configurable
+scale, and times the steps of the pipeline: adding the assembly and the data to a
+database, constructing the datasets, getting single items, and iterating over a
+(PyTorch) DataLoader with different numbers of workers. The results are written as
+JSON, so they can be compared between versions.
+
+Next to the time, samplers are compared on the page faults of the process and on the
+hit rate of the sequence block cache, as a measure of the locality of their reads.
+
+Usage: peaksql-benchmark --chromosomes 4 --intervals 100000 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, cast
+
+import numpy as np
+
+from .database import DataBase
+from .datasets.base import _DataSet
+from .datasets.bed import BedDataSet
+from .datasets.bedgraph import BedGraphDataSet
+from .datasets.loader import BatchLoader
+from .datasets.sampler import BlockShuffleSampler
+from .datasets.narrowpeak import NarrowPeakDataSet
+
+DATASETS = {
+    ".bed": BedDataSet,
+    ".narrowPeak": NarrowPeakDataSet,
+    ".bdg": BedGraphDataSet,
+}
+
+
+def generate_assembly(
+    path: str, nr_chromosomes: int, chromosome_size: int, rng: np.random.Generator
+) -> Dict[str, int]:
+    """
+    Write a random assembly (fasta), and return the size of each chromosome.
+    """
+    sizes = dict()
+    with open(path, "w") as f:
+        for i in range(nr_chromosomes):
+            chrom = f"chr{i + 1}"
+            sequence = np.frombuffer(b"ACGT", dtype=np.uint8)[
+                rng.integers(0, 4, chromosome_size)
+            ].tobytes()
+            f.write(f">{chrom}\n")
+            for start in range(0, chromosome_size, 60):
+                f.write(sequence[start : start + 60].decode("ascii") + "\n")
+            sizes[chrom] = chromosome_size
+
+    return sizes
+
+
+def generate_data(
+    path: str,
+    sizes: Dict[str, int],
+    nr_intervals: int,
+    rng: np.random.Generator,
+    interval_size: int = 200,
+):
+    """
+    Write random intervals to a bed, narrowPeak, or bedgraph file (depending on the
+    extension of the path), sorted on position.
+    """
+    *_, extension = os.path.splitext(path)
+    with open(path, "w") as f:
+        for chrom, size in sizes.items():
+            nr_chrom = nr_intervals // len(sizes)
+            if extension == ".bdg":
+                # bedgraphs cover the chromosome with non-overlapping intervals
+                bounds = np.unique(rng.integers(0, size, nr_chrom))
+                bounds = np.concatenate([[0], bounds, [size]])
+                bounds = np.unique(bounds)
+                values = rng.random(len(bounds) - 1).round(3)
+                for start, end, value in zip(bounds[:-1], bounds[1:], values):
+                    f.write(f"{chrom}\t{start}\t{end}\t{value}\n")
+                continue
+
+            starts = np.sort(rng.integers(0, size - interval_size, nr_chrom))
+            lengths = rng.integers(interval_size // 2, interval_size, nr_chrom)
+            for start, length in zip(starts, lengths):
+                if extension == ".narrowPeak":
+                    peak = rng.integers(0, length)
+                    f.write(f"{chrom}\t{start}\t{start + length}\t.\t0\t.\t0\t0\t0")
+                    f.write(f"\t{peak}\n")
+                else:
+                    f.write(f"{chrom}\t{start}\t{start + length}\n")
+
+
+def timed(function: Callable) -> Tuple[float, Any]:
+    """
+    Return the duration in seconds of calling a function, and what it returned.
+    """
+    start = time.perf_counter()
+    value = function()
+    return time.perf_counter() - start, value
+
+
+def result(name: str, seconds: float, items: Optional[int] = None, **info) -> dict:
+    """
+    Format the result of a single benchmark.
+    """
+    result = {"name": name, "seconds": seconds, **info}
+    if items is not None:
+        result["items"] = items
+        result["per_second"] = items / max(seconds, 1e-12)
+    return result
+
+
+def page_faults() -> Tuple[int, int]:
+    """
+    Return the number of (minor, major) page faults of this process so far, or zeros
+    on platforms where they are not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0, 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt, usage.ru_majflt
+
+
+def benchmark_dataloader(
+    dataset: _DataSet, num_workers: int, batch_size: int, nr_batches: int,
+) -> dict:
+    """
+    Time iterating over a number of batches of a PyTorch DataLoader.
+    """
+    import torch.utils.data
+
+    # a _DataSet is a map-style dataset, even though it does not subclass Dataset
+    loader = torch.utils.data.DataLoader(
+        cast(torch.utils.data.Dataset, dataset),
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        worker_init_fn=dataset.worker_init_fn,
+    )
+
+    start = time.perf_counter()
+    nr_items = 0
+    for i, (seqs, _) in enumerate(loader):
+        nr_items += len(seqs)
+        if i + 1 == nr_batches:
+            break
+    seconds = time.perf_counter() - start
+
+    return result(
+        f"dataloader_{num_workers}_workers",
+        seconds,
+        nr_items,
+        num_workers=num_workers,
+        batch_size=batch_size,
+    )
+
+
+def benchmark_batch_loader(
+    dataset: _DataSet, num_threads: int, batch_size: int, nr_batches: int,
+) -> dict:
+    """
+    Time iterating over a number of batches of a (threaded) BatchLoader.
+    """
+    loader = BatchLoader(
+        dataset, batch_size=batch_size, shuffle=True, num_threads=num_threads
+    )
+
+    start = time.perf_counter()
+    nr_items = 0
+    for i, (seqs, _) in enumerate(loader):
+        nr_items += len(seqs)
+        if i + 1 == nr_batches:
+            break
+    seconds = time.perf_counter() - start
+
+    return result(
+        f"batch_loader_{num_threads}_threads",
+        seconds,
+        nr_items,
+        num_threads=num_threads,
+        batch_size=batch_size,
+    )
+
+
+def benchmark_sampler(
+    dataset: _DataSet, name: str, sampler: list, batch_size: int, nr_batches: int,
+) -> dict:
+    """
+    Time iterating over a number of batches in the order of a sampler, and count the
+    page faults and the sequence block cache hits (of a dataset with stats) meanwhile.
+    """
+    assert dataset.stats is not None, "the dataset should collect stats"
+    loader = BatchLoader(dataset, batch_size=batch_size, sampler=sampler, num_threads=1)
+    dataset.stats.reset()
+
+    minor, major = page_faults()
+    start = time.perf_counter()
+    nr_items = 0
+    for i, (seqs, _) in enumerate(loader):
+        nr_items += len(seqs)
+        if i + 1 == nr_batches:
+            break
+    seconds = time.perf_counter() - start
+    end_minor, end_major = page_faults()
+
+    return result(
+        f"sampler_{name}",
+        seconds,
+        nr_items,
+        minor_page_faults=end_minor - minor,
+        major_page_faults=end_major - major,
+        sequence_cache_hit_rate=dataset.stats.report()["sequence_cache_hit_rate"],
+    )
+
+
+def run(
+    directory: str,
+    nr_chromosomes: int = 4,
+    chromosome_size: int = 1_000_000,
+    nr_intervals: int = 100_000,
+    nr_conditions: int = 2,
+    seq_length: int = 1000,
+    stride: int = 500,
+    nr_items: int = 1000,
+    num_workers: Sequence[int] = (0, 2),
+    num_threads: Sequence[int] = (1, 4),
+    block_size: int = 1024,
+    buffer: int = 8,
+    batch_size: int = 64,
+    nr_batches: int = 20,
+    seed: int = 0,
+) -> dict:
+    """
+    Generate the synthetic data in a directory and run all the benchmarks on it.
+
+    :return: a dictionary of the configuration, the environment and the result of each
+        benchmark.
+    """
+    config = {key: value for key, value in locals().items() if key not in ["directory"]}
+    config["num_workers"] = list(num_workers)
+    config["num_threads"] = list(num_threads)
+    rng = np.random.default_rng(seed)
+    results = []
+
+    # generate the data
+    fasta = os.path.join(directory, "assembly.fa")
+    sizes = generate_assembly(fasta, nr_chromosomes, chromosome_size, rng)
+    data = dict()
+    for extension in DATASETS:
+        data[extension] = [
+            os.path.join(directory, f"condition{i}{extension}")
+            for i in range(nr_conditions)
+        ]
+        for path in data[extension]:
+            generate_data(path, sizes, nr_intervals // nr_conditions, rng)
+
+    # fill a database per data type
+    databases = dict()
+    for extension, paths in data.items():
+        databases[extension] = os.path.join(directory, f"{extension[1:]}.sqlite")
+        db = DataBase(databases[extension])
+        seconds, _ = timed(lambda: db.add_assembly(fasta, "assembly"))
+        results.append(
+            result(
+                f"add_assembly{extension}", seconds, nr_chromosomes * chromosome_size
+            )
+        )
+
+        seconds, nr_rows = timed(
+            lambda: [
+                db.add_data(path, "assembly", f"condition{i}")
+                for i, path in enumerate(paths)
+            ]
+        )
+        results.append(result(f"add_data{extension}", seconds, sum(nr_rows)))
+        db.close()
+
+    # construct the datasets, and get items
+    for extension, database in databases.items():
+        dataset_class = DATASETS[extension]
+        for index in ["sql", "memory"]:
+            seconds, dataset = timed(
+                lambda: dataset_class(
+                    database, seq_length=seq_length, stride=stride, index=index
+                )
+            )
+            name = f"{dataset_class.__name__}_{index}"
+            results.append(result(f"construct_{name}", seconds, len(dataset)))
+
+            indices = rng.integers(0, len(dataset), nr_items).tolist()
+            seconds, _ = timed(lambda: [dataset[i] for i in indices])
+            results.append(result(f"getitem_{name}", seconds, len(indices)))
+
+            seconds, _ = timed(
+                lambda: [dataset.get_label(*dataset._index_to_site(i)) for i in indices]
+            )
+            results.append(result(f"get_label_{name}", seconds, len(indices)))
+
+            seconds, _ = timed(lambda: dataset.__getitems__(indices))
+            results.append(result(f"getitems_{name}", seconds, len(indices)))
+            dataset.close()
+
+    # iterate over the (threaded) batch loader
+    dataset = BedDataSet(databases[".bed"], seq_length=seq_length, stride=stride)
+    for threads in num_threads:
+        results.append(benchmark_batch_loader(dataset, threads, batch_size, nr_batches))
+    dataset.close()
+
+    # compare random and block shuffling, each with its own (cold) sequence cache
+    samplers = {
+        "random": lambda dataset: rng.permutation(len(dataset)).tolist(),
+        "block": lambda dataset: BlockShuffleSampler(
+            dataset, block_size, buffer, seed=seed
+        ),
+    }
+    for name, sampler in samplers.items():
+        dataset = BedDataSet(
+            databases[".bed"],
+            seq_length=seq_length,
+            stride=stride,
+            cache_sequences=2 ** 26,
+            stats=True,
+        )
+        results.append(
+            benchmark_sampler(dataset, name, sampler(dataset), batch_size, nr_batches)
+        )
+        dataset.close()
+
+    # iterate over a dataloader
+    try:
+        import torch  # noqa: F401
+    except ImportError:
+        results.append({"name": "dataloader", "skipped": "torch is not installed"})
+    else:
+        dataset = BedDataSet(databases[".bed"], seq_length=seq_length, stride=stride)
+        for workers in num_workers:
+            results.append(
+                benchmark_dataloader(dataset, workers, batch_size, nr_batches)
+            )
+        dataset.close()
+
+    environment = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    return {"config": config, "environment": environment, "results": results}
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Run the benchmarks from the command line, and write the results as JSON.
+    """
+    parser = argparse.ArgumentParser(
+        prog="peaksql-benchmark", description="Benchmark the peaksql data pipeline."
+    )
+    parser.add_argument("--chromosomes", type=int, default=4)
+    parser.add_argument("--chromosome-size", type=int, default=1_000_000)
+    parser.add_argument("--intervals", type=int, default=100_000)
+    parser.add_argument("--conditions", type=int, default=2)
+    parser.add_argument("--seq-length", type=int, default=1000)
+    parser.add_argument("--stride", type=int, default=500)
+    parser.add_argument(
+        "--items", type=int, default=1000, help="number of items to get"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        nargs="+",
+        default=[0, 2],
+        help="numbers of DataLoader workers",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="numbers of BatchLoader threads",
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=1024,
+        help="number of consecutive windows per block of the block sampler",
+    )
+    parser.add_argument(
+        "--buffer",
+        type=int,
+        default=8,
+        help="number of blocks the block sampler shuffles together",
+    )
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--directory",
+        default=None,
+        help="where to generate the data (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--output", default="-", help="JSON output file (default: stdout)"
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        results = run(
+            directory,
+            nr_chromosomes=args.chromosomes,
+            chromosome_size=args.chromosome_size,
+            nr_intervals=args.intervals,
+            nr_conditions=args.conditions,
+            seq_length=args.seq_length,
+            stride=args.stride,
+            nr_items=args.items,
+            num_workers=args.num_workers,
+            num_threads=args.num_threads,
+            block_size=args.block_size,
+            buffer=args.buffer,
+            batch_size=args.batch_size,
+            nr_batches=args.batches,
+            seed=args.seed,
+        )
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
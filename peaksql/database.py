@@ -1,12 +1,76 @@
+import logging
+import multiprocessing
 import sqlite3
 import os
+import queue
+import time
+import urllib.parse
+from contextlib import contextmanager
 from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import pyfaidx
 import pandas as pd
 import numpy as np
 
 import peaksql.tables as tables
+from .genome import load_packed, pack_fasta
+from .signal import SignalWriter
+
+logger = logging.getLogger(__name__)
+
+# the ways the r*tree of an assembly can be partitioned, and the column of each
+PARTITIONS = {"chromosome": "ChromosomeId", "condition": "ConditionId"}
+
+# the number of prepared statements sqlite(3) keeps per connection
+CACHED_STATEMENTS = 512
+
+# the statements that are executed often, always executed by the same (parameterised)
+# text so sqlite only has to parse and plan them once per connection
+STATEMENTS = {
+    "assembly_id": "SELECT AssemblyId FROM Assembly WHERE Assembly = ? LIMIT 1",
+    "chromosome_id": (
+        "SELECT ChromosomeId FROM Chromosome WHERE Chromosome = ? AND AssemblyId = ? "
+        "LIMIT 1"
+    ),
+    "offset_chromosomeid": (
+        "SELECT Offset, ChromosomeId FROM Chromosome "
+        "INNER JOIN Assembly ON Assembly.AssemblyId = Chromosome.AssemblyId "
+        "WHERE Chromosome = ? AND Assembly = ?"
+    ),
+    "chromosome_size": (
+        "SELECT Chromosome.Size FROM Chromosome "
+        "INNER JOIN Assembly ON Assembly.AssemblyId = Chromosome.AssemblyId "
+        "WHERE Chromosome = ? AND Assembly = ?"
+    ),
+    "assemblies": "SELECT Assembly FROM Assembly",
+    "chromosomes": (
+        "SELECT Chromosome, ChromosomeId, Offset FROM Chromosome WHERE AssemblyId = ?"
+    ),
+    "partitions": (
+        "SELECT Assembly, ChromosomeId, ConditionId, TableName FROM BedPartition "
+        "INNER JOIN Assembly ON Assembly.AssemblyId = BedPartition.AssemblyId "
+        "ORDER BY PartitionId"
+    ),
+    "partition": (
+        "SELECT TableName FROM BedPartition WHERE AssemblyId = ? "
+        "AND ChromosomeId IS ? AND ConditionId IS ?"
+    ),
+    "condition_id": "SELECT ConditionId FROM Condition WHERE Condition = ?",
+}
+
+
+def quote(identifier: str) -> str:
+    """
+    Quote an identifier (e.g. a table name), so that it can be used in a statement
+    whatever characters it contains.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+# the (0-based) columns we use of each supported file type: chrom, chromstart,
+# chromend, and the value (bedgraph) or peak (narrowPeak)
+COLUMNS = {".bed": [0, 1, 2], ".narrowPeak": [0, 1, 2, 9], ".bdg": [0, 1, 2, 3]}
 
 
 class DataBase:
@@ -15,45 +79,177 @@ class DataBase:
     peaksql database.
     """
 
-    def __init__(self, db: str = "PeakSQL.sqlite", in_memory: bool = False):
+    def __init__(
+        self,
+        db: str = "PeakSQL.sqlite",
+        in_memory: bool = False,
+        read_only: bool = False,
+        mmap_size: int = 0,
+    ):
         """
         :param db: the name (path) of the database, will create a new database if it
             doesn't exist yet.
         :param in_memory: whether to load a (pre-existing) database into memory. This
             can be useful in combination with one of the dataloaders for
             faster queries.
+        :param read_only: whether to open a (pre-existing) database as read-only and
+            immutable. This skips all locking, but requires that the database is not
+            changed as long as the connection is open. Read-only connections can be
+            shared between threads.
+        :param mmap_size: the maximum number of bytes of the database to access
+            through memory-mapped I/O instead of reads (default: 0, no memory-mapping).
+            Processes that memory-map the same database share its pages.
         """
         self.db = db
+        self.read_only = read_only
 
         # connect, and set a relatively high timeout number for multiprocessing
-        self.conn = sqlite3.connect(db, timeout=30)
+        if read_only:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(db))}?mode=ro&immutable=1"
+            self.conn = sqlite3.connect(
+                uri,
+                uri=True,
+                check_same_thread=False,
+                cached_statements=CACHED_STATEMENTS,
+            )
+        else:
+            self.conn = sqlite3.connect(
+                db, timeout=30, cached_statements=CACHED_STATEMENTS
+            )
         self.cursor = self.conn.cursor()
+        self.statements = dict(STATEMENTS)
+        if mmap_size:
+            self.cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
 
         self.in_memory = in_memory
         if in_memory:
             # start a connection with our memory and move our database there
-            dest = sqlite3.connect(":memory:")
+            dest = sqlite3.connect(
+                ":memory:",
+                check_same_thread=not read_only,
+                cached_statements=CACHED_STATEMENTS,
+            )
             self.conn.backup(dest)
+            self.conn.close()
 
             # replace the old connection and cursor with our new in-memory connection
             self.conn = dest
             self.cursor = self.conn.cursor()
 
         # register all the tables (Assembly, Chromosome, Condition, Peak)
-        for table in [table for table in dir(tables) if not table.startswith("__")]:
-            virtual = "VIRTUAL" if "virtual" in getattr(tables, table).lower() else ""
-            self.cursor.execute(
-                f"CREATE {virtual} TABLE IF NOT EXISTS {getattr(tables, table)}"
-            )
+        if not read_only:
+            for table in [table for table in dir(tables) if not table.startswith("__")]:
+                virtual = (
+                    "VIRTUAL" if "virtual" in getattr(tables, table).lower() else ""
+                )
+                self.cursor.execute(
+                    f"CREATE {virtual} TABLE IF NOT EXISTS {getattr(tables, table)}"
+                )
+
+        # databases made by older versions miss the newer columns of the assemblies
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(Assembly)")]
+        for column in ["PackedPath", "PartitionBy"]:
+            if column not in columns and not read_only:
+                self.cursor.execute(f"ALTER TABLE Assembly ADD COLUMN {column} TEXT")
+                columns.append(column)
 
         self.conn.commit()
+        self._partitions: Optional[
+            Dict[str, List[Tuple[Optional[int], Optional[int], str]]]
+        ] = None
+        self._upgrade()
 
-        # if we are loading a pre-existing database connect to all the assemblies
+        # if we are loading a pre-existing database connect to all the assemblies,
+        # (lazily) since reading the index of a fasta can take a while
         self.cursor.execute("SELECT Assembly, AbsPath FROM Assembly")
-        self.fastas = {
-            assembly: pyfaidx.Fasta(abspath)
-            for assembly, abspath in self.cursor.fetchall()
+        self.fastas = _Fastas(self.cursor.fetchall())
+
+        # and memory-map the assemblies that are packed, together with their offset
+        self.genomes: Dict[str, Tuple[np.ndarray, int]] = dict()
+        if "PackedPath" in columns:
+            self.cursor.execute(
+                "SELECT Assembly, PackedPath, MIN(Offset) FROM Assembly "
+                "INNER JOIN Chromosome ON Chromosome.AssemblyId = Assembly.AssemblyId "
+                "WHERE PackedPath IS NOT NULL "
+                "GROUP BY Assembly.AssemblyId"
+            )
+            self.genomes = {
+                assembly: (load_packed(packed_path), offset)
+                for assembly, packed_path, offset in self.cursor.fetchall()
+            }
+
+    def close(self):
+        """
+        Close the connection to the database and all the assemblies.
+        """
+        self.conn.close()
+        for fasta in self.fastas.values():
+            fasta.close()
+        self.fastas.clear()
+        self.genomes.clear()
+
+    def _upgrade(self):
+        """
+        Upgrade a database made by an older version of peaksql. These stored the
+        AssemblyId of the chromosomes as text, and have a single r*tree per assembly
+        (BedVirtual_{assembly}) without auxiliary columns, that is not registered in
+        BedPartition. The r*tree is rebuilt from its intervals joined with the Bed
+        table. Read-only databases can not be upgraded, so those raise an error.
+        """
+        names = {
+            row[0] for row in self.cursor.execute("SELECT name FROM sqlite_master")
         }
+        if "Assembly" not in names:
+            return
+        registered = set()
+        if "BedPartition" in names:
+            registered = {
+                row[0]
+                for row in self.cursor.execute("SELECT TableName FROM BedPartition")
+            }
+        legacy = [
+            (assembly_id, assembly)
+            for assembly_id, assembly in self.cursor.execute(
+                "SELECT AssemblyId, Assembly FROM Assembly"
+            ).fetchall()
+            if f"BedVirtual_{assembly}" in names
+            and f"BedVirtual_{assembly}" not in registered
+        ]
+        if not legacy:
+            return
+        if self.read_only:
+            raise ValueError(
+                f"Database {self.db} was made by an older version of peaksql, open it "
+                f"once with DataBase({self.db!r}) to upgrade it"
+            )
+
+        self.cursor.execute(
+            "UPDATE Chromosome SET AssemblyId = CAST(AssemblyId AS INTEGER) "
+            "WHERE typeof(AssemblyId) = 'text'"
+        )
+        for assembly_id, assembly in legacy:
+            old = f"BedVirtual_{assembly}"
+            self.cursor.execute(
+                f"ALTER TABLE {quote(old)} RENAME TO {quote(old + '_old')}"
+            )
+            table = self._get_partition(assembly_id, assembly)
+            self.cursor.execute(
+                f"INSERT INTO {quote(table)} "
+                f"SELECT Old.BedId, Old.ChromStart, Old.ChromEnd, Bed.ConditionId, "
+                f"    Bed.ChromosomeId, Bed.DataValue, Bed.Peak "
+                f"FROM {quote(old + '_old')} Old "
+                f"INNER JOIN Bed ON Bed.BedId = Old.BedId "
+                f"ORDER BY Old.ChromStart"
+            )
+            self.cursor.execute(f"DROP TABLE {quote(old + '_old')}")
+            logger.info(f"Upgraded the r*tree of assembly {assembly} of {self.db}")
+        self.conn.commit()
+
+    def execute(self, statement: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        """
+        Execute a statement of the registry (DataBase.statements) by its name.
+        """
+        return self.cursor.execute(self.statements[statement], parameters)
 
     @lru_cache()
     def get_assembly_id(self, assembly_name: str) -> int:
@@ -63,11 +259,7 @@ class DataBase:
         :param assembly_name: name of the assembly
         :return: id of the assembly
         """
-        result = self.cursor.execute(
-            f"SELECT AssemblyId FROM Assembly "
-            f"    WHERE Assembly='{assembly_name}' "
-            f"LIMIT 1"
-        ).fetchone()
+        result = self.execute("assembly_id", (assembly_name,)).fetchone()
         if result:
             return result[0]
         raise ValueError(f"Assembly {assembly_name} is not present in the database")
@@ -81,12 +273,7 @@ class DataBase:
         :param chrom_name: name of the assembly
         :return: id of the chromosome
         """
-        result = self.cursor.execute(
-            f"SELECT ChromosomeId FROM Chromosome "
-            f"    WHERE Chromosome='{chrom_name}' "
-            f"    AND AssemblyId='{assembly_id}'"
-            f"LIMIT 1"
-        ).fetchone()
+        result = self.execute("chromosome_id", (chrom_name, assembly_id)).fetchone()
         if result:
             return result[0]
         raise ValueError(
@@ -98,26 +285,134 @@ class DataBase:
         """
         Get the offset and chromosomeid based on assembly and chromosome name.
         """
-        return self.cursor.execute(
-            f"""
-            SELECT Offset, ChromosomeId FROM Chromosome
-            INNER JOIN Assembly ON Assembly.AssemblyId = Chromosome.AssemblyId
-            WHERE Chromosome='{chrom_name}' AND Assembly='{assembly_name}'
-            """
+        return self.execute(
+            "offset_chromosomeid", (chrom_name, assembly_name)
         ).fetchone()
 
+    @lru_cache(maxsize=2 ** 16)
+    def get_chromosome_size(self, assembly_name: str, chrom_name: str) -> int:
+        """
+        Get the size of a chromosome based on assembly and chromosome name.
+        """
+        (size,) = self.execute(
+            "chromosome_size", (chrom_name, assembly_name)
+        ).fetchone()
+        return size
+
+    def get_sequence(self, assembly: str, chrom: str, chromstart: int, chromend: int):
+        """
+        Get the sequence of chrom:chromstart-chromend of an assembly. For packed
+        assemblies this is an uint8 view on the packed genome, otherwise it is the
+        sequence (str) read by pyfaidx.
+        """
+        if assembly in self.genomes:
+            genome, assembly_offset = self.genomes[assembly]
+            offset, _ = self.get_offset_chromosomeid(assembly, chrom)
+            offset -= assembly_offset
+            return genome[offset + chromstart : offset + chromend]
+
+        return self.fastas[assembly][chrom][chromstart:chromend].seq
+
     @property
     def assemblies(self):
         """
         All assemblies registred in the database.
         """
+        return [val[0] for val in self.execute("assemblies").fetchall()]
+
+    def get_partitions(
+        self,
+        assembly: str,
+        chromosome_id: Optional[int] = None,
+        condition_ids: Optional[List[int]] = None,
+    ) -> List[str]:
+        """
+        Get the r*tree tables (partitions) of an assembly, optionally only those that
+        can contain intervals on a chromosome and/or of a selection of conditions.
+        """
         return [
-            val[0]
-            for val in self.cursor.execute(f"SELECT Assembly FROM Assembly").fetchall()
+            table
+            for table, chrom_id in self.get_partition_chromosomes(
+                assembly, condition_ids
+            ).items()
+            if chromosome_id is None or chrom_id is None or chrom_id == chromosome_id
         ]
 
+    def get_partition_chromosomes(
+        self, assembly: str, condition_ids: Optional[List[int]] = None
+    ) -> Dict[str, Optional[int]]:
+        """
+        Get the r*tree tables (partitions) of an assembly, and the chromosome they are
+        partitioned on (None when not partitioned on chromosome), optionally only those
+        that can contain intervals of a selection of conditions.
+        """
+        if self._partitions is None:
+            self._partitions = dict()
+            for name, chrom_id, condition_id, table in self.execute(
+                "partitions"
+            ).fetchall():
+                self._partitions.setdefault(name, []).append(
+                    (chrom_id, condition_id, table)
+                )
+
+        return {
+            table: chrom_id
+            for chrom_id, condition_id, table in self._partitions.get(assembly, [])
+            if condition_ids is None
+            or condition_id is None
+            or condition_id in condition_ids
+        }
+
+    def _get_partition(
+        self,
+        assembly_id: int,
+        assembly: str,
+        chromosome_id: Optional[int] = None,
+        condition_id: Optional[int] = None,
+    ) -> str:
+        """
+        Get the r*tree table of the intervals on a chromosome and/or of a condition,
+        and make it when it does not exist yet.
+        """
+        table = self.execute(
+            "partition", (assembly_id, chromosome_id, condition_id)
+        ).fetchone()
+        if table:
+            return table[0]
+
+        table = f"BedVirtual_{assembly}"
+        if chromosome_id is not None:
+            table += f"_chrom{chromosome_id}"
+        if condition_id is not None:
+            table += f"_cond{condition_id}"
+
+        # the intervals carry their condition, chromosome and payload as auxiliary
+        # columns, so queries do not need to join the Bed table
+        self.cursor.execute(
+            f"CREATE VIRTUAL TABLE {quote(table)} USING rtree_i32("
+            f"    BedId INT,"
+            f"    ChromStart INT,"
+            f"    ChromEnd INT,"
+            f"    +ConditionId INT,"
+            f"    +ChromosomeId INT,"
+            f"    +DataValue REAL,"
+            f"    +Peak INT"
+            f")"
+        )
+        self.cursor.execute(
+            "INSERT INTO BedPartition VALUES(NULL, ?, ?, ?, ?)",
+            (assembly_id, chromosome_id, condition_id, table),
+        )
+        self._partitions = None
+        return table
+
     def add_assembly(
-        self, assembly_path: str, assembly: str = None, species: str = None
+        self,
+        assembly_path: str,
+        assembly: Optional[str] = None,
+        species: Optional[str] = None,
+        pack: bool = False,
+        partition_by: Optional[List[str]] = None,
     ):
         """
         Add an assembly (genome) to the database. Sequences from the assembly are
@@ -125,11 +420,21 @@ class DataBase:
         the fasta file is stored. This thus assumes that the assembly does not change
         location during during the database's lifetime.
 
+        Optionally the assembly is converted (once) to a packed genome file next to the
+        database. Sequences are then sliced from a memory-mapped array, instead of read
+        with PyFaidx.
+
         :param assembly_path: The path to the assembly file.
         :param assembly: The name of the assembly (optional: default is the name of the
             file).
         :param species: The name of the species the assembly belongs to (optional:
             default is the assembly name)
+        :param pack: Whether to store a packed (memory-mappable) copy of the assembly
+            (optional: default is False).
+        :param partition_by: Partition the r*tree of the assembly in a table per
+            "chromosome" and/or per "condition" (optional: default is a single table).
+            Queries only look at the tables of their chromosome, so the trees stay
+            small.
         """
         assert not self.in_memory, (
             "It is currently not supported to add data with an in-memory " "database."
@@ -148,64 +453,147 @@ class DataBase:
             assembly not in self.assemblies
         ), f"Assembly '{assembly}' has already been added to the database!"
 
+        partition_by = partition_by if partition_by else []
+        assert all(
+            partition in PARTITIONS for partition in partition_by
+        ), f"The r*tree can only be partitioned by {', '.join(PARTITIONS)}"
+
         fasta = pyfaidx.Fasta(abs_path)
         size = sum(len(seq) for seq in fasta.values())
         # add the assembly to the assembly table
         self.cursor.execute(
-            f"INSERT INTO Assembly (Assembly, Species, Abspath, Size) "
-            f"VALUES ('{assembly}', '{species}', '{abs_path}', {size})"
+            "INSERT INTO Assembly (Assembly, Species, Abspath, Size) "
+            "VALUES (?, ?, ?, ?)",
+            (assembly, species, abs_path, size),
         )
         assembly_id = self.cursor.lastrowid
+        assert assembly_id is not None
+        self.cursor.execute(
+            "UPDATE Assembly SET PartitionBy = ? WHERE AssemblyId = ?",
+            (",".join(partition_by), assembly_id),
+        )
+
+        # the packed genome is in the same order as the chromosomes (offsets)
+        if pack:
+            packed_path = os.path.abspath(f"{self.db}.{assembly}.genome")
+            pack_fasta(fasta, packed_path)
+            self.cursor.execute(
+                "UPDATE Assembly SET PackedPath = ? WHERE AssemblyId = ?",
+                (packed_path, assembly_id),
+            )
 
         # now fill the chromosome table
         offset = self.cursor.execute(
-            f"SELECT SUM(Size) FROM Assembly WHERE AssemblyId < {assembly_id}"
+            "SELECT SUM(Size) FROM Assembly WHERE AssemblyId < ?", (assembly_id,)
         ).fetchone()[0]
         offset = 0 if offset is None else offset
+        assembly_offset = offset
         for sequence_name, sequence in fasta.items():
             size = len(sequence)
             self.cursor.execute(
-                f"INSERT INTO Chromosome (AssemblyId, Size, Chromosome, Offset) "
-                f"    VALUES('{assembly_id}', '{size}', '{sequence_name}', '{offset}')"
+                "INSERT INTO Chromosome (AssemblyId, Size, Chromosome, Offset) "
+                "VALUES(?, ?, ?, ?)",
+                (assembly_id, size, sequence_name, offset),
             )
             offset += size
 
-        self.cursor.execute(
-            f"CREATE VIRTUAL TABLE BedVirtual_{assembly} USING rtree_i32("
-            f"    BedId INT,"
-            f"    ChromStart INT,"
-            f"    ChromEnd INT,"
-            f")"
-        )
+        # partitioned r*trees are made when there is data for them
+        if not partition_by:
+            self._get_partition(assembly_id, assembly)
         # clean up after yourself
         self.conn.commit()
 
-    def add_data(self, data_path: str, assembly: str, condition: str = None):
+        self.fastas[assembly] = fasta
+        if pack:
+            self.genomes[assembly] = (load_packed(packed_path), assembly_offset)
+
+    def add_data(
+        self,
+        data_path: str,
+        assembly: str,
+        condition: Optional[str] = None,
+        chunksize: int = 2 ** 20,
+        signal_bin_size: int = 1,
+        signal_zooms: int = 4,
+    ) -> int:
         """
         Add data (bed, narrowPeak, or bedgraph) to the database.
 
+        The file is streamed in chunks, with one transaction per chunk, so large files
+        do not have to fit in memory. The r*tree is filled after all the rows are
+        inserted, sorted on position.
+
+        Bedgraph files are not stored as rows, but as a binned signal track of their
+        condition (see peaksql.signal).
+
         :param data_path: The path to the assembly file.
         :param assembly: The name of the assembly. Requires the assembly to be added to
             the database prior.
         :param condition: Experimental condition (optional). This allows for filtering
             on conditions , e.g. when streaming data with a DataSet.
+        :param chunksize: The number of lines to read (and insert) at once.
+        :param signal_bin_size: The bin size (bp) of the signal of bedgraph files.
+        :param signal_zooms: The number of zoom levels of the signal of bedgraph
+            files, each zoom level has 4 times larger bins than the previous.
+        :return: The number of rows that were added.
+        """
+        return self.add_data_many(
+            [data_path],
+            assembly,
+            [condition],
+            processes=0,
+            chunksize=chunksize,
+            signal_bin_size=signal_bin_size,
+            signal_zooms=signal_zooms,
+        )
+
+    def add_data_many(
+        self,
+        data_paths: List[str],
+        assembly: str,
+        conditions: Optional[List[Optional[str]]] = None,
+        processes: Optional[int] = None,
+        chunksize: int = 2 ** 20,
+        queue_size: int = 4,
+        signal_bin_size: int = 1,
+        signal_zooms: int = 4,
+    ) -> int:
+        """
+        Add multiple data files (bed, narrowPeak, or bedgraph) to the database.
+
+        The files are parsed in parallel by a pool of processes, which pass their
+        chunks through a bounded queue to this process. This process is the only one
+        writing to the database.
+
+        :param data_paths: The paths to the data files.
+        :param assembly: The name of the assembly. Requires the assembly to be added to
+            the database prior.
+        :param conditions: The experimental condition of each file (optional). The
+            signal of the bedgraph files of a condition is summed, and can only be
+            added once: a condition that already has signal raises a ValueError.
+        :param processes: The number of processes that parse files (optional: default
+            is the number of cpus). With 0 processes files are parsed by this process.
+        :param chunksize: The number of lines to read (and insert) at once.
+        :param queue_size: The maximum number of parsed chunks per process waiting to
+            be inserted.
+        :param signal_bin_size: The bin size (bp) of the signal of bedgraph files.
+        :param signal_zooms: The number of zoom levels of the signal of bedgraph
+            files, each zoom level has 4 times larger bins than the previous.
+        :return: The number of rows that were added.
         """
         assert (
             not self.in_memory
         ), "It is currently not supported to add data with an in-memory database."
         # check for supported filetype
-        *_, extension = os.path.splitext(data_path)
-        # TODO: add more extensions
-        assert extension in [
-            ".narrowPeak",
-            ".bdg",
-            ".bed",
-        ], f"The file extension you choose is not supported"
+        for data_path in data_paths:
+            *_, extension = os.path.splitext(data_path)
+            # TODO: add more extensions
+            assert (
+                extension in COLUMNS
+            ), f"The file extension you choose ({extension}) is not supported"
 
         # check if species it belongs to has already been added to the database
-        assembly_id = self.cursor.execute(
-            f"SELECT AssemblyId FROM Assembly WHERE Assembly='{assembly}'"
-        ).fetchone()
+        assembly_id = self.execute("assembly_id", (assembly,)).fetchone()
         assembly_id = assembly_id[0] if assembly_id else assembly_id
         assert assembly_id, (
             f"Assembly '{assembly}' has not been added to the database yet. Before "
@@ -213,84 +601,346 @@ class DataBase:
             f"method."
         )
 
-        # Make sure that condition 'None' exists
-        # This somehow locks the database when in __init__
-        self.cursor.execute(
-            "INSERT INTO Condition(ConditionId, Condition) SELECT 0, NULL "
-            "WHERE NOT EXISTS(SELECT * FROM Condition WHERE ConditionId = 0)"
-        )
-
-        # get the condition id
-        condition_id = self.cursor.execute(
-            f"SELECT ConditionId FROM Condition WHERE Condition='{condition}'"
-        ).fetchone()
-        condition_id = condition_id[0] if condition_id else 0
-
-        # add the condition if necessary
-        if condition and not condition_id:
-            self.cursor.execute(f"INSERT INTO Condition VALUES(NULL, {condition})")
+        conditions = conditions if conditions else [None] * len(data_paths)
+        assert len(conditions) == len(
+            data_paths
+        ), "Each data file should have a (or no) condition."
+        condition_ids = [self._get_condition_id(condition) for condition in conditions]
 
-        # get the
-        _converter = self.cursor.execute(
-            f"SELECT Chromosome, ChromosomeId, Offset FROM Chromosome "
-            f"WHERE AssemblyId='{assembly_id}'"
-        ).fetchall()
+        # get the chromosome id and offset of each chromosome
+        _converter = self.execute("chromosomes", (assembly_id,)).fetchall()
         converter = {
             chrom: (chrom_id, offset) for chrom, chrom_id, offset in _converter
         }
 
+        # bedgraphs are stored as signal tracks, which use chromosome coordinates
+        signal = SignalWriter(self.cursor)
+        offsets = np.zeros(max(chrom_id for _, chrom_id, _ in _converter) + 1, int)
+        for _, chrom_id, offset in _converter:
+            offsets[chrom_id] = offset
+        is_signal = [data_path.endswith(".bdg") for data_path in data_paths]
+        for condition_id, bedgraph in zip(condition_ids, is_signal):
+            if bedgraph:
+                signal.add_track(condition_id, signal_bin_size, signal_zooms)
+
         # get the current BedId we are at
-        highest_id_query = self.cursor.execute(
-            "SELECT BedId FROM Bed ORDER BY BedId DESC LIMIT 1"
-        ).fetchone()
+        bed_id = self.cursor.execute("SELECT IFNULL(MAX(BedId), 0) FROM Bed").fetchone()
+        bed_id = bed_id[0] + 1
 
-        highest_id = 1
-        if highest_id_query is not None:
-            highest_id += highest_id_query[0]
+        # the positions are staged, and only added to the r*tree at the end
+        self.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS BedStaging ("
+            "    BedId INT,"
+            "    ChromStart INT,"
+            "    ChromEnd INT,"
+            "    ConditionId INT,"
+            "    ChromosomeId INT,"
+            "    DataValue REAL,"
+            "    Peak INT"
+            ")"
+        )
 
-        # read the bed(like) file
-        bed = pd.read_csv(data_path, sep="\t", header=None).rename(
-            columns={1: "chromstart", 2: "chromend"}
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(data_paths))
+
+        start_time = time.perf_counter()
+        with self._bulk_load():
+            nr_rows = 0
+            for file_idx, chunk in parse_files(
+                data_paths, converter, processes, chunksize, queue_size
+            ):
+                if is_signal[file_idx]:
+                    chrom_offsets = offsets[chunk["chrom_ids"]]
+                    signal.add(
+                        condition_ids[file_idx],
+                        chunk["chrom_ids"],
+                        chunk["chromstarts"] - chrom_offsets,
+                        chunk["chromends"] - chrom_offsets,
+                        chunk["values"],
+                    )
+                    self.conn.commit()
+                    nr_rows += len(chunk["chrom_ids"])
+                    continue
+
+                bed_lines, virt_lines = chunk_to_rows(
+                    chunk, condition_ids[file_idx], bed_id
+                )
+                self.cursor.executemany(
+                    "INSERT INTO Bed VALUES(?, ?, ?, ?, ?)", bed_lines
+                )
+                self.cursor.executemany(
+                    "INSERT INTO temp.BedStaging VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    virt_lines,
+                )
+                self.conn.commit()
+
+                bed_id += len(bed_lines)
+                nr_rows += len(bed_lines)
+
+            signal.flush()
+
+            # distribute the positions over the partitions of the r*tree, building
+            # each tree in sorted order gives a better (and faster) tree
+            partition_by = self.cursor.execute(
+                "SELECT PartitionBy FROM Assembly WHERE AssemblyId = ?", (assembly_id,)
+            ).fetchone()[0]
+            columns = [
+                PARTITIONS[partition]
+                for partition in PARTITIONS
+                if partition in (partition_by or "").split(",")
+            ]
+            self.cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS temp.BedStagingIndex "
+                f"ON BedStaging({', '.join(columns + ['ChromStart'])})"
+            )
+            partitions = self.cursor.execute(
+                f"SELECT DISTINCT {', '.join(columns)} FROM temp.BedStaging"
+                if columns
+                else "SELECT 1 FROM temp.BedStaging LIMIT 1"
+            ).fetchall()
+            for partition in partitions:
+                partition = dict(zip(columns, partition))
+                table = self._get_partition(
+                    assembly_id,
+                    assembly,
+                    partition.get("ChromosomeId"),
+                    partition.get("ConditionId"),
+                )
+                where = " AND ".join(f"{column} = ?" for column in partition)
+                self.cursor.execute(
+                    f"INSERT INTO {quote(table)} SELECT * FROM temp.BedStaging "
+                    f"{'WHERE ' + where if where else ''} ORDER BY ChromStart",
+                    tuple(partition.values()),
+                )
+            self.cursor.execute("DROP TABLE temp.BedStaging")
+            self.conn.commit()
+
+        duration = time.perf_counter() - start_time
+        logger.info(
+            f"Added {nr_rows} rows from {len(data_paths)} file(s) in {duration:.1f} "
+            f"seconds ({nr_rows / max(duration, 1e-9):.0f} rows per second)"
         )
+        return nr_rows
 
-        # now set the values that go into our db
-        bed["None"] = None
-        bed["condition_id"] = condition_id
-        bed["bedid"] = np.arange(highest_id, highest_id + bed.shape[0])
-        bed[["chromosome_id", "offset"]] = pd.DataFrame(
-            [converter[chromname] for chromname in bed[0]]
+    def _get_condition_id(self, condition: Optional[str] = None) -> int:
+        """
+        Get the ConditionId of a condition, and add the condition when it is not in the
+        database yet. No condition corresponds to ConditionId 0.
+        """
+        # Make sure that condition 'None' exists
+        self.cursor.execute(
+            "INSERT INTO Condition(ConditionId, Condition) SELECT 0, NULL "
+            "WHERE NOT EXISTS(SELECT * FROM Condition WHERE ConditionId = 0)"
         )
-        bed["chromstart"] += bed["offset"]
-        bed["chromend"] += bed["offset"]
-
-        if extension == ".bed":
-            bed_lines = bed[
-                ["condition_id", "chromosome_id", "None", "None"]
-            ].values.tolist()
-        elif extension == ".narrowPeak":
-            bed_lines = bed[
-                ["condition_id", "chromosome_id", "None", 9]
-            ].values.tolist()
-        elif extension == ".bdg":
-            bed_lines = bed[
-                ["condition_id", "chromosome_id", 3, "None"]
-            ].values.tolist()
-        else:
-            fields = {".bed": 3, ".narrowPeak": 10, "bdg": 4}
-            assert False, (
-                f"Extension {extension} should have {fields[extension]} fields,"
-                f" however it has {len(fields)}"
-            )
+        if condition is None:
+            return 0
 
-        self.cursor.executemany("INSERT INTO Bed VALUES(NULL, ?, ?, ?, ?)", bed_lines)
+        condition_id = self.execute("condition_id", (condition,)).fetchone()
+        if condition_id:
+            return condition_id[0]
 
-        # also add each bed entry to the BedVirtual table
-        virt_lines = bed[["bedid", "chromstart", "chromend"]].values.tolist()
-        self.cursor.executemany(
-            f"INSERT INTO BedVirtual_{assembly} VALUES(?, ?, ?)", virt_lines,
-        )
+        self.cursor.execute("INSERT INTO Condition VALUES(NULL, ?)", (condition,))
+        condition_id = self.cursor.lastrowid
+        assert condition_id is not None
+        return condition_id
 
+    @contextmanager
+    def _bulk_load(self):
+        """
+        Temporarily trade durability for speed while inserting a lot of rows.
+        """
+        journal_mode = self.cursor.execute("PRAGMA journal_mode").fetchone()[0]
+        synchronous = self.cursor.execute("PRAGMA synchronous").fetchone()[0]
+        cache_size = self.cursor.execute("PRAGMA cache_size").fetchone()[0]
         self.conn.commit()
 
-    def create_index(self):
-        self.cursor.execute("CREATE INDEX idx_Chromosome ON Chromosome (Chromosome)")
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=OFF")
+        self.cursor.execute("PRAGMA cache_size=-262144")  # 256 MiB
+        try:
+            yield
+        finally:
+            self.conn.commit()
+            self.cursor.execute(f"PRAGMA synchronous={synchronous}")
+            self.cursor.execute(f"PRAGMA cache_size={cache_size}")
+
+            # move everything from the write-ahead log into the database itself, since
+            # read-only (immutable) connections do not look at the log
+            try:
+                self.cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            except sqlite3.OperationalError:
+                self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class _Fastas(dict):
+    """
+    Dictionary of assembly names to their pyfaidx.Fasta, which only opens a fasta (and
+    reads its index) the first time it is used.
+    """
+
+    def __init__(self, paths: List[Tuple[str, str]]):
+        super().__init__()
+        self.paths = dict(paths)
+
+    def __missing__(self, assembly: str) -> pyfaidx.Fasta:
+        self[assembly] = pyfaidx.Fasta(self.paths[assembly])
+        return self[assembly]
+
+
+def read_chunks(data_path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Read a bed(like) file in chunks of (at most) chunksize lines, only keeping the
+    columns we use.
+    """
+    *_, extension = os.path.splitext(data_path)
+    return pd.read_csv(
+        data_path,
+        sep="\t",
+        header=None,
+        usecols=COLUMNS[extension],
+        dtype={0: str},
+        chunksize=chunksize,
+    )
+
+
+def parse_chunk(
+    chunk: pd.DataFrame, converter: Dict[str, Tuple[int, int]]
+) -> Dict[str, np.ndarray]:
+    """
+    Convert a chunk of a bed(like) file to arrays of chromosome ids, (offset)
+    chromstarts and chromends, and, when present, the values (bedgraph) or peaks
+    (narrowPeak).
+    """
+    # convert chromosome names to their id and offset
+    chrom_ids = np.empty(len(chunk), dtype=np.int64)
+    offsets = np.empty(len(chunk), dtype=np.int64)
+    for chrom, idx in chunk.groupby(0).indices.items():
+        if chrom not in converter:
+            raise ValueError(f"Chromosome {chrom} is not part of the assembly")
+        chrom_ids[idx], offsets[idx] = converter[chrom]
+
+    arrays = {
+        "chrom_ids": chrom_ids,
+        "chromstarts": chunk[1].to_numpy(dtype=np.int64) + offsets,
+        "chromends": chunk[2].to_numpy(dtype=np.int64) + offsets,
+    }
+    if 3 in chunk:
+        arrays["values"] = chunk[3].to_numpy(dtype=np.float64)
+    if 9 in chunk:
+        arrays["peaks"] = chunk[9].to_numpy(dtype=np.int64)
+
+    return arrays
+
+
+def chunk_to_rows(
+    chunk: Dict[str, np.ndarray], condition_id: int, bed_id: int
+) -> Tuple[List[tuple], List[tuple]]:
+    """
+    Convert a parsed chunk to the rows of the Bed table and the rows of the r*tree
+    (including its auxiliary columns), starting at BedId bed_id.
+    """
+    size = len(chunk["chrom_ids"])
+    bed_ids = list(range(bed_id, bed_id + size))
+
+    nones = [None] * size
+    values = chunk["values"].tolist() if "values" in chunk else nones
+    peaks = chunk["peaks"].tolist() if "peaks" in chunk else nones
+
+    condition_ids = [condition_id] * size
+    chrom_ids = chunk["chrom_ids"].tolist()
+
+    bed_lines = list(zip(bed_ids, condition_ids, chrom_ids, values, peaks))
+    virt_lines = list(
+        zip(
+            bed_ids,
+            chunk["chromstarts"].tolist(),
+            chunk["chromends"].tolist(),
+            condition_ids,
+            chrom_ids,
+            values,
+            peaks,
+        )
+    )
+    return bed_lines, virt_lines
+
+
+def parse_files(
+    data_paths: List[str],
+    converter: Dict[str, Tuple[int, int]],
+    processes: int,
+    chunksize: int,
+    queue_size: int,
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """
+    Parse data files in chunks, and yield (file index, parsed chunk) pairs. With more
+    than 0 processes the files are divided over a pool of processes, which send their
+    parsed chunks back through a bounded queue.
+    """
+    if processes == 0:
+        for file_idx, data_path in enumerate(data_paths):
+            for chunk in read_chunks(data_path, chunksize):
+                yield file_idx, parse_chunk(chunk, converter)
+        return
+
+    tasks: multiprocessing.Queue = multiprocessing.Queue()
+    for task in enumerate(data_paths):
+        tasks.put(task)
+    results: multiprocessing.Queue = multiprocessing.Queue(processes * queue_size)
+
+    workers = [
+        multiprocessing.Process(
+            target=_parse_worker,
+            args=(tasks, results, converter, chunksize),
+            daemon=True,
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+
+    try:
+        # each worker signals that it is done with a None
+        done = 0
+        while done < processes:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                # a worker that died (e.g. killed when out of memory) never sends its
+                # None, so check that they are alive instead of waiting forever
+                exitcodes = [worker.exitcode for worker in workers]
+                if any(exitcode not in [None, 0] for exitcode in exitcodes):
+                    raise RuntimeError(
+                        f"A process parsing the data files died (exit codes "
+                        f"{exitcodes})"
+                    )
+                continue
+            if result is None:
+                done += 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def _parse_worker(
+    tasks: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    converter: Dict[str, Tuple[int, int]],
+    chunksize: int,
+):
+    """
+    Parse the (file index, data path) tasks until a None is encountered.
+    """
+    try:
+        for file_idx, data_path in iter(tasks.get, None):
+            for chunk in read_chunks(data_path, chunksize):
+                results.put((file_idx, parse_chunk(chunk, converter)))
+    except Exception as e:
+        results.put(e)
+    results.put(None)
@@ -1,25 +1,35 @@
 import numpy as np
-import multiprocessing
-import threading
+import glob
+import hashlib
+import os
 from abc import ABC, abstractmethod
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
-from ..database import DataBase
+from ..database import DataBase, quote
+from .cache import BlockCache
+from .index import MemoryIndex, SharedArray
 from .labeler import _Labeler
+from .pool import HandlePool
+from .sharded import export
+from .stats import Stats
 import peaksql.util as util
 
+# the maximum number of selects in a compound (UNION ALL) select of sqlite
+MAX_COMPOUND_SELECT = 500
+
 
 class _DataSet(ABC, _Labeler):
     """
     DataSet baseclass.
     """
 
-    SELECT_CHROM_ASS = "SELECT Assembly, Chromosome "
+    SELECT_CHROM_ASS = "SELECT Assembly, Chromosome, ChromosomeId, Chr.Size "
     FROM = (
         " FROM Chromosome Chr "
         " INNER JOIN Assembly Ass  ON Chr.AssemblyId   = Ass.AssemblyId "
     )
     SELECT_LABEL: str
+    DTYPE: type
 
     def __init__(self, database: str, where: str = "", seq_length: int = 200, **kwargs):
         # check for valid input
@@ -28,11 +38,26 @@ class _DataSet(ABC, _Labeler):
 
         # store general stuff
         self.database_path = database
-        self.databases: Dict[str, DataBase] = dict()
+        self.handles = HandlePool(database, in_memory=kwargs.get("in_memory", False))
         self.seq_length = seq_length
         self.in_memory = kwargs.get("in_memory", False)
+        self.index = kwargs.get("index", "sql")
         self.iter_index = 0
 
+        if self.index not in ["sql", "memory"]:
+            raise ValueError("index should be either 'sql' or 'memory'")
+
+        # optional per-stage timing and counters (see Stats)
+        self.stats = Stats() if kwargs.get("stats", False) else None
+
+        # optionally read the sequences in (cached) blocks, with a memory budget per
+        # process
+        self.block_cache = None
+        if kwargs.get("cache_sequences", 0):
+            self.block_cache = BlockCache(
+                kwargs["cache_sequences"], kwargs.get("block_size", 2 ** 16)
+            )
+
         # sql(ite) lookup
         self.WHERE = where
         query = (
@@ -41,30 +66,141 @@ class _DataSet(ABC, _Labeler):
         self._database.cursor.execute(query)
         self.fetchall = self._database.cursor.fetchall()
 
+        # get all the conditions and their id in the database
+        self.all_conditions = {
+            k: v
+            for k, v in self._database.cursor.execute(
+                "SELECT DISTINCT Condition, ConditionId FROM Condition "
+                "ORDER BY ConditionId"
+            ).fetchall()
+        }
+
+        # the selected conditions, each gets its own label channel (in order)
+        conditions = kwargs.get("conditions", list(self.all_conditions))
+        for condition in conditions:
+            if condition not in self.all_conditions:
+                raise ValueError(f"Condition {condition} is not in the database")
+        self.conditions = {
+            condition: self.all_conditions[condition] for condition in conditions
+        }
+        self.channels = np.full(
+            max(self.all_conditions.values(), default=0) + 1, -1, dtype=np.int64
+        )
+        self.channels[list(self.conditions.values())] = np.arange(len(self.conditions))
+
+        # only look up the intervals of the selected conditions
+        self.condition_ids = None
+        self.CONDITION_FILTER = ""
+        self.statements: Dict[tuple, List[str]] = dict()
+        self.window_selects: Dict[str, List[Tuple[Optional[int], str]]] = dict()
+        if len(self.conditions) < len(self.all_conditions):
+            self.condition_ids = sorted(self.conditions.values())
+            self.CONDITION_FILTER = (
+                f" AND {{table}}.ConditionId IN "
+                f"({', '.join(map(str, self.condition_ids))})"
+            )
+
+        _Labeler.__init__(self, **{"label_func": "any", **kwargs})
+
         # get the genomic positions of our indices
+        self._chromosome_table: Optional[Tuple[list, np.ndarray, np.ndarray]] = None
+        self._balanced_tables: Dict[int, tuple] = dict()
+        self._random_state = None
         if "stride" in kwargs:
             self.stride = kwargs["stride"]
-            self.chromosomes, self.cumsum, self.positions = self.get_strided_positions(
-                self.seq_length, self.stride
+            index_path = self._cache_path(
+                "index", self.WHERE, self.seq_length, self.stride, extension="npz"
             )
+            if kwargs.get("cache_index", False) and os.path.exists(index_path):
+                index = self._load_index(index_path)
+            else:
+                index = self.get_strided_positions(self.seq_length, self.stride)
+                if kwargs.get("cache_index", False):
+                    self._save_index(index_path, *index[:3])
+            self.chromosomes, self.chromosome_ids, self.cumsum, self.positions = index
         if "nr_rand_pos" in kwargs:
             self.nr_rand_pos = kwargs["nr_rand_pos"]
-            self.chromosomes, self.cumsum, self.positions = self.get_random_positions(
-                self.seq_length, self.nr_rand_pos
-            )
+            self.positive_fraction = kwargs.get("positive_fraction", None)
+            self.condition_weights = kwargs.get("condition_weights", None)
 
-        # get all the conditions and their id in the database
-        self.all_conditions = {
-            k: v
-            for k, v in self._database.cursor.execute(
-                "SELECT DISTINCT Condition, ConditionId FROM Condition"
-            ).fetchall()
-        }
+            # the seed and epoch the positions are drawn with, shared with (persistent)
+            # DataLoader workers so they follow reseed and set_epoch. Without a seed
+            # the global numpy random state decides.
+            seed = kwargs.get("seed", None)
+            if seed is None:
+                seed = np.random.randint(2 ** 63 - 1, dtype=np.int64)
+            self._random_state = SharedArray(np.array([seed, 0], dtype=np.int64))
+            self._resample()
+        if "condition_weights" in kwargs and "positive_fraction" not in kwargs:
+            raise ValueError("condition_weights requires a positive_fraction")
+        if "stride" in kwargs and "positive_fraction" in kwargs:
+            raise ValueError("Only random positions can be balanced")
+
+        # load all the intervals in memory, so we do not need sql(ite) for the labels
+        if self.index == "memory":
+            self.memory_index = MemoryIndex(
+                self._database, self.SELECT_LABEL, self.condition_ids
+            )
+            if self.in_memory == "shared":
+                self.memory_index.share()
 
-        # mark fetchall for garbage collection (large and we don't need it anymore)
+        # keep the chromosomes of the query, and mark fetchall for garbage collection
+        # (large and we don't need it anymore)
+        self._query_chromosomes()
         del self.fetchall
 
-        _Labeler.__init__(self, label_func=kwargs.get("label_func", "any"))
+        # optionally replace the label queries by a lookup in precomputed labels
+        self.labels: Optional[np.ndarray] = None
+        if kwargs.get("cache_labels", False):
+            self.precompute_labels()
+
+    def reseed(self, seed: int):
+        """
+        Draw new random positions with another seed (and from epoch 0). Only the
+        positions are drawn again, so this is cheap compared to making a new dataset.
+        Has no effect on strided datasets.
+        """
+        if self._random_state is not None:
+            self._random_state.array[...] = [seed, 0]
+            self._resample()
+
+    def set_epoch(self, epoch: int):
+        """
+        Draw the random positions of an epoch. The positions are a function of the seed
+        and the epoch only, so they are the same in all processes, and DataLoader
+        workers (also persistent ones) follow the epoch of the main process. Call it
+        before iterating over an epoch. Has no effect on strided datasets.
+        """
+        if self._random_state is not None:
+            self._random_state.array[1] = epoch
+            self._resample()
+
+    def _resample(self):
+        """
+        Draw the random positions of the current seed and epoch.
+        """
+        seed, epoch = self._random_state.array.tolist()
+        rng = np.random.default_rng([seed, epoch])
+        if self.positive_fraction is not None:
+            index = self.get_balanced_positions(
+                self.seq_length,
+                self.nr_rand_pos,
+                self.positive_fraction,
+                self.condition_weights,
+                rng,
+            )
+        else:
+            index = self.get_random_positions(self.seq_length, self.nr_rand_pos, rng)
+        self.chromosomes, self.chromosome_ids, self.cumsum, self.positions = index
+        self.seed, self.epoch = seed, epoch
+
+    def _follow_epoch(self):
+        """
+        Draw the random positions again when another process changed the seed or the
+        epoch.
+        """
+        if self._random_state.array.tolist() != [self.seed, self.epoch]:
+            self._resample()
 
     def __len__(self) -> int:
         """
@@ -80,29 +216,233 @@ class _DataSet(ABC, _Labeler):
         if index >= len(self):
             raise StopIteration
 
+        stats = self.stats
+        if stats:
+            stats.start()
         assembly, chrom, chromstart, chromend = self._index_to_site(index)
+        if stats:
+            stats.lap("index_to_site")
 
         # get the sequence, label and condition
         seq = self.get_onehot_sequence(assembly, chrom, chromstart, chromend)
-        label = self.get_label(assembly, chrom, chromstart, chromend)
+        if self.labels is not None:
+            label = self._unpack_labels(self.labels[index])
+            if stats:
+                stats.count("label_cache_hits")
+        else:
+            label = self.get_label(assembly, chrom, chromstart, chromend)
+            if stats:
+                stats.count("label_cache_misses")
 
         return seq, label
 
-    def _get_process(self) -> str:
+    def __getitems__(self, indices: List[int]) -> List[Tuple[np.ndarray, np.ndarray]]:
         """
-        PyFaidx is not multiprocessing safe when reading from fasta index or with
-        sql(ite) queries. However if we start a new DataBase class for each process, we
-        automatically start new sql(ite) connections and pyfaidx instances. This allows
-        us to "stream" our data parallel in e.g. a Pytorch dataloader.
+        Return the one-hot encoded sequences and labels of a batch of indices. The
+        labels of the whole batch are retrieved with a single query per assembly, which
+        is what e.g. a PyTorch DataLoader uses when it is available.
         """
-        process = multiprocessing.current_process().name + str(
-            threading.current_thread().ident
+        seqs, labels = self.get_batch(indices)
+        return list(zip(seqs, labels))
+
+    def get_batch(self, indices: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as self.__getitems__, but returns the batch as an array of sequences and
+        an array of labels.
+        """
+        stats = self.stats
+        if stats:
+            stats.start()
+        sites = self._sites(np.asarray(indices))
+        if stats:
+            stats.lap("index_to_site")
+
+        # encode all sequences into one buffer, instead of allocating one per sample
+        seqs = np.empty((len(sites), self.seq_length, 4), dtype=bool)
+        for site, seq in zip(sites, seqs):
+            self.get_onehot_sequence(*site, out=seq)
+        if self.labels is not None:
+            labels = self._unpack_labels(self.labels[np.asarray(indices)])
+            if stats:
+                stats.count("label_cache_hits", len(sites))
+        else:
+            labels = self.get_labels(sites)
+            if stats:
+                stats.count("label_cache_misses", len(sites))
+
+        return seqs, labels
+
+    def precompute_labels(self, batch_size: int = 4096) -> np.ndarray:
+        """
+        Compute the labels of all the windows of a strided dataset at once, after which
+        retrieving a label is a lookup in an array instead of a query.
+
+        The labels are stored as a .npy file next to the database, and are reused (and
+        memory-mapped) by datasets with the same settings as long as the database does
+        not change. Boolean labels are bit-packed along their last axis.
+        """
+        if not hasattr(self, "stride"):
+            raise ValueError("Only the labels of strided datasets can be precomputed.")
+
+        path = self._cache_path(
+            "labels",
+            type(self).__name__,
+            self.WHERE,
+            self.seq_length,
+            self.stride,
+            self.label_func,
+            self.inner_range,
+            self.ratio,
+            getattr(self, "zoom", 0),
+            list(self.conditions.values()),
         )
-        if process not in self.databases:
-            self.databases[process] = DataBase(
-                self.database_path, in_memory=self.in_memory
+        if not os.path.exists(path):
+            labels: Optional[np.memmap] = None
+            for lower in range(0, len(self), batch_size):
+                indices = np.arange(lower, min(lower + batch_size, len(self)))
+                batch = self.get_labels(self._sites(indices))
+                if batch.dtype == bool:
+                    batch = np.packbits(batch, axis=-1)
+
+                if labels is None:
+                    labels = np.lib.format.open_memmap(
+                        f"{path}.{os.getpid()}.tmp",
+                        mode="w+",
+                        dtype=batch.dtype,
+                        shape=(len(self),) + batch.shape[1:],
+                    )
+                labels[lower : lower + len(batch)] = batch
+
+            # write to a temporary file first, so other processes never read a
+            # partially written file
+            if labels is None:
+                raise ValueError("The dataset has no windows to precompute labels for.")
+            labels.flush()
+            del labels
+            _replace_cache(path)
+
+        self.labels = np.load(path, mmap_mode="r")
+        return self.labels
+
+    def _unpack_labels(self, labels: np.ndarray) -> np.ndarray:
+        """
+        Get the labels from (a batch of) precomputed labels.
+        """
+        assert self.labels is not None, "the labels are not precomputed"
+        # boolean labels are bit-packed
+        if self.labels.dtype == np.uint8:
+            count = self.inner_range if self.label_func == "none" else None
+            return np.unpackbits(
+                labels, axis=-1, count=count or len(self.conditions)
+            ).astype(bool)
+        return np.asarray(labels)
+
+    def export(
+        self,
+        path: str,
+        shard_size: int = 2 ** 16,
+        format: str = "onehot",
+        num_workers: int = 1,
+        batch_size: int = 4096,
+    ) -> str:
+        """
+        Write all the samples of the dataset to a directory, as shards of shard_size
+        samples. Each shard is a .npy file of sequences and a .npy file of labels, so
+        a ShardedDataSet can serve them memory-mapped, without the database. The
+        metadata (meta.json) is written last. Random datasets export the positions of
+        their current epoch.
+
+        :param path: the directory to write to.
+        :param shard_size: the number of samples per shard.
+        :param format: how to store the sequences: "onehot" (bool), or "bases"
+            (uint8), which takes four times less space and is one-hot encoded when
+            read.
+        :param num_workers: the number of processes that write shards in parallel.
+        :param batch_size: the number of labels that is retrieved at once.
+        :return: the path to the directory.
+        """
+        return export(self, path, shard_size, format, num_workers, batch_size)
+
+    @staticmethod
+    def _save_index(
+        path: str, chromosomes: list, chromosome_ids: np.ndarray, cumsum: np.ndarray
+    ):
+        """
+        Save a strided index (as made by get_strided_positions) to file.
+        """
+        # write to a temporary file first, so other processes never read a partially
+        # written file
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+            np.savez(
+                f,
+                assemblies=np.array([assembly for assembly, _ in chromosomes[1:]]),
+                chroms=np.array([chrom for _, chrom in chromosomes[1:]]),
+                chromosome_ids=chromosome_ids,
+                cumsum=cumsum,
             )
-        return process
+        _replace_cache(path)
+
+    @staticmethod
+    def _load_index(
+        path: str,
+    ) -> Tuple[list, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        """
+        Load a strided index saved with _DataSet._save_index.
+        """
+        with np.load(path) as index:
+            chromosomes = [(None, None)] + list(
+                zip(index["assemblies"].tolist(), index["chroms"].tolist())
+            )
+            return chromosomes, index["chromosome_ids"], index["cumsum"], None
+
+    def _cache_path(self, kind: str, *settings, extension: str = "npy") -> str:
+        """
+        Get the path to a file next to the database, unique for the settings and the
+        current state of the database. The path is
+        <database>.<kind>.<digest of settings>.<digest of state>.<extension>, so files
+        of the same settings but an older state of the database can be found (and
+        removed).
+        """
+        stat = os.stat(self.database_path)
+        key = hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+        state = hashlib.sha1(
+            repr((stat.st_size, stat.st_mtime_ns)).encode()
+        ).hexdigest()[:8]
+        return f"{self.database_path}.{kind}.{key}.{state}.{extension}"
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle the dataset without any open handles (e.g. when sent to the worker
+        processes of a PyTorch DataLoader). Memory-mapped labels are mapped again after
+        unpickling instead of being copied.
+        """
+        state = self.__dict__.copy()
+        if isinstance(self.labels, np.memmap):
+            state["labels"] = self.labels.filename
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if isinstance(self.labels, str):
+            self.labels = np.load(self.labels, mmap_mode="r")
+
+    @staticmethod
+    def worker_init_fn(worker_id: int):
+        """
+        Can be passed as worker_init_fn to a PyTorch DataLoader, so that each worker
+        opens its handles when it starts, instead of on its first sample.
+        """
+        from torch.utils.data import get_worker_info
+
+        info = get_worker_info()
+        if info is not None and isinstance(info.dataset, _DataSet):
+            info.dataset._database
+
+    def close(self):
+        """
+        Close all the open handles (of this process) of the dataset.
+        """
+        self.handles.close()
 
     def _index_to_site(self, index: int) -> Tuple[str, str, int, int]:
         """
@@ -111,108 +451,338 @@ class _DataSet(ABC, _Labeler):
 
         Uses binary search for fast retrieval.
         """
+        if self._random_state is not None:
+            self._follow_epoch()
         index_bs = util.binary_search(index, self.cumsum)
 
         assembly, chrom = self.chromosomes[index_bs]
-        chromstart = self.positions[index_bs][index - self.cumsum[index_bs - 1]]
+        if self.positions is None:
+            chromstart = (index - self.cumsum[index_bs - 1]) * self.stride
+        else:
+            chromstart = self.positions[index]
         chromend = chromstart + self.seq_length
 
-        return assembly, chrom, chromstart, chromend
+        return assembly, chrom, int(chromstart), int(chromend)
+
+    def indices_to_sites(
+        self, indices: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Convert an array of indices of self.__getitem__ to arrays of (chrom id,
+        chromstart, chromend), with a single binary search over all indices. The chrom
+        id is the position of the (assembly, chrom) pair in self.chromosomes.
+        """
+        if self._random_state is not None:
+            self._follow_epoch()
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError("Index out of range")
+
+        chrom_ids = np.searchsorted(self.cumsum, indices, side="right")
+        if self.positions is None:
+            chromstarts = (indices - self.cumsum[chrom_ids - 1]) * self.stride
+        else:
+            chromstarts = self.positions[indices].astype(np.int64)
+        chromends = chromstarts + self.seq_length
+
+        return chrom_ids, chromstarts, chromends
+
+    def _sites(self, indices: np.ndarray) -> List[Tuple[str, str, int, int]]:
+        """
+        Same as self._index_to_site, but for an array of indices.
+        """
+        chrom_ids, chromstarts, chromends = self.indices_to_sites(indices)
+        return [
+            (*self.chromosomes[chrom_id], chromstart, chromend)
+            for chrom_id, chromstart, chromend in zip(
+                chrom_ids.tolist(), chromstarts.tolist(), chromends.tolist()
+            )
+        ]
 
     def get_strided_positions(
         self, seq_length: int, stride: int
-    ) -> Tuple[list, np.ndarray, np.ndarray]:
+    ) -> Tuple[list, np.ndarray, np.ndarray, Optional[np.ndarray]]:
         """
         Calculate a map that connects __getitem__ indices to (assembly, chrom,
         chromstart) triplet. The positions are sampled accross the query with an even
         stride.
 
-        The first return value is a list of (assembly, chrom) pairs, the second list
-        consists of the cumulative sum of the number of indices that belong to this
-        assembly, chrom pair, and the third list contains all chromstarts of the
-        sequences. This allows for a decently fast and memory-efficient lookup of
-        genomic positions corresponding to an index.
+        The first return value is a list of (assembly, chrom) pairs, the second their
+        ChromosomeIds, and the third consists of the cumulative sum of the number of
+        indices that belong to this assembly, chrom pair. The chromstarts of the
+        sequences follow from the stride, so they are not stored (None). This keeps
+        the index a few bytes per chromosome, regardless of the number of windows.
         """
-        combis = [(None, None)] + list(
-            {(assembly, chrom) for assembly, chrom, *_ in self.fetchall}
-        )
-
-        counts = [0]
-        startpos = [np.array([])]
-        non_empty_combis = [(None, None)]
-        for assembly, chrom in combis[1:]:
-            positions = np.arange(
-                0, len(self._database.fastas[assembly][chrom]) - seq_length + 1, stride
-            )
-            if len(positions):
-                non_empty_combis.append((assembly, chrom))
-                startpos.append(positions)
-                counts.append(len(startpos[-1]))
+        names, chromosome_ids, sizes = self._query_chromosomes()
 
-        cumsum = np.cumsum(counts)
+        # the number of windows that fit on each chromosome
+        counts = np.where(sizes >= seq_length, (sizes - seq_length) // stride + 1, 0)
 
-        return non_empty_combis, cumsum, startpos
+        return self._make_index(names, chromosome_ids, counts)
 
     def get_random_positions(
-        self, seq_length: int, nr_rand_pos: int
-    ) -> Tuple[list, np.ndarray, np.ndarray]:
+        self,
+        seq_length: int,
+        nr_rand_pos: int,
+        rng: Optional[np.random.Generator] = None,
+    ) -> Tuple[list, np.ndarray, np.ndarray, Optional[np.ndarray]]:
         """
         Calculate a map that connects __getitem__ indices to (assembly, chrom,
         chromstart) triplet. The positions are sampled accross the query randomly, but
         proportional to the size of each chromosome.
 
-        The first return value is a list of (assembly, chrom) pairs, the second list
-        consists of the cumulative sum of the number of indices that belong to this
-        assembly, chrom pair, and the third list contains all chromstarts of the
-        sequences. This allows for a decently fast and memory-efficient lookup of
+        The first return value is a list of (assembly, chrom) pairs, the second their
+        ChromosomeIds, the third consists of the cumulative sum of the number of
+        indices that belong to this assembly, chrom pair, and the fourth is an (uint32)
+        array with the chromstart of each index, grouped per chromosome and sorted on
+        position. This allows for a decently fast and memory-efficient lookup of
         genomic positions corresponding to an index.
+
+        The positions are drawn with rng (default: a generator without seed).
         """
-        combis = [(None, None)] + [
-            (assembly, chrom)
-            for assembly, chrom, *_ in self.fetchall
-            if len(self._database.fastas[assembly][chrom]) > seq_length
-        ]
+        rng = rng or np.random.default_rng()
+        names, chromosome_ids, sizes = self._query_chromosomes()
+        sizes = np.where(sizes > seq_length, sizes, 0)
 
         # distribute the positions over the chromosomes
-        sizes = []
-        for assembly, chrom in combis[1:]:
-            sizes.append(len(self._database.fastas[assembly][chrom]))
+        counts = rng.multinomial(nr_rand_pos, sizes / np.sum(sizes))
 
-        distribution = np.random.choice(
-            range(len(sizes)), size=nr_rand_pos, p=np.array(sizes) / np.sum(sizes)
+        # then distribute inside a chromosome, sorted so that neighbouring indices are
+        # neighbouring windows
+        chromstarts = rng.integers(0, np.repeat(sizes - seq_length, counts)).astype(
+            np.uint32
         )
-        vals, counts = np.unique(distribution, return_counts=True)
-
-        # then distribute inside a chromosome
-        total_counts = [0]
-        startpos = [np.array([])]
-        non_empty_combis = [(None, None)]
-        for i, (assembly, chrom) in enumerate(combis[1:]):
-            where = np.where(vals == i)
-            if len(where[0]) > 0:
-                total_counts.append(counts[where[0][0]])
-                startpos.append(
-                    np.random.randint(
-                        0,
-                        len(self._database.fastas[assembly][chrom]) - seq_length,
-                        size=counts[where[0][0]],
-                    )
-                )
-                non_empty_combis.append((assembly, chrom))
+        chromstarts = chromstarts[
+            np.lexsort((chromstarts, np.repeat(np.arange(len(counts)), counts)))
+        ]
+
+        return self._make_index(names, chromosome_ids, counts, chromstarts)
+
+    def get_balanced_positions(
+        self,
+        seq_length: int,
+        nr_rand_pos: int,
+        positive_fraction: float,
+        condition_weights: Optional[Dict[str, float]] = None,
+        rng: Optional[np.random.Generator] = None,
+    ) -> Tuple[list, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        """
+        Same as get_random_positions, but a fraction of the windows is drawn around the
+        intervals of the (selected) conditions, and the rest is drawn from the genome
+        that does not overlap with any interval. No windows have to be queried (and
+        thrown away) to get the balance.
 
-        cumsum = np.cumsum(total_counts)
+        The label range of a positive window contains the summit of an interval (when
+        it has a peak), or a random position of the interval, at a random position in
+        the label range (windows are kept on the chromosome, so summits at the very
+        ends of a chromosome can be missed). Intervals are drawn uniformly, or with
+        condition_weights the conditions get a share of the positive windows
+        proportional to their weight (default weight: 1), divided evenly over their
+        intervals. The positions are drawn with rng (default: a generator without
+        seed).
+        """
+        if not 0 <= positive_fraction <= 1:
+            raise ValueError("positive_fraction should be between 0 and 1")
+        condition_weights = condition_weights or dict()
+        for condition in condition_weights:
+            if condition not in self.conditions:
+                raise ValueError(f"Condition {condition} is not selected")
 
-        return non_empty_combis, cumsum, startpos
+        rng = rng or np.random.default_rng()
+        names, chromosome_ids, _ = self._query_chromosomes()
+        (
+            offsets,
+            high,
+            shift,
+            (chroms, starts, ends, condition_ids, peaks),
+            (segment_chroms, segment_starts, segment_ends),
+        ) = self._get_balanced_table(seq_length)
+
+        # positive windows
+        nr_positives = int(round(nr_rand_pos * positive_fraction))
+        condition_weight = np.zeros(len(self.channels))
+        for condition, condition_id in self.conditions.items():
+            condition_weight[condition_id] = condition_weights.get(condition, 1.0)
+        weights = (
+            condition_weight[condition_ids]
+            / np.bincount(condition_ids, minlength=len(self.channels))[condition_ids]
+        )
+        drawn = np.empty(0, dtype=np.int64)
+        if nr_positives:
+            if not np.sum(weights) > 0:
+                raise ValueError("There are no intervals to draw positive windows from")
+            drawn = rng.choice(
+                len(weights), size=nr_positives, p=weights / np.sum(weights)
+            )
+        centers = np.where(
+            np.isnan(peaks[drawn]),
+            starts[drawn] + rng.integers(0, np.maximum(ends[drawn] - starts[drawn], 1)),
+            starts[drawn] + np.nan_to_num(peaks[drawn]).astype(np.int64),
+        )
+        label_starts = centers - rng.integers(0, self.inner_range, nr_positives)
+        positive_chroms = chroms[drawn]
+        positive_starts = np.clip(
+            label_starts - shift - offsets[positive_chroms],
+            0,
+            high[positive_chroms] - 1,
+        )
+
+        # negative windows, from the label starts that do not overlap any interval
+        lengths = segment_ends - segment_starts
+        cumsum = np.cumsum(lengths)
+        total = cumsum[-1] if len(cumsum) else 0
+        nr_negatives = nr_rand_pos - nr_positives
+        if nr_negatives and total == 0:
+            raise ValueError("There is no sequence to draw negative windows from")
+        drawn = rng.integers(0, max(total, 1), nr_negatives)
+        segments = np.searchsorted(cumsum, drawn, side="right")
+        negative_chroms = segment_chroms[segments]
+        negative_starts = (
+            segment_starts[segments]
+            + drawn
+            - (cumsum - lengths)[segments]
+            - shift
+            - offsets[negative_chroms]
+        )
+
+        chroms = np.concatenate([positive_chroms, negative_chroms])
+        chromstarts = np.concatenate([positive_starts, negative_starts])
+        order = np.lexsort((chromstarts, chroms))
+        return self._make_index(
+            names,
+            chromosome_ids,
+            np.bincount(chroms, minlength=len(names)),
+            chromstarts[order].astype(np.uint32),
+        )
+
+    def _get_balanced_table(self, seq_length: int) -> tuple:
+        """
+        Get what balanced positions are drawn from: the offset of each chromosome, the
+        (exclusive) upper bound of the chromstarts on each chromosome, the shift of the
+        label range relative to the chromstart, the intervals (see _query_intervals),
+        and the (chromosome, start, end) segments of the label starts that do not
+        overlap with any interval. Made once per seq_length, so drawing positions again
+        is cheap.
+        """
+        if seq_length not in self._balanced_tables:
+            names, chromosome_ids, sizes = self._query_chromosomes()
+            offsets = np.array(
+                [self._database.get_offset_chromosomeid(*name)[0] for name in names],
+                dtype=np.int64,
+            )
+            high = np.where(sizes > seq_length, sizes - seq_length, 0)
+            shift = seq_length // 2 - self.inner_range // 2
+            intervals = self._query_intervals(chromosome_ids, high > 0)
+            _, starts, ends, *_ = intervals
+            segments = _complement(
+                offsets + shift, offsets + shift + high, starts - self.inner_range, ends
+            )
+            self._balanced_tables[seq_length] = (
+                offsets,
+                high,
+                shift,
+                intervals,
+                segments,
+            )
+
+        return self._balanced_tables[seq_length]
+
+    def _query_intervals(
+        self, chromosome_ids: np.ndarray, valid: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the intervals of the selected conditions on the (valid) chromosomes with
+        chromosome_ids (sorted). Returns the position of their chromosome in
+        chromosome_ids, their (offset) start and end, their condition id and their
+        peak (nan when they have none, or it is unknown).
+        """
+        where = ""
+        if self.condition_ids is not None:
+            where = f"WHERE ConditionId IN ({', '.join(map(str, self.condition_ids))})"
+        rows: List[tuple] = []
+        names, *_ = self._query_chromosomes()
+        for assembly in sorted({assembly for assembly, _ in names}):
+            for table in self._database.get_partitions(
+                assembly, None, self.condition_ids
+            ):
+                rows += self._database.cursor.execute(
+                    f"SELECT ChromosomeId, ChromStart, ChromEnd, ConditionId, Peak "
+                    f"FROM {quote(table)} {where}"
+                ).fetchall()
+        intervals = np.array(rows, dtype=np.float64).reshape(len(rows), 5)
+
+        chroms = np.searchsorted(chromosome_ids, intervals[:, 0])
+        chroms = np.minimum(chroms, max(len(chromosome_ids) - 1, 0))
+        keep = (
+            (chromosome_ids[chroms] == intervals[:, 0]) & valid[chroms]
+            if len(chromosome_ids)
+            else np.zeros(len(intervals), dtype=bool)
+        )
+        return (
+            chroms[keep],
+            intervals[keep, 1].astype(np.int64),
+            intervals[keep, 2].astype(np.int64),
+            intervals[keep, 3].astype(np.int64),
+            np.where(intervals[keep, 4] >= 0, intervals[keep, 4], np.nan),
+        )
+
+    def _query_chromosomes(self) -> Tuple[list, np.ndarray, np.ndarray]:
+        """
+        Get the (assembly, chrom) names, ChromosomeIds and sizes of all the chromosomes
+        that match the query, sorted on ChromosomeId.
+        """
+        if self._chromosome_table is None:
+            names = [(assembly, chrom) for assembly, chrom, *_ in self.fetchall]
+            chromosome_ids = np.array([row[2] for row in self.fetchall], dtype=np.int64)
+            sizes = np.array([row[3] for row in self.fetchall], dtype=np.int64)
+            self._chromosome_table = names, chromosome_ids, sizes
+        return self._chromosome_table
+
+    @staticmethod
+    def _make_index(
+        names: list,
+        chromosome_ids: np.ndarray,
+        counts: np.ndarray,
+        chromstarts: Optional[np.ndarray] = None,
+    ) -> Tuple[list, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        """
+        Make the index from the number of windows on each chromosome, and optionally
+        the chromstarts of all windows (grouped per chromosome). Chromosomes without
+        windows are left out.
+        """
+        keep = np.flatnonzero(counts)
+        return (
+            [(None, None)] + [names[i] for i in keep],
+            np.concatenate([[-1], chromosome_ids[keep]]),
+            np.concatenate([[0], np.cumsum(counts[keep])]),
+            chromstarts,
+        )
 
     def get_onehot_sequence(
-        self, assembly: str, chrom: str, chromstart: int, chromend: int
+        self,
+        assembly: str,
+        chrom: str,
+        chromstart: int,
+        chromend: int,
+        out: Optional[np.ndarray] = None,
     ) -> np.ndarray:
         """
         Get the one-hot encoded sequence based on the assembly, chromosome, chromstart
-        and chromend.
+        and chromend. Optionally writes the sequence into an existing array.
         """
-        seq = self._database.fastas[assembly][chrom][chromstart:chromend]
-        seq = util.sequence_to_onehot(seq)
+        stats = self.stats
+        if stats:
+            stats.start()
+        if self.block_cache is not None:
+            return self.block_cache.get_onehot_sequence(
+                self._database, assembly, chrom, chromstart, chromend, out, stats
+            )
+        seq = self._database.get_sequence(assembly, chrom, chromstart, chromend)
+        if stats:
+            stats.lap("sequence")
+        seq = util.sequence_to_onehot(seq, out=out)
+        if stats:
+            stats.lap("onehot")
 
         return seq
 
@@ -222,42 +792,348 @@ class _DataSet(ABC, _Labeler):
         """
         Get the label that corresponds to chromstart:chromend.
         """
+        stats = self.stats
+        if stats:
+            stats.start()
         offset, chromosomeid = self._database.get_offset_chromosomeid(assembly, chrom)
-        chromstart += offset
-        chromend += offset
-
-        # if we only want the label of an inner part
-        if hasattr(self, "inner_range"):
-            midpoint = chromstart + self.seq_length // 2
-            chromstart = midpoint - self.inner_range
-            chromend = midpoint + self.inner_range
-
-        query = f"""
-            SELECT {self.SELECT_LABEL}
-            FROM BedVirtual_{assembly}
-            INNER JOIN Bed on BedVirtual_{assembly}.BedId = Bed.BedId
-            WHERE ({chromstart} < BedVirtual_{assembly}.ChromEnd) AND
-                  ({chromend} >= BedVirtual_{assembly}.ChromStart) AND
-                  ChromosomeId = {chromosomeid}
-        """.format(
-            assembly=assembly
-        )
-        query_result = self._database.cursor.execute(query).fetchall()
+        chromstart, chromend = self._label_range(int(chromstart) + offset)
+
+        if self.index == "memory":
+            _, query_result = self.memory_index.query(
+                np.array([chromosomeid]), np.array([chromstart]), np.array([chromend])
+            )
+        else:
+            query_result = []
+            for statement in self._label_statements(assembly, chromosomeid):
+                query_result += self._database.cursor.execute(
+                    statement,
+                    {
+                        "chromstart": chromstart,
+                        "chromend": chromend,
+                        "chromosomeid": chromosomeid,
+                    },
+                ).fetchall()
+        if stats:
+            stats.lap("query")
+            stats.count("queries")
+            stats.count("rows", len(query_result))
         positions = self.array_from_query(query_result, chromstart, chromend)
+        if stats:
+            stats.lap("array_from_query")
+        labels = self.label_from_array(positions)
+        if stats:
+            stats.lap("label_from_array")
+
+        return labels
+
+    def get_labels(self, sites: List[Tuple[str, str, int, int]]) -> np.ndarray:
+        """
+        Get the labels of a batch of (assembly, chrom, chromstart, chromend) sites.
+
+        Instead of a query per site, all the windows of an assembly are retrieved with a
+        single query. The resulting rows of all the windows are then rasterised at once.
+        """
+        stats = self.stats
+        if stats:
+            stats.start()
+
+        # group the windows per assembly, since each assembly has its own r*tree
+        windows: Dict[str, list] = dict()
+        for i, (assembly, chrom, chromstart, chromend) in enumerate(sites):
+            offset, chromosomeid = self._database.get_offset_chromosomeid(
+                assembly, chrom
+            )
+            windows.setdefault(assembly, []).append(
+                (i, chromosomeid, *self._label_range(int(chromstart) + offset))
+            )
+
+        window_chromstarts = np.zeros(len(sites), dtype=np.int64)
+        intervals = [(np.empty(0, dtype=np.int64),) * 5]
+        for assembly, assembly_windows in windows.items():
+            ids, chromosome_ids, chromstarts, chromends = map(
+                np.array, zip(*assembly_windows)
+            )
+            window_chromstarts[ids] = chromstarts
+            rows: Union[np.ndarray, list]
+            if self.index == "memory":
+                window_ids, interval_ids = self.memory_index.overlap(
+                    chromosome_ids, chromstarts, chromends
+                )
+                window_ids = ids[window_ids]
+                rows = self.memory_index.payload[interval_ids]
+            else:
+                window_ids, rows = self._query_windows(assembly, assembly_windows)
+            if stats:
+                stats.lap("query")
+                stats.count("queries")
+                stats.count("rows", len(rows))
+            intervals.append((window_ids, *self.intervals_from_query(rows)))
+
+        window_ids, conditions, starts, ends, values = map(
+            np.concatenate, zip(*intervals)
+        )
+        positions: np.ndarray = np.zeros(
+            (len(sites), len(self.conditions), self.inner_range), dtype=self.DTYPE
+        )
+        self._rasterise(
+            positions,
+            window_ids,
+            conditions,
+            starts - window_chromstarts[window_ids],
+            ends - window_chromstarts[window_ids],
+            values,
+        )
+        if stats:
+            stats.lap("array_from_query")
         labels = self.label_from_array(positions)
+        if stats:
+            stats.lap("label_from_array")
 
         return labels
 
+    def _query_windows(
+        self, assembly: str, windows: List[Tuple[int, int, int, int]]
+    ) -> Tuple[np.ndarray, list]:
+        """
+        Query the overlapping rows of a batch of (window id, chromosome id, chromstart,
+        chromend) windows of an assembly. The windows are stored in a temporary table
+        and joined against the partitions of the r*tree that can contain intervals on
+        the chromosomes of the batch.
+
+        Returns the window id of each row and the rows, sorted on window id.
+        """
+        chromosome_ids = {window[1] for window in windows}
+        selects = [
+            select
+            for chrom_id, select in self._window_selects(assembly)
+            if chrom_id is None or chrom_id in chromosome_ids
+        ]
+        if not selects:
+            return np.empty(0, dtype=np.int64), []
+
+        cursor = self._database.cursor
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS Windows ("
+            "    WindowId INTEGER PRIMARY KEY,"
+            "    ChromosomeId INT,"
+            "    ChromStart INT,"
+            "    ChromEnd INT"
+            ")"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS temp.WindowsChromosome ON Windows(ChromosomeId)"
+        )
+        cursor.execute("DELETE FROM temp.Windows")
+        cursor.executemany("INSERT INTO temp.Windows VALUES(?, ?, ?, ?)", windows)
+        rows = []
+        for statement in _union_all(selects):
+            rows += cursor.execute(statement).fetchall()
+
+        # the temporary windows should not keep a transaction open
+        self._database.conn.commit()
+
+        window_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        order = np.argsort(window_ids, kind="stable")
+        return window_ids[order], [rows[i][1:] for i in order]
+
+    def _label_statements(self, assembly: str, chromosomeid: int) -> List[str]:
+        """
+        Get the (parameterised) statements that query the label rows of a window on a
+        chromosome. The statements are made once per chromosome, and only look at the
+        partitions of the r*tree that can contain the chromosome.
+        """
+        key = ("label", assembly, chromosomeid)
+        if key not in self.statements:
+            self.statements[key] = _union_all(
+                [
+                    f"""
+                    SELECT {self.SELECT_LABEL}
+                    FROM {{table}}
+                    WHERE (:chromstart < {{table}}.ChromEnd) AND
+                          (:chromend >= {{table}}.ChromStart) AND
+                          {{table}}.ChromosomeId = :chromosomeid
+                          {self.CONDITION_FILTER}
+                    """.format(
+                        table=quote(table)
+                    )
+                    for table in self._database.get_partitions(
+                        assembly, chromosomeid, self.condition_ids
+                    )
+                ]
+            )
+        return self.statements[key]
+
+    def _window_selects(self, assembly: str) -> List[Tuple[Optional[int], str]]:
+        """
+        Get the select of the label rows of the (temporary) windows for each partition
+        of the r*tree of an assembly, together with the chromosome the partition is
+        partitioned on (or None). The selects are made once per assembly. Partitions on
+        a chromosome are only joined with the windows on that chromosome.
+        """
+        if assembly not in self.window_selects:
+            # CROSS JOIN forces the windows to be the outer loop, so each window does a
+            # single r*tree lookup
+            selects = []
+            for table, chrom_id in self._database.get_partition_chromosomes(
+                assembly, self.condition_ids
+            ).items():
+                chromosome_filter = ""
+                if chrom_id is not None:
+                    chromosome_filter = f"AND Windows.ChromosomeId = {chrom_id}"
+                selects.append(
+                    (
+                        chrom_id,
+                        f"""
+                        SELECT Windows.WindowId, {self.SELECT_LABEL}
+                        FROM temp.Windows
+                        CROSS JOIN {{table}} ON
+                            (Windows.ChromStart < {{table}}.ChromEnd) AND
+                            (Windows.ChromEnd >= {{table}}.ChromStart)
+                        WHERE {{table}}.ChromosomeId = Windows.ChromosomeId
+                              {chromosome_filter}
+                              {self.CONDITION_FILTER}
+                        """.format(
+                            table=quote(table)
+                        ),
+                    )
+                )
+            self.window_selects[assembly] = selects
+        return self.window_selects[assembly]
+
+    def _label_range(self, chromstart: int) -> Tuple[int, int]:
+        """
+        Get the (offset) range the label is based on, which is the inner_range centered
+        in the window starting at chromstart.
+        """
+        midpoint = chromstart + self.seq_length // 2
+        chromstart = midpoint - self.inner_range // 2
+        return chromstart, chromstart + self.inner_range
+
     @property
-    def _database(self):
-        process = self._get_process()
-        return self.databases[process]
+    def _database(self) -> DataBase:
+        """
+        The (read-only) database handle of the current process and thread.
+        """
+        return self.handles.get()
 
-    @abstractmethod
     def array_from_query(
-        self, query: List[Tuple[int, int, int]], chromstart: int, chromend: int,
+        self, query: List[tuple], chromstart: int, chromend: int,
     ) -> np.ndarray:
+        """
+        Rasterise the rows of a query into a (conditions x chromend - chromstart)
+        array.
+        """
+        positions: np.ndarray = np.zeros(
+            (1, len(self.conditions), chromend - chromstart), dtype=self.DTYPE
+        )
+        conditions, starts, ends, values = self.intervals_from_query(query)
+        self._rasterise(
+            positions,
+            np.zeros(len(conditions), dtype=np.int64),
+            conditions,
+            starts - chromstart,
+            ends - chromstart,
+            values,
+        )
+        return positions[0]
+
+    def _rasterise(
+        self,
+        positions: np.ndarray,
+        window_ids: np.ndarray,
+        conditions: np.ndarray,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        values: np.ndarray,
+    ):
+        """
+        Rasterise intervals on the label channel of their condition, intervals of
+        conditions that are not selected are skipped.
+        """
+        channels = self.channels[conditions]
+        keep = channels >= 0
+        util.rasterise(
+            window_ids[keep],
+            channels[keep],
+            starts[keep],
+            ends[keep],
+            values[keep],
+            positions,
+        )
+
+    @abstractmethod
+    def intervals_from_query(
+        self, query: Union[np.ndarray, List[tuple]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Convert the (SELECT_LABEL) rows of a query to arrays of the condition, start,
+        end and value of the intervals to rasterise.
+        """
         pass
 
     def label_from_array(self, positions: np.ndarray) -> np.ndarray:
         raise NotImplementedError
+
+
+def _union_all(selects: List[str]) -> List[str]:
+    """
+    Combine selects with UNION ALL, into as few statements as sqlite allows (at most
+    MAX_COMPOUND_SELECT selects per statement).
+    """
+    return [
+        " UNION ALL ".join(selects[lower : lower + MAX_COMPOUND_SELECT])
+        for lower in range(0, len(selects), MAX_COMPOUND_SELECT)
+    ]
+
+
+def _replace_cache(path: str):
+    """
+    Move the temporary file (of this process) of a cache file made by
+    _DataSet._cache_path into place, and remove the files of the same settings that
+    were made for an older state of the database.
+    """
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    stem, _, extension = path.rsplit(".", 2)
+    for stale in glob.glob(f"{glob.escape(stem)}.*.{extension}"):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+def _complement(
+    lowers: np.ndarray, uppers: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the parts of the (sorted, non-overlapping) ranges lowers:uppers that are not
+    covered by any of the intervals starts:ends. Returns the index of the range and the
+    start and end of each part.
+    """
+    # merge the overlapping intervals
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    maxends = np.maximum.accumulate(ends) if len(ends) else ends
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > maxends[:-1]
+    groups = np.cumsum(new) - 1
+    merged_starts = starts[new]
+    merged_ends = np.zeros(len(merged_starts), dtype=np.int64)
+    np.maximum.at(merged_ends, groups, ends)
+
+    # the gaps between the merged intervals
+    gap_starts = np.concatenate([[np.iinfo(np.int64).min], merged_ends])
+    gap_ends = np.concatenate([merged_starts, [np.iinfo(np.int64).max]])
+
+    # the gaps each range overlaps with
+    first = np.searchsorted(gap_ends, lowers, side="right")
+    last = np.searchsorted(gap_starts, uppers, side="left")
+    counts = np.maximum(last - first, 0)
+    ranges = np.repeat(np.arange(len(counts)), counts)
+    gaps = util.expand_ranges(first, counts)
+
+    part_starts = np.maximum(lowers[ranges], gap_starts[gaps])
+    part_ends = np.minimum(uppers[ranges], gap_ends[gaps])
+    keep = part_ends > part_starts
+    return ranges[keep], part_starts[keep], part_ends[keep]
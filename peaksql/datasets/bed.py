@@ -1,5 +1,5 @@
 import numpy as np
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 from .base import _DataSet
 
@@ -9,25 +9,12 @@ class BedDataSet(_DataSet):
     The BedRegion ...
     """
 
-    SELECT_LABEL = (
-        " Bed.ConditionId, BedVirtual_{assembly}.ChromStart, "
-        "BedVirtual_{assembly}.ChromEnd"
-    )
+    DTYPE = bool
+    SELECT_LABEL = " {table}.ConditionId, {table}.ChromStart, {table}.ChromEnd"
 
-    def array_from_query(
-        self, query: List[Tuple[int, int, int]], chromstart: int, chromend: int,
-    ) -> np.ndarray:
-        positions = np.zeros((len(self.all_conditions), self.inner_range), dtype=bool)
-
-        for condition_id, start, end in query:
-            min_idx = int(start - chromstart)
-            if min_idx < 0:
-                min_idx = 0
-
-            max_idx = int(end - chromstart)
-            if max_idx > positions.shape[1]:
-                max_idx = positions.shape[1]
-
-            positions[condition_id, min_idx:max_idx] = True
-
-        return positions
+    def intervals_from_query(
+        self, query: Union[np.ndarray, List[Tuple[int, int, int]]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        rows = np.asarray(query, dtype=np.int64).reshape(len(query), 3)
+        condition_ids, starts, ends = rows.T
+        return condition_ids, starts, ends, np.ones(len(query))
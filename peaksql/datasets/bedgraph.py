@@ -1,55 +1,127 @@
 import numpy as np
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 from .base import _DataSet
+from .. import signal
 
 
 class BedGraphDataSet(_DataSet):
     """
-    The BedGraphDataSet ...
+    The BedGraphDataSet expects that bedgraph files have been added to the DataBase.
+
+    The labels are the signal of each condition at each position of the window. When
+    the database contains signal tracks (see peaksql.signal), the signal is read from
+    the (decoded) chunks of the tracks, at the resolution of the chosen zoom level.
+    Otherwise it is rasterised from the bedgraph rows.
     """
 
+    DTYPE = float
     SELECT_LABEL = (
-        " Bed.ConditionId, BedVirtual_{assembly}.ChromStart, "
-        "BedVirtual_{assembly}.ChromEnd, Bed.DataValue "
+        " {table}.ConditionId, {table}.ChromStart, {table}.ChromEnd, "
+        "{table}.DataValue "
     )
 
     def __init__(self, *args, **kwargs):
+        """
+        :param zoom: the zoom level of the signal tracks to read (default: 0, the
+            signal at its original bin size).
+        """
         kwargs.update({"label_func": "none"})
+        self.zoom = kwargs.get("zoom", 0)
+        self.tracks: Optional[Dict[int, Tuple[int, int, int]]] = None
         _DataSet.__init__(self, *args, **kwargs)
 
-    def array_from_query(
-        self, query: List[Tuple[int, int, int]], chromstart: int, chromend: int,
+    def intervals_from_query(
+        self, query: Union[np.ndarray, List[Tuple[int, int, int, float]]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        rows = np.asarray(query, dtype=np.float64).reshape(len(query), 4)
+        condition_ids, starts, ends, values = rows.T
+        return (
+            condition_ids.astype(np.int64),
+            starts.astype(np.int64),
+            ends.astype(np.int64),
+            values,
+        )
+
+    def _get_tracks(self) -> Dict[int, Tuple[int, int, int]]:
+        """
+        Get the (bin size, chunk size, zooms) of the signal track of each condition.
+        """
+        if self.tracks is None:
+            self.tracks = {
+                condition_id: (bin_size, chunk_size, zooms)
+                for condition_id, bin_size, chunk_size, zooms in (
+                    self._database.cursor.execute(
+                        "SELECT ConditionId, BinSize, ChunkSize, Zooms FROM Track"
+                    )
+                )
+            }
+            for condition_id, (_, _, zooms) in self.tracks.items():
+                if self.zoom > zooms:
+                    raise ValueError(
+                        f"The signal of condition id {condition_id} only has {zooms} "
+                        f"zoom levels"
+                    )
+
+        return self.tracks
+
+    def get_label(
+        self, assembly: str, chrom: str, chromstart: int, chromend: int
     ) -> np.ndarray:
-        positions = np.zeros(
-            (len(self.all_conditions), chromend - chromstart), dtype=float
+        if not self._get_tracks():
+            return _DataSet.get_label(self, assembly, chrom, chromstart, chromend)
+        return self.get_labels([(assembly, chrom, chromstart, chromend)])[0]
+
+    def get_labels(self, sites: List[Tuple[str, str, int, int]]) -> np.ndarray:
+        """
+        Get the signal of a batch of (assembly, chrom, chromstart, chromend) sites.
+
+        The chunks needed by the batch are read (and decoded) once per condition and
+        chromosome, after which the signal of all windows is gathered at once.
+        """
+        tracks = self._get_tracks()
+        if not tracks:
+            return _DataSet.get_labels(self, sites)
+
+        stats = self.stats
+        if stats:
+            stats.start()
+        chrom_ids = np.empty(len(sites), dtype=np.int64)
+        chromstarts = np.empty(len(sites), dtype=np.int64)
+        for i, (assembly, chrom, chromstart, _) in enumerate(sites):
+            _, chrom_ids[i] = self._database.get_offset_chromosomeid(assembly, chrom)
+            chromstarts[i], _ = self._label_range(int(chromstart))
+        positions = chromstarts[:, None] + np.arange(self.inner_range)
+
+        labels = np.zeros(
+            (len(sites), len(self.conditions), self.inner_range), dtype=self.DTYPE
         )
+        for condition_id, (bin_size, chunk_size, _) in tracks.items():
+            channel = self.channels[condition_id]
+            if channel < 0:
+                continue
+
+            bins = positions // signal.zoom_bin_size(bin_size, self.zoom)
+            chunks = bins // chunk_size
+            for chrom_id in np.unique(chrom_ids):
+                windows = chrom_ids == chrom_id
+                needed = np.unique(chunks[windows])
+                decoded = np.zeros((len(needed), chunk_size), dtype=np.float32)
+                rows = 0
+                for chunk, values in signal.read_chunks(
+                    self._database.cursor, condition_id, chrom_id, self.zoom, needed
+                ):
+                    decoded[np.searchsorted(needed, chunk)] = values
+                    rows += 1
+                if stats:
+                    stats.lap("query")
+                    stats.count("queries")
+                    stats.count("rows", rows)
+
+                labels[windows, channel] = decoded[
+                    np.searchsorted(needed, chunks[windows]), bins[windows] % chunk_size
+                ]
+                if stats:
+                    stats.lap("array_from_query")
 
-        # for condition_id, start, end, value in query:
-        #     min_idx = int(start - chromstart)
-        #     if min_idx < 0:
-        #         min_idx = 0
-        #
-        #     max_idx = int(end - chromstart)
-        #     if max_idx > positions.shape[1]:
-        #         max_idx = positions.shape[1]
-        #
-        #     positions[condition_id, min_idx:max_idx] = value
-
-        if len(query):
-            condition, min_idx, max_idx, value = np.split(np.array(query), 4, axis=1)
-            min_idx -= chromstart
-            max_idx -= chromstart
-            min_idx[min_idx < 0] = 0
-            max_idx[max_idx > positions.shape[1]] = positions.shape[1]
-            condition = condition.astype(int).flatten()
-            min_idx = min_idx.astype(int).flatten()
-            max_idx = max_idx.astype(int).flatten()
-            value = value.flatten()
-
-            print(min_idx)
-            print(max_idx)
-            print(value)
-            positions[condition, min_idx:max_idx] = value
-
-        return positions
+        return labels
@@ -0,0 +1,159 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from ..database import DataBase
+from .stats import Stats
+import peaksql.util as util
+
+
+class BlockCache:
+    """
+    LRU cache of aligned blocks of the chromosomes, so that neighbouring (e.g. strided)
+    windows are slices of a block that was read and encoded once, instead of a read
+    and an encoding per window.
+
+    Blocks are cached one-hot encoded. Blocks with ambiguous (or invalid) nucleotides
+    are cached as (uint8) sequence instead, and the windows on those blocks are
+    encoded on each read, so that ambiguous nucleotides still get a random option each
+    time (and invalid nucleotides raise an error only for the windows that contain
+    them).
+
+    The blocks are never pickled, so each (DataLoader) worker gets its own cache.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 2 ** 16):
+        """
+        :param max_bytes: the memory budget of the cached blocks (of each process).
+        :param block_size: the size (in nucleotides) of the blocks.
+        """
+        if block_size <= 0:
+            raise ValueError("block_size should be positive")
+
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.blocks: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self.nbytes = 0
+
+    def __getstate__(self) -> dict:
+        """
+        Only pickle the settings of the cache, never the blocks.
+        """
+        return {"max_bytes": self.max_bytes, "block_size": self.block_size}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._reset()
+
+    def __len__(self) -> int:
+        """
+        Return the number of cached blocks of this process.
+        """
+        return len(self.blocks)
+
+    def get_onehot_sequence(
+        self,
+        database: DataBase,
+        assembly: str,
+        chrom: str,
+        chromstart: int,
+        chromend: int,
+        out: Optional[np.ndarray] = None,
+        stats: Optional[Stats] = None,
+    ) -> np.ndarray:
+        """
+        Get the one-hot encoded sequence of chrom:chromstart-chromend of an assembly,
+        optionally written into an existing array.
+        """
+        if out is None:
+            out = np.empty((chromend - chromstart, 4), dtype=bool)
+
+        first, last = chromstart // self.block_size, (chromend - 1) // self.block_size
+        blocks = [
+            (block, self._get_block(database, assembly, chrom, block, stats))
+            for block in range(first, last + 1)
+        ]
+        if stats:
+            stats.lap("sequence")
+
+        for block, data in blocks:
+            block_start = block * self.block_size
+            lower = max(chromstart, block_start)
+            upper = min(chromend, block_start + self.block_size)
+            source = data[lower - block_start : upper - block_start]
+            if data.dtype == np.uint8:
+                util.sequence_to_onehot(
+                    source, out=out[lower - chromstart : upper - chromstart]
+                )
+            else:
+                out[lower - chromstart : upper - chromstart] = source
+        if stats:
+            stats.lap("onehot")
+
+        return out
+
+    def _get_block(
+        self,
+        database: DataBase,
+        assembly: str,
+        chrom: str,
+        block: int,
+        stats: Optional[Stats],
+    ) -> np.ndarray:
+        """
+        Get a block from the cache, or read (and encode) it when it is not cached.
+        """
+        key = (assembly, chrom, block)
+        if os.getpid() != self.pid:
+            self._reset()
+
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+        if stats:
+            stats.count(
+                "sequence_cache_hits" if data is not None else "sequence_cache_misses"
+            )
+        if data is not None:
+            return data
+
+        data = self._read_block(database, assembly, chrom, block)
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = data
+                self.nbytes += data.nbytes
+
+            # evict the least recently used blocks, but always keep the newest
+            while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return data
+
+    def _read_block(
+        self, database: DataBase, assembly: str, chrom: str, block: int
+    ) -> np.ndarray:
+        """
+        Read a block, and one-hot encode it when it only has A, C, G and T.
+        """
+        chromstart = block * self.block_size
+        chromend = min(
+            chromstart + self.block_size, database.get_chromosome_size(assembly, chrom)
+        )
+        sequence = util._to_uint8(
+            database.get_sequence(assembly, chrom, chromstart, chromend)
+        )
+
+        codes = util._NUC_TO_IDX[sequence]
+        if np.all((codes >= 0) & (codes < 4)):
+            return util.sequence_to_onehot(sequence)
+        return np.array(sequence, dtype=np.uint8)
@@ -0,0 +1,249 @@
+import numpy as np
+import os
+import weakref
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+from ..database import DataBase, quote
+import peaksql.util as util
+
+
+class MemoryIndex:
+    """
+    In-memory interval index, that answers the same overlap queries as the r*tree
+    tables of the database, but without going through sqlite.
+
+    All the intervals of the database are loaded into numpy arrays. Since the offsets
+    of the chromosomes never overlap we can keep one index for all the assemblies. The
+    intervals are grouped in buckets of similar length (between 2 ** b and 2 ** (b + 1)
+    nucleotides), and sorted on their (offset) start within each bucket. An interval of
+    a bucket can only overlap with a window when it starts less than the longest
+    interval of its bucket before the window, so the candidates of each bucket are
+    found with two binary searches, and are at most about twice the intervals that
+    actually overlap. A few long intervals thus only make the windows scan their own
+    (small) bucket, instead of all the intervals after them.
+
+    The arrays can be moved into shared memory with MemoryIndex.share, after which
+    pickled copies of the index (e.g. in DataLoader workers) attach to the same memory
+    instead of copying the arrays.
+    """
+
+    ARRAYS = ["chromosome_ids", "starts", "ends", "payload", "buckets", "maxlengths"]
+
+    def __init__(
+        self,
+        database: DataBase,
+        select_label: str,
+        condition_ids: Optional[List[int]] = None,
+    ):
+        """
+        :param database: the database to load the intervals from.
+        :param select_label: the columns to select for each interval (the SELECT_LABEL
+            of a dataset), these are returned as rows by the query.
+        :param condition_ids: only load the intervals of these conditions (optional:
+            default is all conditions).
+        """
+        chromosome_ids: List[int] = []
+        starts: List[int] = []
+        ends: List[int] = []
+        rows: List[tuple] = []
+        tables = [
+            table
+            for assembly in database.assemblies
+            for table in database.get_partitions(assembly, None, condition_ids)
+        ]
+        where = ""
+        if condition_ids is not None:
+            where = f"WHERE ConditionId IN ({', '.join(map(str, condition_ids))})"
+        for table in tables:
+            query = f"""
+                SELECT {{table}}.ChromosomeId, {{table}}.ChromStart,
+                    {{table}}.ChromEnd, {select_label}
+                FROM {{table}}
+                {where}
+            """.format(
+                table=quote(table)
+            )
+            for chromosome_id, start, end, *row in database.cursor.execute(query):
+                chromosome_ids.append(chromosome_id)
+                starts.append(start)
+                ends.append(end)
+                rows.append(tuple(row))
+
+        # sort the intervals on their start within buckets of (log2) length
+        interval_starts = np.array(starts, dtype=np.int64)
+        lengths = np.array(ends, dtype=np.int64) - interval_starts
+        bucket_ids = np.floor(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+        order = np.lexsort((interval_starts, bucket_ids))
+        self.chromosome_ids = np.array(chromosome_ids, dtype=np.int64)[order]
+        self.starts = interval_starts[order]
+        self.ends = np.array(ends, dtype=np.int64)[order]
+
+        # the selected columns, unknown (NULL) values become nan
+        payload = np.array(rows).reshape(len(rows), select_label.count(",") + 1)
+        if payload.dtype == object:
+            payload = payload.astype(float)
+        self.payload = payload[order]
+
+        # the bounds of the (non-empty) buckets, and the longest interval of each
+        bucket_ids = bucket_ids[order]
+        bounds = np.flatnonzero(np.diff(bucket_ids)) + 1
+        self.buckets = np.concatenate([[0], bounds, [len(bucket_ids)]]).astype(np.int64)
+        self.maxlengths = np.array(
+            [
+                (self.ends[lower:upper] - self.starts[lower:upper]).max()
+                for lower, upper in zip(self.buckets[:-1], self.buckets[1:])
+                if upper > lower
+            ],
+            dtype=np.int64,
+        )
+
+        self.shared: Dict[str, shared_memory.SharedMemory] = dict()
+
+    def share(self):
+        """
+        Move all the arrays of the index into shared memory. The shared memory is
+        released when the index that shared it is garbage collected.
+        """
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared[...] = array
+            setattr(self, name, shared)
+            self.shared[name] = shm
+            weakref.finalize(self, _unlink, shm, os.getpid())
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle shared arrays as a reference to their shared memory.
+        """
+        state = self.__dict__.copy()
+        state["shared"] = dict()
+        for name, shm in self.shared.items():
+            array = state.pop(name)
+            state["shared"][name] = (shm.name, array.shape, array.dtype.str)
+        return state
+
+    def __setstate__(self, state: dict):
+        shared = state.pop("shared")
+        self.__dict__.update(state)
+        self.shared = dict()
+        for name, (shm_name, shape, dtype) in shared.items():
+            shm = _attach(shm_name)
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            self.shared[name] = shm
+
+    def __len__(self) -> int:
+        """
+        Return the number of intervals in the index.
+        """
+        return len(self.starts)
+
+    def overlap(
+        self, chromosome_ids: np.ndarray, chromstarts: np.ndarray, chromends: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the overlapping intervals of a batch of (offset) windows. Uses the same
+        conditions as the sql(ite) query, so an interval overlaps when
+        chromstart < ChromEnd and chromend >= ChromStart on the same chromosome.
+
+        Returns the index of the window and the index of the interval for each overlap,
+        sorted on the window index.
+        """
+        chromosome_ids = np.asarray(chromosome_ids, dtype=np.int64)
+        chromstarts = np.asarray(chromstarts, dtype=np.int64)
+        chromends = np.asarray(chromends, dtype=np.int64)
+
+        # the candidates of each bucket are the intervals that start after the start
+        # minus the longest interval of the bucket, and not after the end
+        lower = np.empty((len(self.maxlengths), len(chromstarts)), dtype=np.int64)
+        upper = np.empty_like(lower)
+        for bucket, maxlength in enumerate(self.maxlengths):
+            first, last = self.buckets[bucket], self.buckets[bucket + 1]
+            starts = self.starts[first:last]
+            lower[bucket] = first + np.searchsorted(
+                starts, chromstarts - maxlength, side="right"
+            )
+            upper[bucket] = first + np.searchsorted(starts, chromends, side="right")
+        counts = np.maximum(upper - lower, 0).ravel()
+        lower = lower.ravel()
+
+        # expand the candidate ranges to (window, interval) pairs
+        windows = np.repeat(
+            np.tile(np.arange(len(chromstarts)), len(self.maxlengths)), counts
+        )
+        intervals = util.expand_ranges(lower, counts)
+
+        mask = (self.ends[intervals] > chromstarts[windows]) & (
+            self.chromosome_ids[intervals] == chromosome_ids[windows]
+        )
+        windows, intervals = windows[mask], intervals[mask]
+
+        # sort on the window, and within each window on the start of the interval
+        order = np.lexsort((self.starts[intervals], windows))
+        return windows[order], intervals[order]
+
+    def query(
+        self, chromosome_ids: np.ndarray, chromstarts: np.ndarray, chromends: np.ndarray
+    ) -> Tuple[np.ndarray, list]:
+        """
+        Same as MemoryIndex.overlap, but returns the selected rows of the overlapping
+        intervals instead of their index.
+        """
+        windows, intervals = self.overlap(chromosome_ids, chromstarts, chromends)
+        return windows, self.payload[intervals].tolist()
+
+
+class SharedArray:
+    """
+    A (small) numpy array in shared memory, that pickled copies (e.g. in DataLoader
+    workers) attach to instead of copying. The shared memory is released when the
+    SharedArray that made it is garbage collected.
+    """
+
+    def __init__(self, array: np.ndarray):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array: np.ndarray = np.ndarray(
+            array.shape, dtype=array.dtype, buffer=self.shm.buf
+        )
+        self.array[...] = array
+        weakref.finalize(self, _unlink, self.shm, os.getpid())
+
+    def __getstate__(self) -> dict:
+        return {
+            "name": self.shm.name,
+            "shape": self.array.shape,
+            "dtype": self.array.dtype.str,
+        }
+
+    def __setstate__(self, state: dict):
+        self.shm = _attach(state["name"])
+        self.array = np.ndarray(
+            state["shape"], dtype=state["dtype"], buffer=self.shm.buf
+        )
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to existing shared memory, without tracking it in this process.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # type: ignore
+    except TypeError:  # python < 3.13
+        # processes started by multiprocessing share the resource tracker of their
+        # parent, which already tracks the shared memory
+        return shared_memory.SharedMemory(name)
+
+
+def _unlink(shm: shared_memory.SharedMemory, pid: int):
+    """
+    Release shared memory, but only from the process that made it (and not from its
+    forks).
+    """
+    if os.getpid() == pid:
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:  # still in use, closed once all its arrays are gone
+            pass
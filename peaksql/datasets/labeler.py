@@ -15,19 +15,20 @@ class _Labeler:
             "none",
         ]
 
+        self.label_func = kwargs["label_func"]
         self.inner_range = kwargs.get("inner_range", self.seq_length)
         self.ratio = kwargs.get("ratio", 1.0)
 
         setattr(self, "label_from_array", eval("self." + kwargs["label_func"]))
 
     def any(self, positions: np.ndarray) -> np.ndarray:
-        return np.any(positions, axis=1)
+        return np.any(positions, axis=-1)
 
     def all(self, positions: np.ndarray) -> np.ndarray:
-        return np.all(positions, axis=1)
+        return np.all(positions, axis=-1)
 
     def fraction(self, positions: np.ndarray) -> np.ndarray:
-        return np.sum(positions, axis=1) / positions.shape[1] >= self.ratio
+        return np.sum(positions, axis=-1) / positions.shape[-1] >= self.ratio
 
     def none(self, position: np.ndarray) -> np.ndarray:
         return position
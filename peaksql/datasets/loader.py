@@ -0,0 +1,119 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterator, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+from .base import _DataSet
+
+
+class Sampler(Protocol):
+    """
+    The indices of the samples to load, in order, e.g. a list or a BlockShuffleSampler.
+    """
+
+    def __len__(self) -> int:
+        ...
+
+    def __iter__(self) -> Iterator[int]:
+        ...
+
+
+class BatchLoader:
+    """
+    Iterates over (sequences, labels) batches of a dataset, with a pool of threads that
+    prepare the next batches in the background.
+
+    This is an alternative to a PyTorch DataLoader with worker processes: all threads
+    share the dataset (and e.g. its memory index and cached labels) of a single
+    process, and only have their own database handle. The sqlite queries, the fasta
+    reads and the (numba) encoding and rasterising release the GIL, so the threads can
+    overlap their I/O and most of their compute.
+
+    The batches are yielded in order, as numpy arrays. At most prefetch batches are
+    prepared (or ready) at any time, which bounds the memory the batches take.
+    """
+
+    def __init__(
+        self,
+        dataset: _DataSet,
+        batch_size: int = 64,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        sampler: Optional[Sampler] = None,
+        num_threads: int = 4,
+        prefetch: int = 8,
+    ):
+        """
+        :param dataset: the dataset to get the batches of.
+        :param batch_size: the number of samples per batch.
+        :param shuffle: whether to shuffle the samples each iteration (default: False).
+        :param drop_last: whether to drop the last batch when it is smaller than
+            batch_size (default: False).
+        :param sampler: the indices of the samples, in order (optional: replaces
+            shuffle).
+        :param num_threads: the number of threads that prepare batches.
+        :param prefetch: the maximum number of batches that are prepared ahead.
+        """
+        if batch_size <= 0 or num_threads <= 0 or prefetch <= 0:
+            raise ValueError("batch_size, num_threads and prefetch should be positive")
+        if shuffle and sampler is not None:
+            raise ValueError("choose either shuffle or a sampler")
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.num_threads = num_threads
+        self.prefetch = prefetch
+
+    def __len__(self) -> int:
+        """
+        Return the number of batches per iteration.
+        """
+        nr_samples = (
+            len(self.sampler) if self.sampler is not None else len(self.dataset)
+        )
+        if self.drop_last:
+            return nr_samples // self.batch_size
+        return -(-nr_samples // self.batch_size)
+
+    def _batches(self) -> Iterator[List[int]]:
+        """
+        Split the indices of an iteration into batches.
+        """
+        if self.sampler is not None:
+            indices = iter(self.sampler)
+        elif self.shuffle:
+            indices = iter(np.random.permutation(len(self.dataset)).tolist())
+        else:
+            indices = iter(range(len(self.dataset)))
+
+        while True:
+            batch = [index for _, index in zip(range(self.batch_size), indices)]
+            if not batch or (self.drop_last and len(batch) < self.batch_size):
+                return
+            yield batch
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        batches = self._batches()
+        pending: Deque[Future] = deque()
+        executor = ThreadPoolExecutor(self.num_threads, "peaksql-loader")
+        try:
+            while True:
+                # keep the queue of batches that are prepared ahead full
+                while len(pending) < self.prefetch:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pending.append(executor.submit(self.dataset.get_batch, batch))
+
+                if not pending:
+                    return
+                yield pending.popleft().result()
+        finally:
+            # stopping early (or an error) cancels the batches that did not start yet
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -1,5 +1,5 @@
 import numpy as np
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 from .base import _DataSet
 
@@ -9,18 +9,12 @@ class NarrowPeakDataSet(_DataSet):
     The NarrowPeakDataSet expects that narrowPeak files have been added to the DataBase.
     """
 
-    SELECT_LABEL = (
-        " Bed.ChromosomeId, Bed.ConditionId, BedVirtual_{assembly}.ChromStart, Bed.Peak"
-    )
+    DTYPE = bool
+    SELECT_LABEL = " {table}.ConditionId, {table}.ChromStart, {table}.Peak"
 
-    def array_from_query(
-        self, query: List[Tuple[int, int, int]], chromstart: int, chromend: int,
-    ) -> np.ndarray:
-        positions = np.zeros((len(self.all_conditions), self.inner_range), dtype=bool)
-
-        for condition_id, start, peak in query:
-            peak_idx = int(start - chromstart + peak)
-            if 0 <= peak_idx < positions.shape[1]:
-                positions[condition_id, peak_idx] = True
-
-        return positions
+    def intervals_from_query(
+        self, query: Union[np.ndarray, List[Tuple[int, int, int]]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        rows = np.asarray(query, dtype=np.int64).reshape(len(query), 3)
+        condition_ids, starts, peaks = rows.T
+        return condition_ids, starts + peaks, starts + peaks + 1, np.ones(len(query))
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+from typing import Dict, Optional, Union
+
+from ..database import DataBase
+
+
+class HandlePool:
+    """
+    Pool of read-only DataBase handles (sql(ite) connection and fasta/genome handles).
+
+    PyFaidx and sql(ite) cursors are not safe to use from multiple processes or threads
+    at the same time, so each thread of each process gets its own handle. Handles are
+    opened lazily, so a pool can be pickled (or forked) into e.g. PyTorch DataLoader
+    workers without copying any open handles, and each worker opens its own on first
+    use. Handles of threads that have finished are reused by new threads, so the
+    number of handles is bounded by the number of live threads that use the pool.
+
+    With in_memory="shared" the database is copied into shared memory (/dev/shm) once,
+    and all the handles of all the processes memory-map that same copy read-only,
+    instead of each loading their own copy into memory.
+    """
+
+    def __init__(self, database_path: str, in_memory: Union[bool, str] = False):
+        """
+        :param database_path: the path to the (pre-existing) database.
+        :param in_memory: whether to load the database into memory for each handle
+            (True), or once in shared memory for all handles ("shared").
+        """
+        if in_memory not in [True, False, "shared"]:
+            raise ValueError("in_memory should be either True, False or 'shared'")
+
+        self.database_path = database_path
+        self.in_memory = in_memory
+        self.shared_path: Optional[str] = None
+        if in_memory == "shared":
+            self.shared_path = self._share()
+        self._reset()
+
+    def _share(self) -> str:
+        """
+        Copy the database into shared memory, the copy is removed when the pool that
+        made it is garbage collected.
+        """
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        fd, shared_path = tempfile.mkstemp(".sqlite", "peaksql-", dir=directory)
+        os.close(fd)
+
+        source = sqlite3.connect(self.database_path)
+        dest = sqlite3.connect(shared_path)
+        source.backup(dest)
+        dest.execute("PRAGMA journal_mode=DELETE")
+        source.close()
+        dest.close()
+
+        weakref.finalize(self, _remove, shared_path, os.getpid())
+        return shared_path
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.handles: Dict[int, DataBase] = dict()
+
+    def __getstate__(self) -> dict:
+        """
+        Only pickle the settings of the pool, never the open handles.
+        """
+        return {
+            "database_path": self.database_path,
+            "in_memory": self.in_memory,
+            "shared_path": self.shared_path,
+        }
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._reset()
+
+    def __len__(self) -> int:
+        """
+        Return the number of open handles of this process.
+        """
+        return len(self.handles)
+
+    def get(self) -> DataBase:
+        """
+        Get the handle of the current thread, and open one if it does not exist yet.
+        """
+        # after a fork the handles belong to the parent process, leave them alone
+        if os.getpid() != self.pid:
+            self._reset()
+
+        thread = threading.get_ident()
+        handle = self.handles.get(thread)
+        if handle is None:
+            with self.lock:
+                handle = self._reclaim() or self._open()
+                self.handles[thread] = handle
+
+        return handle
+
+    def _open(self) -> DataBase:
+        """
+        Open a new (read-only) handle.
+        """
+        if self.shared_path:
+            return DataBase(
+                self.shared_path,
+                read_only=True,
+                mmap_size=os.path.getsize(self.shared_path),
+            )
+        return DataBase(
+            self.database_path, in_memory=self.in_memory is True, read_only=True
+        )
+
+    def _reclaim(self) -> Optional[DataBase]:
+        """
+        Take the handle of a thread that has finished, if there is one.
+        """
+        alive = {thread.ident for thread in threading.enumerate()}
+        for thread in list(self.handles):
+            if thread not in alive:
+                return self.handles.pop(thread)
+        return None
+
+    def close(self):
+        """
+        Close all the handles of this process.
+        """
+        with self.lock:
+            if os.getpid() == self.pid:
+                for handle in self.handles.values():
+                    handle.close()
+            self.handles.clear()
+
+
+def _remove(path: str, pid: int):
+    """
+    Remove a file, but only from the process that made it (and not from its forks).
+    """
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
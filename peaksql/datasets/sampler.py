@@ -0,0 +1,54 @@
+from typing import Iterator
+
+import numpy as np
+
+from .base import _DataSet
+
+
+class BlockShuffleSampler:
+    """
+    Shuffles the indices of a dataset in blocks of consecutive indices, which are
+    neighbouring windows on the genome.
+
+    The order of the blocks is shuffled, after which the indices of each group of
+    buffer consecutive (shuffled) blocks are shuffled together. So each batch is a
+    random mix of windows of a few regions of the genome, instead of windows from all
+    over the genome, which keeps the reads of the fasta (or packed genome), the r*tree
+    pages and the sequence block cache local. A larger buffer gives more random
+    batches, a buffer of one block gives the windows of a block in a random order.
+
+    Can be used as the sampler of a PyTorch DataLoader or a BatchLoader.
+    """
+
+    def __init__(
+        self, dataset: _DataSet, block_size: int = 1024, buffer: int = 8, seed=None
+    ):
+        """
+        :param dataset: the dataset to sample the indices of.
+        :param block_size: the number of consecutive indices per block.
+        :param buffer: the number of blocks whose indices are shuffled together.
+        :param seed: the seed of the shuffling (optional).
+        """
+        if block_size <= 0 or buffer <= 0:
+            raise ValueError("block_size and buffer should be positive")
+
+        self.nr_indices = len(dataset)
+        self.block_size = block_size
+        self.buffer = buffer
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return self.nr_indices
+
+    def __iter__(self) -> Iterator[int]:
+        nr_blocks = -(-self.nr_indices // self.block_size)
+        blocks = self.rng.permutation(nr_blocks)
+        for lower in range(0, nr_blocks, self.buffer):
+            starts = blocks[lower : lower + self.buffer] * self.block_size
+            indices = np.concatenate(
+                [
+                    np.arange(start, min(start + self.block_size, self.nr_indices))
+                    for start in starts
+                ]
+            )
+            yield from self.rng.permutation(indices).tolist()
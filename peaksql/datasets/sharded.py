@@ -0,0 +1,244 @@
+import json
+import multiprocessing
+import os
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import peaksql.util as util
+
+if TYPE_CHECKING:  # base imports this module
+    from .base import _DataSet
+
+# the ways the sequences can be exported: one-hot encoded (bool), or as (uint8) bases
+FORMATS = ["onehot", "bases"]
+
+# the dataset that is exported by the processes of a pool
+_dataset: Optional["_DataSet"] = None
+
+
+def export(
+    dataset: "_DataSet",
+    path: str,
+    shard_size: int,
+    format: str,
+    num_workers: int,
+    batch_size: int,
+) -> str:
+    """
+    Export all the samples of a dataset to shards in a directory (see _DataSet.export).
+    """
+    if format not in FORMATS:
+        raise ValueError(f"format should be one of {', '.join(FORMATS)}")
+    if shard_size <= 0:
+        raise ValueError("shard_size should be positive")
+
+    os.makedirs(path, exist_ok=True)
+    shards = list(range(-(-len(dataset) // shard_size)))
+    args = [(path, shard, shard_size, format, batch_size) for shard in shards]
+    if num_workers > 1:
+        with multiprocessing.Pool(
+            num_workers, initializer=_init_worker, initargs=(dataset,)
+        ) as pool:
+            label_shapes = pool.starmap(_export_shard, args)
+    else:
+        _init_worker(dataset)
+        try:
+            label_shapes = [_export_shard(*arg) for arg in args]
+        finally:
+            _init_worker(None)
+
+    # the metadata is written last, so a directory with metadata is complete
+    label_shape, label_dtype = label_shapes[0] if label_shapes else ([], "|b1")
+    meta = {
+        "length": len(dataset),
+        "shard_size": shard_size,
+        "nr_shards": len(shards),
+        "format": format,
+        "seq_length": dataset.seq_length,
+        "label_shape": label_shape,
+        "label_dtype": label_dtype,
+        "conditions": list(dataset.conditions),
+        "dataset": type(dataset).__name__,
+    }
+    with open(os.path.join(path, f"meta.json.{os.getpid()}.tmp"), "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(
+        os.path.join(path, f"meta.json.{os.getpid()}.tmp"),
+        os.path.join(path, "meta.json"),
+    )
+    return path
+
+
+def _init_worker(dataset: Optional["_DataSet"]):
+    global _dataset
+    _dataset = dataset
+
+
+def _export_shard(
+    path: str, shard: int, shard_size: int, format: str, batch_size: int
+) -> Tuple[list, str]:
+    """
+    Write the sequences and labels of a shard as .npy files, and return the shape (of
+    a single sample) and dtype of the labels.
+    """
+    dataset = _dataset
+    assert dataset is not None, "the dataset of the worker is not set"
+    lower, upper = shard * shard_size, min((shard + 1) * shard_size, len(dataset))
+    shape: Tuple[int, ...]
+    dtype: type
+    if format == "onehot":
+        shape, dtype = (upper - lower, dataset.seq_length, 4), bool
+    else:
+        shape, dtype = (upper - lower, dataset.seq_length), np.uint8
+    sequences_path, labels_path = _shard_paths(path, shard)
+    sequences = np.lib.format.open_memmap(
+        f"{sequences_path}.{os.getpid()}.tmp", mode="w+", dtype=dtype, shape=shape
+    )
+
+    labels: Optional[np.memmap] = None
+    for start in range(lower, upper, batch_size):
+        indices = np.arange(start, min(start + batch_size, upper))
+        sites = dataset._sites(indices)
+        for site, out in zip(sites, sequences[start - lower :]):
+            if format == "onehot":
+                dataset.get_onehot_sequence(*site, out=out)
+            else:
+                out[:] = util._to_uint8(dataset._database.get_sequence(*site))
+
+        if dataset.labels is not None:
+            batch = dataset._unpack_labels(dataset.labels[indices])
+        else:
+            batch = dataset.get_labels(sites)
+        if labels is None:
+            labels = np.lib.format.open_memmap(
+                f"{labels_path}.{os.getpid()}.tmp",
+                mode="w+",
+                dtype=batch.dtype,
+                shape=(upper - lower,) + batch.shape[1:],
+            )
+        labels[start - lower : start - lower + len(batch)] = batch
+
+    # write to temporary files first, so other processes never read a partially
+    # written shard
+    assert labels is not None, "a shard has at least one sample"
+    label_shape, label_dtype = list(labels.shape[1:]), labels.dtype.str
+    sequences.flush()
+    labels.flush()
+    del sequences, labels
+    for array_path in [sequences_path, labels_path]:
+        os.replace(f"{array_path}.{os.getpid()}.tmp", array_path)
+    return label_shape, label_dtype
+
+
+def _shard_paths(path: str, shard: int) -> Tuple[str, str]:
+    return (
+        os.path.join(path, f"sequences.{shard:06d}.npy"),
+        os.path.join(path, f"labels.{shard:06d}.npy"),
+    )
+
+
+class ShardedDataSet:
+    """
+    Serves the samples of a dataset that was exported with DataSet.export, from
+    memory-mapped shards. The samples are (read-only) views on the shards, so getting
+    a sample copies nothing.
+
+    The ShardedDataSet does not need the database (or the fasta files) of the dataset
+    it was exported from, and can be used in the same way as that dataset, e.g. with a
+    PyTorch DataLoader.
+    """
+
+    def __init__(self, path: str, onehot: bool = True):
+        """
+        :param path: the directory the dataset was exported to.
+        :param onehot: whether to one-hot encode sequences that were exported as bases
+            (default: True). Sequences that were exported one-hot encoded are always
+            served one-hot encoded.
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if not onehot and self.meta["format"] == "onehot":
+            raise ValueError("The sequences were exported one-hot encoded")
+
+        self.path = path
+        self.onehot = onehot
+        self.shard_size = self.meta["shard_size"]
+        self.seq_length = self.meta["seq_length"]
+        self.conditions = self.meta["conditions"]
+        self.shards: Dict[int, Tuple[np.ndarray, np.ndarray]] = dict()
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle without the memory-mapped shards, they are mapped again on first use.
+        """
+        state = self.__dict__.copy()
+        state["shards"] = dict()
+        return state
+
+    def __len__(self) -> int:
+        return self.meta["length"]
+
+    def _shard(self, shard: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the (memory-mapped) sequences and labels of a shard.
+        """
+        if shard not in self.shards:
+            sequences_path, labels_path = _shard_paths(self.path, shard)
+            self.shards[shard] = (
+                np.load(sequences_path, mmap_mode="r"),
+                np.load(labels_path, mmap_mode="r"),
+            )
+        return self.shards[shard]
+
+    def _encode(self, sequences: np.ndarray) -> np.ndarray:
+        if self.onehot and self.meta["format"] == "bases":
+            return util.sequences_to_onehot(sequences.reshape(-1, self.seq_length))
+        return sequences
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the sequence and the label of an index.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("Index out of range")
+
+        sequences, labels = self._shard(index // self.shard_size)
+        sequence = sequences[index % self.shard_size]
+        if self.onehot and self.meta["format"] == "bases":
+            sequence = util.sequence_to_onehot(sequence)
+        return sequence, labels[index % self.shard_size]
+
+    def __getitems__(self, indices: List[int]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Return the sequences and labels of a batch of indices.
+        """
+        seqs, labels = self.get_batch(indices)
+        return list(zip(seqs, labels))
+
+    def get_batch(self, indices: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the sequences and labels of a batch of indices as two arrays. A batch
+        of consecutive indices within a shard is a view on the shard.
+        """
+        array = np.asarray(indices, dtype=np.int64)
+        if len(array) and (array.min() < 0 or array.max() >= len(self)):
+            raise IndexError("Index out of range")
+
+        shards = array // self.shard_size
+        if len(array) and np.all(np.diff(array) == 1) and shards[0] == shards[-1]:
+            sequences, labels = self._shard(int(shards[0]))
+            window = slice(
+                int(array[0] % self.shard_size), int(array[-1] % self.shard_size) + 1
+            )
+            return self._encode(sequences[window]), labels[window]
+
+        batch = [self._shard(int(shard)) for shard in shards]
+        offsets = (array % self.shard_size).tolist()
+        sequences = np.stack(
+            [sequences[offset] for (sequences, _), offset in zip(batch, offsets)]
+        )
+        labels = np.stack(
+            [labels[offset] for (_, labels), offset in zip(batch, offsets)]
+        )
+        return self._encode(sequences), labels
@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+import weakref
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from .index import _attach, _unlink
+
+
+class Stats:
+    """
+    Per-stage timing and counters of a dataset, enabled with DataSet(..., stats=True).
+
+    Each stage keeps its cumulative time (in nanoseconds), its number of calls and a
+    histogram of the duration of the calls, where bucket b counts the calls that took
+    between 2 ** (b - 1) and 2 ** b nanoseconds. Next to that there are counters, e.g.
+    the number of rows the label queries return.
+
+    The numbers are kept in shared memory, with a slot per process: the main process
+    uses slot 0, and PyTorch DataLoader workers use slot worker id + 1. So the workers
+    never write to the same numbers, and the numbers of all the workers can be read
+    (and aggregated) from the main process with Stats.report. Workers beyond the number
+    of slots share a slot.
+
+    Stages are timed as laps: Stats.start marks the start of a method, and each
+    Stats.lap records the time since the previous mark (of the same thread) under a
+    stage.
+    """
+
+    STAGES = [
+        "index_to_site",
+        "sequence",
+        "onehot",
+        "query",
+        "array_from_query",
+        "label_from_array",
+    ]
+    COUNTERS = [
+        "queries",
+        "rows",
+        "label_cache_hits",
+        "label_cache_misses",
+        "sequence_cache_hits",
+        "sequence_cache_misses",
+    ]
+    BUCKETS = 40
+
+    # the cumulative nanoseconds and calls per slot and stage, the histogram of the
+    # durations per slot and stage, and the counters per slot (in shared memory)
+    ns: np.ndarray
+    calls: np.ndarray
+    histogram: np.ndarray
+    counts: np.ndarray
+    # the slot of this process, claimed on first use
+    slot: Optional[int]
+
+    def __init__(self, slots: int = 65):
+        """
+        :param slots: the number of processes (the main process and its workers) that
+            each get their own numbers.
+        """
+        self.slots = slots
+        self.shared: Dict[str, shared_memory.SharedMemory] = dict()
+        self.stages = {stage: i for i, stage in enumerate(self.STAGES)}
+        self.counters = {counter: i for i, counter in enumerate(self.COUNTERS)}
+        for name, shape in self._shapes().items():
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+            np.ndarray(shape, dtype=np.int64, buffer=shm.buf)[...] = 0
+            self.shared[name] = shm
+            weakref.finalize(self, _unlink, shm, os.getpid())
+        self._map()
+        self._reset()
+
+    def _shapes(self) -> Dict[str, tuple]:
+        return {
+            "ns": (self.slots, len(self.STAGES)),
+            "calls": (self.slots, len(self.STAGES)),
+            "histogram": (self.slots, len(self.STAGES), self.BUCKETS),
+            "counts": (self.slots, len(self.COUNTERS)),
+        }
+
+    def _map(self):
+        """
+        Make the arrays of the numbers on their shared memory.
+        """
+        shapes = self._shapes()
+
+        def array(name: str) -> np.ndarray:
+            return np.ndarray(
+                shapes[name], dtype=np.int64, buffer=self.shared[name].buf
+            )
+
+        self.ns = array("ns")
+        self.calls = array("calls")
+        self.histogram = array("histogram")
+        self.counts = array("counts")
+
+    def _reset(self):
+        """
+        Forget the slot and the laps, e.g. after a fork.
+        """
+        self.pid = os.getpid()
+        self.slot = None
+        self.local = threading.local()
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle the numbers as a reference to their shared memory.
+        """
+        state = self.__dict__.copy()
+        for name in self._shapes():
+            state.pop(name)
+        state["shared"] = {name: shm.name for name, shm in self.shared.items()}
+        del state["local"]
+        return state
+
+    def __setstate__(self, state: dict):
+        shared = state.pop("shared")
+        self.__dict__.update(state)
+        self.shared = {name: _attach(shared[name]) for name in self._shapes()}
+        self._map()
+        self._reset()
+
+    def _claim(self) -> int:
+        """
+        Get the slot of the current process.
+        """
+        if os.getpid() != self.pid:
+            self._reset()
+        if self.slot is None:
+            self.slot = 0
+            try:
+                from torch.utils.data import get_worker_info
+            except ImportError:
+                pass
+            else:
+                info = get_worker_info()
+                if info is not None:
+                    self.slot = 1 + info.id % (self.slots - 1)
+        return self.slot
+
+    def start(self):
+        """
+        Mark the start of the laps of the current thread.
+        """
+        self.local.last = time.perf_counter_ns()
+
+    def lap(self, stage: str):
+        """
+        Record the time since the previous mark (of the current thread) under a stage.
+        """
+        now = time.perf_counter_ns()
+        ns = now - self.local.last
+        self.local.last = now
+
+        slot, index = self._claim(), self.stages[stage]
+        self.ns[slot, index] += ns
+        self.calls[slot, index] += 1
+        self.histogram[slot, index, min(ns.bit_length(), self.BUCKETS - 1)] += 1
+
+    def count(self, counter: str, value: int = 1):
+        """
+        Add a value to a counter.
+        """
+        self.counts[self._claim(), self.counters[counter]] += value
+
+    def reset(self):
+        """
+        Set all the numbers (of all the processes) back to zero.
+        """
+        for array in [self.ns, self.calls, self.histogram, self.counts]:
+            array[...] = 0
+
+    def report(self, slot: Optional[int] = None) -> dict:
+        """
+        Summarise the numbers of a single slot, or of all slots together (default).
+
+        :return: a dictionary with per stage the number of calls, the total seconds,
+            the mean nanoseconds per call and the (non-empty) buckets of the histogram
+            as [upper bound in nanoseconds, calls] pairs, the counters, the mean number
+            of rows per query, and the hit rates of the precomputed labels and of the
+            sequence block cache.
+        """
+        select = slice(None) if slot is None else slice(slot, slot + 1)
+        ns = self.ns[select].sum(axis=0)
+        calls = self.calls[select].sum(axis=0)
+        histogram = self.histogram[select].sum(axis=0)
+        counts = dict(zip(self.COUNTERS, self.counts[select].sum(axis=0).tolist()))
+
+        stages = dict()
+        for i, stage in enumerate(self.STAGES):
+            stages[stage] = {
+                "calls": int(calls[i]),
+                "seconds": int(ns[i]) / 1e9,
+                "mean_ns": int(ns[i]) / max(int(calls[i]), 1),
+                "histogram": [
+                    [2 ** int(bucket), int(histogram[i, bucket])]
+                    for bucket in np.flatnonzero(histogram[i])
+                ],
+            }
+
+        report = {
+            "stages": stages,
+            "counters": counts,
+            "rows_per_query": counts["rows"] / max(counts["queries"], 1),
+        }
+        for cache in ["label_cache", "sequence_cache"]:
+            hits, misses = counts[f"{cache}_hits"], counts[f"{cache}_misses"]
+            report[f"{cache}_hit_rate"] = hits / max(hits + misses, 1)
+        return report
+
+    def workers(self) -> Dict[Union[str, int], dict]:
+        """
+        The report of each slot that was used: "main" for the main process, and the
+        worker id for each DataLoader worker.
+        """
+        used: List[int] = np.flatnonzero(
+            self.calls.sum(axis=1) + self.counts.sum(axis=1)
+        ).tolist()
+        return {"main" if slot == 0 else slot - 1: self.report(slot) for slot in used}
@@ -0,0 +1,37 @@
+"""
+Packed (binary) genome files, which can be memory-mapped as uint8 arrays.
+
+A packed genome is the concatenation of all the sequences of a fasta file, in the same
+order as the fasta, stored as one byte (ascii code) per nucleotide. Newlines and
+headers are stripped, but soft-masking and IUPAC codes are kept as is, so slicing a
+packed genome gives the exact same sequence as pyfaidx does.
+"""
+import numpy as np
+import pyfaidx
+
+
+def pack_fasta(fasta: pyfaidx.Fasta, path: str, chunk_size: int = 2 ** 24) -> int:
+    """
+    Write all the sequences of a fasta to a packed genome file.
+
+    :param fasta: the (pyfaidx) fasta to pack.
+    :param path: the path of the packed genome file.
+    :param chunk_size: the number of nucleotides to read from the fasta at once.
+    :return: the size of the packed genome.
+    """
+    size = 0
+    with open(path, "wb") as f:
+        for sequence in fasta.values():
+            for start in range(0, len(sequence), chunk_size):
+                f.write(sequence[start : start + chunk_size].seq.encode("ascii"))
+            size += len(sequence)
+
+    return size
+
+
+def load_packed(path: str) -> np.ndarray:
+    """
+    Memory-map a packed genome file (read-only). Slices of the returned array are views
+    on the file, so processes that read the same genome share the same page cache.
+    """
+    return np.memmap(path, dtype=np.uint8, mode="r")
@@ -0,0 +1,253 @@
+"""
+Chunked, compressed signal tracks (e.g. of bedgraph files), stored in the Signal table.
+
+The signal of a condition on a chromosome is binned with a fixed bin size, where the
+value of a bin is the mean signal over the bin. Consecutive bins are grouped in chunks
+of a fixed number of bins, and each chunk is stored run-length encoded and compressed.
+Next to the signal itself zoom levels are stored, where each zoom level has bins that
+are four times as large as the previous level.
+
+Since the value of a bin is a sum (divided by the bin size), partially filled chunks
+can be merged by adding them up. This means that files do not have to be sorted, and
+that a chunk can be written before all of its data has been read.
+"""
+import sqlite3
+import zlib
+from typing import AbstractSet, Dict, Iterator, Set, Tuple
+
+import numba
+import numpy as np
+
+import peaksql.util as util
+
+# each zoom level has bins that are ZOOM_FACTOR times larger than the previous level
+ZOOM_FACTOR = 4
+
+# the number of bins per chunk
+CHUNK_SIZE = 2 ** 12
+
+# the maximum number of chunks that is read with a single query, stays below the
+# default limit of 999 variables per statement of sqlite before 3.32
+MAX_CHUNKS_PER_QUERY = 900
+
+
+def zoom_bin_size(bin_size: int, zoom: int) -> int:
+    """
+    The bin size of a zoom level.
+    """
+    return bin_size * ZOOM_FACTOR ** zoom
+
+
+def encode(values: np.ndarray) -> bytes:
+    """
+    Run-length encode and compress the (float32) values of a chunk.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    starts = np.flatnonzero(
+        np.concatenate(
+            [[True], values[1:].view(np.int32) != values[:-1].view(np.int32)]
+        )
+    )
+    lengths = np.diff(np.append(starts, len(values))).astype(np.int32)
+    return zlib.compress(
+        np.int32(len(starts)).tobytes() + lengths.tobytes() + values[starts].tobytes()
+    )
+
+
+def decode(data: bytes) -> np.ndarray:
+    """
+    Decode a chunk encoded with signal.encode back to its (float32) values.
+    """
+    data = zlib.decompress(data)
+    nr_runs = int(np.frombuffer(data, dtype=np.int32, count=1)[0])
+    lengths = np.frombuffer(data, dtype=np.int32, count=nr_runs, offset=4)
+    values = np.frombuffer(
+        data, dtype=np.float32, count=nr_runs, offset=4 + 4 * nr_runs
+    )
+    return np.repeat(values, lengths)
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _bin_intervals(
+    slots: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    values: np.ndarray,
+    bin_size: int,
+    out: np.ndarray,
+) -> None:
+    for i in range(len(slots)):
+        start, end = starts[i], ends[i]
+        idx = start // bin_size
+        while start < end:
+            bin_end = min((idx + 1) * bin_size, end)
+            out[slots[i], idx] += values[i] * (bin_end - start)
+            start = bin_end
+            idx += 1
+
+
+def bin_intervals(
+    chrom_ids: np.ndarray,
+    chromstarts: np.ndarray,
+    chromends: np.ndarray,
+    values: np.ndarray,
+    bin_size: int,
+    chunk_size: int,
+) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Bin intervals (with chromosome coordinates) into the chunks they overlap with.
+
+    Returns a dictionary of (chromosome id, chunk) to an array with the summed signal
+    (value * overlap) of each bin of the chunk. Divide by the bin size for the mean.
+    """
+    chrom_ids = np.asarray(chrom_ids, dtype=np.int64)
+    chromstarts = np.asarray(chromstarts, dtype=np.int64)
+    chromends = np.asarray(chromends, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+
+    # intervals without signal do not contribute
+    keep = (values != 0) & ~np.isnan(values) & (chromends > chromstarts)
+    chrom_ids, chromstarts, chromends, values = (
+        chrom_ids[keep],
+        chromstarts[keep],
+        chromends[keep],
+        values[keep],
+    )
+
+    # split the intervals at the chunk boundaries
+    chunk_length = bin_size * chunk_size
+    first, last = chromstarts // chunk_length, (chromends - 1) // chunk_length
+    counts = last - first + 1
+    pieces = np.repeat(np.arange(len(counts)), counts)
+    chunks = util.expand_ranges(first, counts)
+    starts = (
+        np.maximum(chromstarts[pieces], chunks * chunk_length) - chunks * chunk_length
+    )
+    ends = (
+        np.minimum(chromends[pieces], (chunks + 1) * chunk_length)
+        - chunks * chunk_length
+    )
+
+    keys, slots = np.unique(
+        np.stack([chrom_ids[pieces], chunks], axis=1), axis=0, return_inverse=True
+    )
+    out = np.zeros((len(keys), chunk_size), dtype=np.float64)
+    _bin_intervals(slots.reshape(-1), starts, ends, values[pieces], bin_size, out)
+
+    return {
+        (int(chrom_id), int(chunk)): sums for (chrom_id, chunk), sums in zip(keys, out)
+    }
+
+
+class SignalWriter:
+    """
+    Bins the intervals of (bedgraph) files into chunks, and writes the chunks to the
+    Signal table.
+
+    Chunks are kept in memory as long as new intervals are added to them. Chunks that
+    were not touched by the last added intervals are written to the database, since for
+    sorted files they are complete. Chunks that are already in the database are merged
+    with the new signal, so unsorted files result in the same signal.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+        self.tracks: Dict[int, Tuple[int, int, int]] = dict()
+        self.pending: Dict[Tuple[int, int, int, int], np.ndarray] = dict()
+
+    def add_track(self, condition_id: int, bin_size: int, zooms: int):
+        """
+        Register the track of a condition. The signal of the files of a condition is
+        summed, which is only valid for files added by the same writer (i.e. the same
+        DataBase.add_data_many call), so a condition that already has a track in the
+        database raises an error instead of adding to (e.g. doubling) its signal.
+        """
+        if condition_id in self.tracks:
+            return
+
+        existing = self.cursor.execute(
+            "SELECT 1 FROM Track WHERE ConditionId = ?", (condition_id,)
+        ).fetchone()
+        if existing is not None:
+            raise ValueError(
+                f"The signal of condition id {condition_id} is already stored, add all "
+                f"the bedgraph files of a condition in a single add_data(_many) call"
+            )
+        track = (bin_size, CHUNK_SIZE, zooms)
+        self.cursor.execute(
+            "INSERT INTO Track VALUES(?, ?, ?, ?)", (condition_id, *track)
+        )
+        self.tracks[condition_id] = track
+
+    def add(
+        self,
+        condition_id: int,
+        chrom_ids: np.ndarray,
+        chromstarts: np.ndarray,
+        chromends: np.ndarray,
+        values: np.ndarray,
+    ):
+        """
+        Add the intervals (chromosome coordinates) of a condition with a track.
+        """
+        bin_size, chunk_size, zooms = self.tracks[condition_id]
+        touched: Set[Tuple[int, int, int, int]] = set()
+        for zoom in range(zooms + 1):
+            chunks = bin_intervals(
+                chrom_ids,
+                chromstarts,
+                chromends,
+                values,
+                zoom_bin_size(bin_size, zoom),
+                chunk_size,
+            )
+            for (chrom_id, chunk), sums in chunks.items():
+                key = (condition_id, chrom_id, zoom, chunk)
+                if key in self.pending:
+                    self.pending[key] += sums
+                else:
+                    self.pending[key] = sums
+                touched.add(key)
+
+        self.flush(keep=touched)
+
+    def flush(self, keep: AbstractSet[Tuple[int, int, int, int]] = frozenset()):
+        """
+        Write all pending chunks, except those in keep, to the database.
+        """
+        for key in [key for key in self.pending if key not in keep]:
+            sums = self.pending.pop(key)
+            condition_id, chrom_id, zoom, chunk = key
+            bin_size = zoom_bin_size(self.tracks[condition_id][0], zoom)
+
+            existing = self.cursor.execute(
+                "SELECT Data FROM Signal WHERE ConditionId = ? AND ChromosomeId = ? "
+                "AND Zoom = ? AND Chunk = ?",
+                key,
+            ).fetchone()
+            if existing is not None:
+                sums += decode(existing[0]) * bin_size
+
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO Signal VALUES(?, ?, ?, ?, ?)",
+                (*key, encode(sums / bin_size)),
+            )
+
+
+def read_chunks(
+    cursor: sqlite3.Cursor, condition_id: int, chrom_id: int, zoom: int, chunks: list
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Read and decode (chunk, values) pairs of a track. Chunks without signal are not
+    stored, and thus not returned.
+    """
+    chunks = [int(chunk) for chunk in chunks]
+    for lower in range(0, len(chunks), MAX_CHUNKS_PER_QUERY):
+        batch = chunks[lower : lower + MAX_CHUNKS_PER_QUERY]
+        query = (
+            "SELECT Chunk, Data FROM Signal WHERE ConditionId = ? AND ChromosomeId = ? "
+            f"AND Zoom = ? AND Chunk IN ({', '.join('?' * len(batch))})"
+        )
+        parameters = (int(condition_id), int(chrom_id), int(zoom), *batch)
+        for chunk, data in cursor.execute(query, parameters):
+            yield chunk, decode(data)
@@ -8,7 +8,9 @@ ASS = (
     "    Assembly TEXT NOT NULL,"
     "    Species,"
     "    Size INT NOT NULL,"
-    "    AbsPath TEXT UNIQUE NOT NULL"
+    "    AbsPath TEXT UNIQUE NOT NULL,"
+    "    PackedPath TEXT,"  # optional memory-mappable copy of the assembly
+    "    PartitionBy TEXT"  # how the r*tree of the assembly is partitioned
     ")"
 )
 
@@ -45,6 +47,44 @@ BED = (
     ")"
 )
 
+# The r*tree tables (partitions) of each assembly, and the chromosome and/or condition
+# they hold the intervals of (NULL when not partitioned on it)
+PAR = (
+    "BedPartition ("
+    "    PartitionId INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "    AssemblyId NOT NULL,"
+    "    ChromosomeId,"
+    "    ConditionId,"
+    "    TableName TEXT UNIQUE NOT NULL,"
+    "    FOREIGN KEY(AssemblyId) REFERENCES Assembly(AssemblyId),"
+    "    FOREIGN KEY(ChromosomeId) REFERENCES Chromosome(ChromosomeId),"
+    "    FOREIGN KEY(ConditionId)  REFERENCES Condition(ConditionId)"
+    ")"
+)
+
+# Signal track settings of a condition (see peaksql.signal)
+TRK = (
+    "Track ("
+    "    ConditionId INTEGER PRIMARY KEY,"
+    "    BinSize INT NOT NULL,"
+    "    ChunkSize INT NOT NULL,"
+    "    Zooms INT NOT NULL,"
+    "    FOREIGN KEY(ConditionId) REFERENCES Condition(ConditionId)"
+    ")"
+)
+
+# Signal table, run-length encoded and compressed chunks of binned signal
+SIG = (
+    "Signal ("
+    "    ConditionId INT NOT NULL,"
+    "    ChromosomeId INT NOT NULL,"
+    "    Zoom INT NOT NULL,"
+    "    Chunk INT NOT NULL,"
+    "    Data BLOB NOT NULL,"
+    "    PRIMARY KEY(ConditionId, ChromosomeId, Zoom, Chunk)"
+    ") WITHOUT ROWID"
+)
+
 # Virtual Bed table, complement of the BED table. Uses r*tree for faster queries
 # BED_VIRT = (
 #     f"BedVirtual USING rtree("
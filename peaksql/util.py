@@ -1,8 +1,58 @@
+from typing import Optional
+
 import numba
 import numpy as np
 
 
-@numba.jit(nopython=True, cache=True)
+# all the IUPAC nucleotide codes, and the one-hot indexes they can correspond to
+IUPAC = {
+    "A": [0],
+    "C": [1],
+    "G": [2],
+    "T": [3],
+    "N": [0, 1, 2, 3],
+    "R": [0, 2],
+    "Y": [1, 3],
+    "S": [1, 2],
+    "W": [0, 3],
+    "K": [2, 3],
+    "M": [0, 1],
+    "B": [1, 2, 3],
+    "D": [0, 2, 3],
+    "H": [0, 1, 3],
+    "V": [0, 1, 2],
+}
+
+
+def _make_lookup_tables():
+    """
+    Make the lookup tables used to convert (ascii) nucleotides to one-hot indexes.
+
+    The first table maps each byte to the one-hot index (0, 1, 2, 3) of the
+    single-nucleotide codes, to 4 + the row in the second table for multiple-nucleotide
+    codes, and to -1 for everything that is not an IUPAC code. The second table holds
+    the possible indexes of the multiple-nucleotide codes, padded with their first
+    option, and the third table the number of options.
+    """
+    lookup = np.full(256, -1, dtype=np.int8)
+    options = np.zeros((len(IUPAC) - 4, 4), dtype=np.int8)
+    nr_options = np.zeros(len(IUPAC) - 4, dtype=np.int8)
+    for nuc, idx in IUPAC.items():
+        if len(idx) == 1:
+            code = idx[0]
+        else:
+            code = 4 + np.sum(nr_options > 0)
+            options[code - 4] = idx + idx[:1] * (4 - len(idx))
+            nr_options[code - 4] = len(idx)
+        lookup[ord(nuc)] = lookup[ord(nuc.lower())] = code
+
+    return lookup, options, nr_options
+
+
+_NUC_TO_IDX, _AMBIGUOUS, _NR_AMBIGUOUS = _make_lookup_tables()
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
 def _nuc_to_onehot_idx(nuc: int) -> int:
     """
     Convert a nucleotide to a one hot index, where the indexes 0, 1, 2, 3 respectively
@@ -11,64 +61,177 @@ def _nuc_to_onehot_idx(nuc: int) -> int:
     Accepts all IUPAC nucleotide codes, and picks a random option from the possible
     nucleotides.
     """
-    # first try single-nucleotide codes
-    # start with A & T, since genomes generally have higher AT content than GC content
-    if nuc == 65:  # A
-        return 0
-    if nuc == 84:  # T
-        return 3
-    if nuc == 67:  # C
-        return 1
-    if nuc == 71:  # G
-        return 2
-
-    # if that doesn't work try multiple-nucleotide codes
-    # first set potential indexes
-    if nuc == 78:  # N
-        idx = np.array([0, 1, 2, 3])
-    elif nuc == 82:  # R
-        idx = np.array([0, 2])
-    elif nuc == 89:  # Y
-        idx = np.array([1, 3])
-    elif nuc == 83:  # S
-        idx = np.array([1, 2])
-    elif nuc == 87:  # W
-        idx = np.array([0, 3])
-    elif nuc == 75:  # K
-        idx = np.array([2, 3])
-    elif nuc == 77:  # M
-        idx = np.array([0, 1])
-    elif nuc == 66:  # B
-        idx = np.array([1, 2, 3])
-    elif nuc == 68:  # D
-        idx = np.array([0, 2, 3])
-    elif nuc == 72:  # H
-        idx = np.array([0, 1, 3])
-    elif nuc == 86:  # V
-        idx = np.array([0, 1, 2])
-    else:
+    idx = _NUC_TO_IDX[nuc]
+    if idx < 0:
         raise ValueError("Only IUPAC nucleotide codes are accepted.")
 
-    # now return any of the possible indexes
-    return np.random.choice(idx)
+    # single-nucleotide codes are a simple lookup
+    if idx < 4:
+        return idx
 
+    # multiple-nucleotide codes pick any of the possible indexes
+    idx -= 4
+    return _AMBIGUOUS[idx, np.random.randint(_NR_AMBIGUOUS[idx])]
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _sequence_to_onehot(sequence: np.ndarray, onehot: np.ndarray) -> None:
+    onehot[:] = 0
+    for i in range(len(sequence)):
+        onehot[i, _nuc_to_onehot_idx(sequence[i])] = 1
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _sequences_to_onehot(sequences: np.ndarray, onehot: np.ndarray) -> None:
+    for i in range(len(sequences)):
+        _sequence_to_onehot(sequences[i], onehot[i])
 
-@numba.jit(nopython=True, cache=True)
-def _sequence_to_onehot(sequence: np.ndarray) -> np.ndarray:
-    onehot = np.zeros((len(sequence), 4), dtype=numba.boolean)
-    for i, nuc in enumerate(sequence):
-        onehot[i, _nuc_to_onehot_idx(nuc)] = True
 
-    return onehot
+def _to_uint8(sequence) -> np.ndarray:
+    """
+    Get a sequence as uint8 (ascii) array, without copying when possible.
+    """
+    if isinstance(sequence, np.ndarray):
+        return sequence.view(np.uint8)
+    if isinstance(sequence, (bytes, bytearray, memoryview)):
+        return np.frombuffer(sequence, dtype=np.uint8)
+    return np.frombuffer(str(sequence).encode("ascii"), dtype=np.uint8)
 
 
-def sequence_to_onehot(sequence) -> np.ndarray:
+def sequence_to_onehot(sequence, out: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Convert a sequence of length n to a one-hot encoded array of shape (n x 4).
 
-    The nucleotides A, C, G, T respectively correspond to indices 0, 1, 2, 3.
+    The nucleotides A, C, G, T respectively correspond to indices 0, 1, 2, 3. The
+    sequence can be a string (or e.g. a pyfaidx Sequence), bytes or an uint8 array,
+    and is optionally written into an existing (n x 4) array.
+    """
+    sequence = _to_uint8(sequence)
+    if out is None:
+        out = np.empty((len(sequence), 4), dtype=bool)
+
+    _sequence_to_onehot(sequence, out)
+    return out
+
+
+def sequences_to_onehot(sequences, out: Optional[np.ndarray] = None) -> np.ndarray:
     """
-    return _sequence_to_onehot(str(sequence).upper().encode("utf-8"))
+    Convert a batch of b sequences of length n to a one-hot encoded array of shape
+    (b x n x 4), optionally written into an existing array.
+    """
+    sequences = np.stack([_to_uint8(sequence) for sequence in sequences])
+    if out is None:
+        out = np.empty(sequences.shape + (4,), dtype=bool)
+
+    _sequences_to_onehot(sequences, out)
+    return out
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _rasterise(
+    windows: np.ndarray,
+    conditions: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    values: np.ndarray,
+    order: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    length = out.shape[2]
+    counts = np.zeros(length + 1, dtype=np.int64)
+    nans = np.zeros(length + 1, dtype=np.int64)
+    sums = np.zeros(length + 1, dtype=np.float64)
+
+    i = 0
+    while i < len(order):
+        window, condition = windows[order[i]], conditions[order[i]]
+
+        # difference arrays of all the intervals of this window and condition
+        lower, upper = length, 0
+        while (
+            i < len(order)
+            and windows[order[i]] == window
+            and conditions[order[i]] == condition
+        ):
+            start = max(starts[order[i]], 0)
+            end = min(ends[order[i]], length)
+            if start < end:
+                counts[start] += 1
+                counts[end] -= 1
+                # unknown (nan) values are counted apart, so they do not make the
+                # running sum nan past their own interval
+                if np.isnan(values[order[i]]):
+                    nans[start] += 1
+                    nans[end] -= 1
+                else:
+                    sums[start] += values[order[i]]
+                    sums[end] -= values[order[i]]
+                lower, upper = min(lower, start), max(upper, end)
+            i += 1
+
+        # the cumulative sum of the difference arrays is the raster, the count makes
+        # sure that positions without intervals are exactly zero
+        count, nan, total = 0, 0, 0.0
+        for j in range(lower, upper):
+            count += counts[j]
+            nan += nans[j]
+            total += sums[j]
+            counts[j], nans[j], sums[j] = 0, 0, 0.0
+            if count == 0:
+                total = 0.0
+            out[window, condition, j] = np.nan if nan > 0 else total
+        counts[upper], nans[upper], sums[upper] = 0, 0, 0.0
+
+
+def rasterise(
+    windows: np.ndarray,
+    conditions: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    values: np.ndarray,
+    out: np.ndarray,
+) -> np.ndarray:
+    """
+    Rasterise intervals onto a zero-initialised (batch x conditions x length) array.
+
+    Each interval i sets out[windows[i], conditions[i], starts[i]:ends[i]] to values[i],
+    where the starts and ends are relative to the start of the window, and are clipped
+    to the window. Overlapping intervals of the same window and condition add up, and
+    positions covered by an interval with a nan value are nan. The intervals are drawn
+    with difference arrays, so the cost does not depend on their length. For a boolean
+    out each (non-zero) interval sets its positions to True.
+    """
+    windows = np.asarray(windows, dtype=np.int64)
+    conditions = np.asarray(conditions, dtype=np.int64)
+    order = np.lexsort((conditions, windows))
+
+    _rasterise(
+        windows,
+        conditions,
+        np.asarray(starts, dtype=np.int64),
+        np.asarray(ends, dtype=np.int64),
+        np.asarray(values, dtype=np.float64),
+        order,
+        out,
+    )
+    return out
+
+
+def expand_ranges(firsts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Expand ranges, given by their first index and their length, into the concatenated
+    indices of all the ranges.
+
+    firsts: [3, 10, 0]
+    counts: [2, 0, 3]
+    returns: [3, 4, 0, 1, 2]
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    return (
+        np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+        + np.repeat(np.asarray(firsts, dtype=np.int64), counts)
+    )
 
 
 @numba.jit(nopython=True, cache=True)
@@ -84,19 +247,14 @@ def binary_search(index: int, lens: np.ndarray) -> int:
     if index < lens[0] or index >= lens[-1]:
         raise ValueError("Invalid index")
 
-    # FIXME: this can hang in infinite loop, and because of numba becomes unresponsive.
-    left, right = 0, len(lens)
-
-    while left <= right:
+    # find the first value larger than index, the range halves each iteration so this
+    # always terminates in O(log n), also when lens contains repeated values
+    left, right = 0, len(lens) - 1
+    while left < right:
         mid = (left + right) // 2
-
-        if lens[mid - 1] > index:
-            right = mid
-
-        elif lens[mid] <= index:
-            left = mid
-
+        if lens[mid] <= index:
+            left = mid + 1
         else:
-            return mid
+            right = mid
 
-    assert False
+    return left
@@ -172,3 +172,75 @@ class TestUtil(unittest.TestCase):
 
         assert peaksql.util.binary_search(14, haystack) == 4
         assert peaksql.util.binary_search.py_func(14, haystack) == 4
+
+        # repeated values (chromosomes without windows) are skipped
+        haystack = np.array([0, 5, 5, 5, 12])
+        assert peaksql.util.binary_search(5, haystack) == 4
+        assert peaksql.util.binary_search.py_func(4, haystack) == 1
+
+    def test_120_sequence_to_onehot_input_types(self):
+        true = peaksql.util.sequence_to_onehot("ACGTACGT")
+        for sequence in [
+            b"ACGTACGT",
+            "acgtACGT",
+            np.frombuffer(b"ACGTACGT", dtype=np.uint8),
+        ]:
+            np.testing.assert_array_equal(
+                peaksql.util.sequence_to_onehot(sequence), true
+            )
+        self.assertRaises(ValueError, peaksql.util.sequence_to_onehot, "ACGQ")
+
+    def test_121_sequences_to_onehot_out(self):
+        out = np.ones((2, 4, 4), dtype=np.float32)
+        onehot = peaksql.util.sequences_to_onehot(["ACGT", "TTNA"], out=out)
+        assert onehot is out
+        np.testing.assert_array_equal(out[0], np.eye(4))
+        np.testing.assert_array_equal(out.sum(axis=2), np.ones((2, 4)))
+        np.testing.assert_array_equal(out[1, [0, 1, 3]], np.eye(4)[[3, 3, 0]])
+
+    def test_122_rasterise(self):
+        out = np.zeros((2, 2, 10), dtype=float)
+        peaksql.util.rasterise(
+            windows=[1, 0, 1, 0],
+            conditions=[1, 0, 1, 1],
+            starts=[-5, 2, 5, 8],
+            ends=[3, 4, 15, 9],
+            values=[0.1, 2.0, 0.2, 3.0],
+            out=out,
+        )
+        true = np.zeros((2, 2, 10))
+        true[0, 0, 2:4] = 2.0
+        true[0, 1, 8] = 3.0
+        true[1, 1, :3] = 0.1
+        true[1, 1, 5:] = 0.2
+        np.testing.assert_array_equal(out, true)
+
+        # nan values only affect their own interval, also next to other intervals
+        out = np.zeros((2, 1, 10), dtype=float)
+        peaksql.util.rasterise(
+            [0, 0, 0, 1, 1],
+            [0] * 5,
+            [0, 3, 5, 0, 2],
+            [3, 5, 10, 4, 6],
+            [1.0, np.nan, 2.0, 1.0, np.nan],
+            out,
+        )
+        np.testing.assert_array_equal(
+            out[:, 0],
+            [
+                [1, 1, 1, np.nan, np.nan, 2, 2, 2, 2, 2],
+                [1, 1, np.nan, np.nan, np.nan, np.nan, 0, 0, 0, 0],
+            ],
+        )
+
+        out = np.zeros((2, 2, 10), dtype=bool)
+        peaksql.util.rasterise([1, 1], [0, 0], [12, 3], [15, 5], [1, 1], out)
+        true = np.zeros((2, 2, 10), dtype=bool)
+        true[1, 0, 3:5] = True
+        np.testing.assert_array_equal(out, true)
+
+    def test_123_expand_ranges(self):
+        np.testing.assert_array_equal(
+            peaksql.util.expand_ranges([3, 10, 0], [2, 0, 3]), [3, 4, 0, 1, 2]
+        )
+        assert len(peaksql.util.expand_ranges([], [])) == 0
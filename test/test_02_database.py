@@ -1,6 +1,14 @@
+import glob
+import multiprocessing
+import signal
 import unittest
 import sys
+import tempfile
 import os
+import sqlite3
+from unittest import mock
+
+import numpy as np
 
 import peaksql
 
@@ -13,6 +21,8 @@ if os.path.isfile(DATABASE_BED):
     os.remove(DATABASE_BED)
 if os.path.isfile(DATABASE_NWP):
     os.remove(DATABASE_NWP)
+for cache in glob.glob(f"{DATABASE_BED}.*") + glob.glob(f"{DATABASE_NWP}.*"):
+    os.remove(cache)
 
 
 class TestDataBase(unittest.TestCase):
@@ -96,3 +106,235 @@ class TestDataBase(unittest.TestCase):
             db_file.cursor.execute("SELECT * FROM BED").fetchall()
             == db_memo.cursor.execute("SELECT * FROM BED").fetchall()
         )
+
+    def test_206_packed_assembly(self):
+        db = peaksql.DataBase(DATABASE_NWP)
+        db.add_assembly("test/data/assembly2.fa", pack=True)
+        assert os.path.isfile(f"{DATABASE_NWP}.assembly2.genome")
+
+        for database in [db, peaksql.DataBase(DATABASE_NWP)]:
+            assert list(database.genomes) == ["assembly2"]
+            for chrom in ["chr1", "chr3"]:
+                packed = database.get_sequence("assembly2", chrom, 5, 25)
+                assert isinstance(packed, np.ndarray)
+                assert packed.tobytes().decode() == str(
+                    database.fastas["assembly2"][chrom][5:25]
+                )
+
+    def test_207_add_data_chunked_with_condition(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = peaksql.DataBase(os.path.join(tmpdir, "condition.sqlite"))
+            db.add_assembly("test/data/assembly1.fa")
+            assert (
+                db.add_data(
+                    "test/data/assembly1.narrowPeak", "assembly1", "ctcf", chunksize=3
+                )
+                == 4
+            )
+            db.add_data("test/data/assembly1.bed", "assembly1", "ctcf'")
+            assert db.cursor.execute(
+                "SELECT ConditionId, Condition FROM Condition"
+            ).fetchall() == [(0, None), (1, "ctcf"), (2, "ctcf'")]
+            assert db.cursor.execute(
+                "SELECT BedId, ConditionId, Peak, ChromStart, ChromEnd "
+                "FROM BedVirtual_assembly1 ORDER BY BedId"
+            ).fetchall() == [
+                (1, 1, 5, 0, 10),
+                (2, 1, 3, 20, 30),
+                (3, 1, 1, 50, 57),
+                (4, 1, 6, 73, 80),
+                (5, 2, None, 0, 10),
+            ]
+
+    def test_208_add_data_many(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = peaksql.DataBase(os.path.join(tmpdir, "many.sqlite"))
+            db.add_assembly("test/data/assembly1.fa")
+            data = ["test/data/assembly1.narrowPeak", "test/data/assembly1.bed"]
+            assert db.add_data_many(data, "assembly1", ["a", "b"], processes=2) == 5
+            assert sorted(
+                db.cursor.execute(
+                    "SELECT Condition, Peak, ChromStart, ChromEnd "
+                    "FROM BedVirtual_assembly1 JOIN Condition USING (ConditionId)"
+                ).fetchall(),
+                key=str,
+            ) == [
+                ("a", 1, 50, 57),
+                ("a", 3, 20, 30),
+                ("a", 5, 0, 10),
+                ("a", 6, 73, 80),
+                ("b", None, 0, 10),
+            ]
+
+            # errors in the parsing processes are raised by the writer
+            self.assertRaises(
+                ValueError,
+                db.add_data_many,
+                ["test/data/assembly2.bed"],
+                "assembly1",
+                processes=1,
+            )
+
+    def test_209_add_bedgraph_signal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bedgraph = os.path.join(tmpdir, "signal.bdg")
+            with open(bedgraph, "w") as f:
+                f.write("chr1\t10\t20\t2.0\nchr1\t0\t5\t1.0\nchr2\t3\t4\t4.0\n")
+                f.write("chr1\t20\t23\t3.0\n")
+
+            db = peaksql.DataBase(os.path.join(tmpdir, "signal.sqlite"))
+            db.add_assembly("test/data/assembly1.fa")
+            assert (
+                db.add_data(
+                    bedgraph,
+                    "assembly1",
+                    "signal",
+                    chunksize=2,
+                    signal_bin_size=2,
+                    signal_zooms=1,
+                )
+                == 4
+            )
+            assert db.cursor.execute("SELECT COUNT(*) FROM Bed").fetchone() == (0,)
+            assert db.cursor.execute("SELECT * FROM Track").fetchall() == [
+                (1, 2, peaksql.signal.CHUNK_SIZE, 1)
+            ]
+
+            signal = {
+                (chrom_id, zoom): peaksql.signal.decode(data)
+                for chrom_id, zoom, data in db.cursor.execute(
+                    "SELECT ChromosomeId, Zoom, Data FROM Signal WHERE Chunk = 0"
+                )
+            }
+            assert sorted(signal) == [(1, 0), (1, 1), (2, 0), (2, 1)]
+            np.testing.assert_array_equal(
+                signal[1, 0][:13], [1, 1, 0.5, 0, 0, 2, 2, 2, 2, 2, 3, 1.5, 0]
+            )
+            np.testing.assert_array_equal(signal[1, 1][:4], [0.625, 1.5, 2.125, 0])
+            np.testing.assert_array_equal(signal[2, 0][:3], [0, 2, 0])
+
+            # the signal of a condition is added once, not on top of the stored signal
+            for bin_size in [1, 2]:
+                self.assertRaises(
+                    ValueError,
+                    db.add_data,
+                    bedgraph,
+                    "assembly1",
+                    "signal",
+                    signal_bin_size=bin_size,
+                    signal_zooms=1,
+                )
+            assert db.cursor.execute(
+                "SELECT Data FROM Signal WHERE ChromosomeId = 2 AND Zoom = 0"
+            ).fetchone() == (peaksql.signal.encode(signal[2, 0]),)
+
+            # but the files of a condition added at once are summed
+            db.add_data_many(
+                [bedgraph, bedgraph], "assembly1", ["twice", "twice"], processes=0
+            )
+            np.testing.assert_array_equal(
+                peaksql.signal.decode(
+                    db.cursor.execute(
+                        "SELECT Data FROM Signal WHERE ConditionId = 2 "
+                        "AND ChromosomeId = 2 AND Zoom = 0"
+                    ).fetchone()[0]
+                )[:5],
+                [0, 0, 0, 8, 0],
+            )
+
+    def test_210_partitioned_rtree(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = peaksql.DataBase(os.path.join(tmpdir, "partitioned.sqlite"))
+            db.add_assembly(
+                "test/data/assembly1.fa", partition_by=["chromosome", "condition"]
+            )
+            db.add_data("test/data/assembly1.bed", "assembly1", "a")
+            db.add_data("test/data/assembly1.narrowPeak", "assembly1", "b")
+            assert db.get_partitions("assembly1") == [
+                "BedVirtual_assembly1_chrom1_cond1",
+                "BedVirtual_assembly1_chrom1_cond2",
+                "BedVirtual_assembly1_chrom2_cond2",
+            ]
+            assert db.get_partitions("assembly1", 2) == [
+                "BedVirtual_assembly1_chrom2_cond2"
+            ]
+            assert db.cursor.execute(
+                "SELECT BedId, ChromStart, ChromEnd, ConditionId, ChromosomeId, Peak "
+                "FROM BedVirtual_assembly1_chrom2_cond2"
+            ).fetchall() == [(4, 50, 57, 2, 2, 1), (5, 73, 80, 2, 2, 6)]
+
+            self.assertRaises(
+                AssertionError,
+                db.add_assembly,
+                "test/data/assembly2.fa",
+                partition_by=["assembly"],
+            )
+
+    def test_211_upgrade_old_database(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # the tables of a database made before the r*tree was partitioned
+            old = os.path.join(tmpdir, "old.sqlite")
+            conn = sqlite3.connect(old)
+            conn.executescript(
+                """
+                CREATE TABLE Assembly (
+                    AssemblyId INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Assembly TEXT NOT NULL, Species, Size INT NOT NULL,
+                    AbsPath TEXT UNIQUE NOT NULL);
+                CREATE TABLE Chromosome (
+                    ChromosomeId INTEGER PRIMARY KEY AUTOINCREMENT, Chromosome TEXT,
+                    Size INT NOT NULL, Offset INT NOT NULL, AssemblyId NOT NULL);
+                CREATE TABLE Condition (
+                    ConditionId INTEGER PRIMARY KEY AUTOINCREMENT, Condition TEXT);
+                CREATE TABLE Bed (
+                    BedId INTEGER PRIMARY KEY AUTOINCREMENT, ConditionId,
+                    ChromosomeId NOT NULL, DataValue NUMERIC, Peak INT);
+                CREATE VIRTUAL TABLE BedVirtual_assembly1 USING rtree_i32(
+                    BedId INT, ChromStart INT, ChromEnd INT);
+                """
+            )
+            conn.execute(
+                "INSERT INTO Assembly VALUES(1, 'assembly1', 'assembly1', 80, ?)",
+                (os.path.abspath("test/data/assembly1.fa"),),
+            )
+            conn.execute("INSERT INTO Chromosome VALUES(1, 'chr1', 40, 0, '1')")
+            conn.execute("INSERT INTO Chromosome VALUES(2, 'chr2', 40, 40, '1')")
+            conn.execute("INSERT INTO Condition VALUES(0, NULL)")
+            conn.execute("INSERT INTO Bed VALUES(1, 0, 1, NULL, NULL)")
+            conn.execute("INSERT INTO BedVirtual_assembly1 VALUES(1, 0, 10)")
+            conn.commit()
+            conn.close()
+
+            self.assertRaises(ValueError, peaksql.DataBase, old, read_only=True)
+            db = peaksql.DataBase(old)
+            assert db.get_partitions("assembly1") == ["BedVirtual_assembly1"]
+            assert db.cursor.execute(
+                "SELECT BedId, ChromStart, ChromEnd, ConditionId, ChromosomeId "
+                "FROM BedVirtual_assembly1"
+            ).fetchall() == [(1, 0, 10, 0, 1)]
+            db.add_data("test/data/assembly1.narrowPeak", "assembly1", "peaks")
+            db.close()
+
+            dataset = peaksql.BedDataSet(old, seq_length=10, stride=10)
+            labels = np.array([label for _, label in dataset])
+            assert np.all(labels[:, 0] == [1, 0, 0, 0, 0, 0, 0, 0])
+            assert np.all(labels[:, 1] == [1, 0, 1, 0, 0, 1, 0, 1])
+
+    @unittest.skipUnless(
+        multiprocessing.get_start_method() == "fork", "needs forked workers"
+    )
+    def test_212_add_data_dead_worker(self):
+        def killed(*args):
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = peaksql.DataBase(os.path.join(tmpdir, "killed.sqlite"))
+            db.add_assembly("test/data/assembly1.fa")
+            with mock.patch("peaksql.database.read_chunks", killed):
+                self.assertRaises(
+                    RuntimeError,
+                    db.add_data_many,
+                    ["test/data/assembly1.bed"],
+                    "assembly1",
+                    processes=1,
+                )
@@ -1,3 +1,7 @@
+import glob
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
@@ -96,8 +100,541 @@ class TestDataBase(unittest.TestCase):
 
     def test_310_BedDataSet_random_pos_distribution(self):
         dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, nr_rand_pos=100_000)
+        assert dataset.positions.dtype == np.uint32
+        assert dataset.positions.shape == (100_000,)
 
         # chromosomes are of equal size, so we expect equal nr of positions for each
         un_cumsum = dataset.cumsum - np.roll(dataset.cumsum, shift=1)
         for count in un_cumsum[1:]:
             assert 0.245 <= count / 100_000 <= 0.255
+
+    def test_311_BedDataSet_get_labels(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, stride=3)
+        sites = [dataset._index_to_site(index) for index in range(len(dataset))]
+        labels = np.stack([dataset.get_label(*site) for site in sites])
+        np.testing.assert_array_equal(dataset.get_labels(sites), labels)
+
+    def test_312_NarrowPeakDataSet_getitems(self):
+        dataset = peaksql.NarrowPeakDataSet(DATABASE_NWP, seq_length=10, stride=3)
+        indices = list(range(len(dataset)))
+        for (seq, label), index in zip(dataset.__getitems__(indices), indices):
+            true_seq, true_label = dataset[index]
+            np.testing.assert_array_equal(seq, true_seq)
+            np.testing.assert_array_equal(label, true_label)
+        self.assertRaises(IndexError, dataset.__getitems__, [len(dataset)])
+
+    def test_313_memory_index(self):
+        for dataset_class, database in [
+            (peaksql.BedDataSet, DATABASE_BED),
+            (peaksql.NarrowPeakDataSet, DATABASE_NWP),
+        ]:
+            sql = dataset_class(database, seq_length=10, stride=3)
+            memory = dataset_class(database, seq_length=10, stride=3, index="memory")
+            sites = [sql._index_to_site(index) for index in range(len(sql))]
+            np.testing.assert_array_equal(
+                sql.get_labels(sites), memory.get_labels(sites)
+            )
+            for site in sites:
+                np.testing.assert_array_equal(
+                    sql.get_label(*site), memory.get_label(*site)
+                )
+
+    def test_314_cache_labels(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = shutil.copy(DATABASE_BED, tmpdir)
+            dataset = peaksql.BedDataSet(database, seq_length=10, stride=3)
+            cached = peaksql.BedDataSet(
+                database, seq_length=10, stride=3, cache_labels=True
+            )
+            assert cached.labels.dtype == np.uint8
+            indices = list(range(len(dataset)))
+            for (_, label), (_, true_label) in zip(
+                cached.__getitems__(indices), dataset.__getitems__(indices)
+            ):
+                np.testing.assert_array_equal(label, true_label)
+            for index in indices:
+                np.testing.assert_array_equal(cached[index][1], dataset[index][1])
+
+            # the labels of a dataset with the same settings are loaded from file
+            reloaded = peaksql.BedDataSet(database, seq_length=10, stride=3)
+            assert reloaded.precompute_labels().filename == cached.labels.filename
+
+            # a change of the database replaces the labels of the same settings, but
+            # keeps those of other settings
+            peaksql.BedDataSet(database, seq_length=10, stride=5, cache_labels=True)
+            os.utime(database, ns=(0, os.stat(database).st_mtime_ns + 10 ** 9))
+            changed = peaksql.BedDataSet(
+                database, seq_length=10, stride=3, cache_labels=True
+            )
+            assert changed.labels.filename != cached.labels.filename
+            assert len(glob.glob(f"{database}.labels.*.npy")) == 2
+            assert not os.path.exists(cached.labels.filename)
+
+            random = peaksql.BedDataSet(database, seq_length=10, nr_rand_pos=10)
+            self.assertRaises(ValueError, random.precompute_labels)
+            for ds in [dataset, cached, reloaded, changed, random]:
+                ds.close()
+
+    def test_315_strided_index_order(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, stride=7)
+        assert dataset.chromosomes == [
+            (None, None),
+            ("assembly1", "chr1"),
+            ("assembly1", "chr2"),
+            ("assembly2", "chr1"),
+            ("assembly2", "chr3"),
+        ]
+        np.testing.assert_array_equal(dataset.chromosome_ids, [-1, 1, 2, 3, 4])
+        np.testing.assert_array_equal(dataset.cumsum, [0, 5, 10, 15, 20])
+        assert dataset.positions is None
+        assert [dataset._index_to_site(index) for index in range(5, 10)] == [
+            ("assembly1", "chr2", chromstart, chromstart + 10)
+            for chromstart in [0, 7, 14, 21, 28]
+        ]
+
+    def test_316_cache_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = shutil.copy(DATABASE_BED, tmpdir)
+            dataset = peaksql.BedDataSet(
+                database, seq_length=10, stride=7, cache_index=True
+            )
+            cached = peaksql.BedDataSet(
+                database, seq_length=10, stride=7, cache_index=True
+            )
+            assert len(glob.glob(f"{database}.index.*.npz")) == 1
+            assert cached.chromosomes == dataset.chromosomes
+            np.testing.assert_array_equal(cached.chromosome_ids, dataset.chromosome_ids)
+            np.testing.assert_array_equal(cached.cumsum, dataset.cumsum)
+
+            # a change of the database replaces the index
+            os.utime(database, ns=(0, os.stat(database).st_mtime_ns + 10 ** 9))
+            peaksql.BedDataSet(database, seq_length=10, stride=7, cache_index=True)
+            assert len(glob.glob(f"{database}.index.*.npz")) == 1
+            dataset.close()
+            cached.close()
+
+    def test_317_indices_to_sites(self):
+        for kwargs in [dict(stride=7), dict(nr_rand_pos=1000)]:
+            dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, **kwargs)
+            indices = np.arange(len(dataset))
+            chrom_ids, chromstarts, chromends = dataset.indices_to_sites(indices)
+            assert [
+                (*dataset.chromosomes[chrom_id], chromstart, chromend)
+                for chrom_id, chromstart, chromend in zip(
+                    chrom_ids, chromstarts, chromends
+                )
+            ] == [dataset._index_to_site(index) for index in indices]
+            self.assertRaises(IndexError, dataset.indices_to_sites, [len(dataset)])
+
+    def test_318_BedGraph_array_from_query(self):
+        chromstart = 10
+        chromend = 20
+        query = [(0, 15, 25, 2.0), (0, 5, 13, 1.0), (0, 13, 14, None)]
+        dataset = peaksql.BedGraphDataSet(DATABASE_BED, seq_length=10, stride=10)
+        np.testing.assert_array_equal(
+            dataset.array_from_query(query, chromstart, chromend),
+            [[1.0, 1.0, 1.0, np.nan, 0.0, 2.0, 2.0, 2.0, 2.0, 2.0]],
+        )
+
+        # intervals next to an unknown value keep their own value
+        query = [(0, 10, 13, 1.0), (0, 13, 15, None), (0, 15, 20, 2.0)]
+        np.testing.assert_array_equal(
+            dataset.array_from_query(query, chromstart, chromend),
+            [[1.0, 1.0, 1.0, np.nan, np.nan, 2.0, 2.0, 2.0, 2.0, 2.0]],
+        )
+
+    def test_319_BedGraphDataSet_signal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bedgraph = os.path.join(tmpdir, "signal.bdg")
+            with open(bedgraph, "w") as f:
+                f.write("chr1\t10\t20\t2.0\nchr1\t0\t5\t1.0\nchr1\t20\t23\t3.0\n")
+
+            database = os.path.join(tmpdir, "signal.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa")
+            db.add_data(bedgraph, "assembly1", "signal", signal_zooms=1)
+            db.close()
+
+            dataset = peaksql.BedGraphDataSet(database, seq_length=10, stride=10)
+            true = np.zeros((len(dataset), 2, 10))
+            true[0, 1, :5] = 1.0
+            true[1, 1] = 2.0
+            true[2, 1, :3] = 3.0
+            np.testing.assert_array_equal(
+                [dataset[index][1] for index in range(len(dataset))], true
+            )
+            np.testing.assert_array_equal(
+                np.stack([label for _, label in dataset.__getitems__([0, 1, 2, 3])]),
+                true[:4],
+            )
+
+            dataset = peaksql.BedGraphDataSet(
+                database, seq_length=10, stride=10, zoom=1
+            )
+            np.testing.assert_array_equal(
+                dataset[0][1][1], [1.0] * 4 + [0.25] * 4 + [1.0] * 2
+            )
+            dataset.close()
+
+    def test_320_partitioned_labels(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            labels = []
+            for partition_by in [None, ["chromosome"], ["chromosome", "condition"]]:
+                database = os.path.join(tmpdir, f"{partition_by}.sqlite")
+                db = peaksql.DataBase(database)
+                for assembly in ["assembly1", "assembly2"]:
+                    db.add_assembly(
+                        f"test/data/{assembly}.fa", partition_by=partition_by
+                    )
+                    db.add_data(f"test/data/{assembly}.bed", assembly, "bed")
+                db.add_data("test/data/assembly1.narrowPeak", "assembly1", "peak")
+                db.close()
+
+                dataset = peaksql.BedDataSet(database, seq_length=10, stride=3)
+                labels.append(np.stack([label for _, label in dataset]))
+                np.testing.assert_array_equal(
+                    [label for _, label in dataset.__getitems__(range(len(dataset)))],
+                    labels[-1],
+                )
+                dataset.close()
+
+            np.testing.assert_array_equal(labels[0], labels[1])
+            np.testing.assert_array_equal(labels[0], labels[2])
+
+    def test_321_select_conditions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = os.path.join(tmpdir, "conditions.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa", partition_by=["condition"])
+            db.add_data("test/data/assembly1.bed", "assembly1", "bed")
+            db.add_data("test/data/assembly1.narrowPeak", "assembly1", "peak")
+            db.close()
+
+            dataset = peaksql.BedDataSet(database, seq_length=10, stride=3)
+            labels = np.stack([label for _, label in dataset])
+            assert labels.shape[1] == 3
+
+            for index in ["sql", "memory"]:
+                for conditions in [["peak"], ["peak", "bed"]]:
+                    selected = peaksql.BedDataSet(
+                        database,
+                        seq_length=10,
+                        stride=3,
+                        conditions=conditions,
+                        index=index,
+                    )
+                    channels = [dataset.conditions[c] for c in conditions]
+                    np.testing.assert_array_equal(
+                        np.stack([label for _, label in selected]), labels[:, channels],
+                    )
+                    np.testing.assert_array_equal(
+                        [
+                            label
+                            for _, label in selected.__getitems__(range(len(selected)))
+                        ],
+                        labels[:, channels],
+                    )
+                    selected.close()
+
+            self.assertRaises(
+                ValueError,
+                peaksql.BedDataSet,
+                database,
+                seq_length=10,
+                stride=3,
+                conditions=["chip"],
+            )
+            dataset.close()
+
+    def test_322_quoted_names(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = os.path.join(tmpdir, "quoted.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa", assembly='it\'s-an "assembly"')
+            db.add_data("test/data/assembly1.bed", 'it\'s-an "assembly"', "a'b")
+            db.close()
+
+            for index in ["sql", "memory"]:
+                dataset = peaksql.BedDataSet(
+                    database, seq_length=10, stride=10, index=index
+                )
+                assert dataset.conditions == {None: 0, "a'b": 1}
+                np.testing.assert_array_equal(
+                    [label for _, label in dataset],
+                    [[False, True]] + [[False, False]] * 7,
+                )
+                np.testing.assert_array_equal(
+                    dataset.get_labels([dataset._index_to_site(0)]), [[False, True]]
+                )
+                dataset.close()
+
+    def test_323_stats(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, stride=10)
+        assert dataset.stats is None
+
+        for index in ["sql", "memory"]:
+            dataset = peaksql.BedDataSet(
+                DATABASE_BED, seq_length=10, stride=10, index=index, stats=True
+            )
+            for i in range(len(dataset)):
+                dataset[i]
+            dataset.__getitems__(range(len(dataset)))
+
+            report = dataset.stats.report()
+            stages = report["stages"]
+            assert stages["index_to_site"]["calls"] == len(dataset) + 1
+            assert stages["sequence"]["calls"] == 2 * len(dataset)
+            assert stages["onehot"]["calls"] == 2 * len(dataset)
+            assert stages["label_from_array"]["calls"] == len(dataset) + 1
+            for stage in stages.values():
+                assert sum(calls for _, calls in stage["histogram"]) == stage["calls"]
+            assert report["counters"]["queries"] == len(dataset) + 2
+            assert report["counters"]["label_cache_misses"] == 2 * len(dataset)
+            assert report["label_cache_hit_rate"] == 0
+            assert list(dataset.stats.workers()) == ["main"]
+
+            dataset.stats.reset()
+            assert dataset.stats.report()["stages"]["onehot"]["calls"] == 0
+            dataset.close()
+
+    def test_324_cache_sequences(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, stride=3)
+        for block_size, budget in [(7, 2 ** 20), (16, 100), (2 ** 16, 2 ** 20)]:
+            cached = peaksql.BedDataSet(
+                DATABASE_BED,
+                seq_length=10,
+                stride=3,
+                cache_sequences=budget,
+                block_size=block_size,
+                stats=True,
+            )
+            for i in range(len(dataset)):
+                np.testing.assert_array_equal(cached[i][0], dataset[i][0])
+            np.testing.assert_array_equal(
+                [seq for seq, _ in cached.__getitems__(range(len(cached)))],
+                [seq for seq, _ in dataset],
+            )
+            assert cached.block_cache.nbytes <= max(budget, block_size * 4)
+            assert cached.stats.report()["sequence_cache_hit_rate"] > 0
+            cached.close()
+
+        # blocks with ambiguous nucleotides are encoded per window
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fasta = os.path.join(tmpdir, "ambiguous.fa")
+            with open(fasta, "w") as f:
+                f.write(">chr1\nACGTACGTNNACGTACGTAC\n")
+            database = os.path.join(tmpdir, "ambiguous.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly(fasta, "ambiguous")
+            db.close()
+
+            cached = peaksql.BedDataSet(
+                database, seq_length=5, stride=5, cache_sequences=2 ** 20, block_size=8
+            )
+            seqs = np.concatenate([seq for seq, _ in cached])
+            np.testing.assert_array_equal(seqs.sum(axis=1), 1)
+            np.testing.assert_array_equal(
+                seqs[:8], peaksql.util.sequence_to_onehot("ACGTACGT")
+            )
+            assert cached.block_cache.blocks[("ambiguous", "chr1", 1)].dtype == np.uint8
+            cached.close()
+
+    def test_325_balanced_positions(self):
+        for fraction in [0, 0.25, 1]:
+            dataset = peaksql.BedDataSet(
+                DATABASE_BED, seq_length=5, nr_rand_pos=200, positive_fraction=fraction
+            )
+            assert len(dataset) == 200
+            labels = np.stack([label for _, label in dataset])
+            assert labels.any(axis=1).sum() == round(200 * fraction)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = os.path.join(tmpdir, "balanced.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa")
+            db.add_data("test/data/assembly1.bed", "assembly1", "bed")
+            db.add_data("test/data/assembly1.narrowPeak", "assembly1", "peak")
+            db.close()
+
+            # positive windows of the conditions with weight only
+            dataset = peaksql.BedDataSet(
+                database,
+                seq_length=5,
+                inner_range=1,
+                nr_rand_pos=100,
+                positive_fraction=1,
+                condition_weights={"bed": 1, "peak": 0},
+            )
+            labels = np.stack([label for _, label in dataset])
+            assert labels[:, dataset.conditions["bed"]].all()
+
+            # negative windows overlap with none of the conditions
+            dataset = peaksql.BedDataSet(
+                database, seq_length=5, nr_rand_pos=100, positive_fraction=0
+            )
+            assert not np.stack([label for _, label in dataset]).any()
+
+            # any dataset can draw balanced positions, of any seq_length
+            dataset = peaksql.BedDataSet(database, seq_length=5, stride=5)
+            for seq_length in [5, 35, 5]:
+                *_, cumsum, chromstarts = dataset.get_balanced_positions(
+                    seq_length, 50, 0.5, rng=np.random.default_rng(0)
+                )
+                assert cumsum[-1] == 50
+                assert chromstarts.max() + seq_length <= 40
+
+            for kwargs in [
+                {"stride": 1, "positive_fraction": 0.5},
+                {"nr_rand_pos": 10, "condition_weights": {"bed": 1}},
+                {"nr_rand_pos": 10, "positive_fraction": 2},
+                {
+                    "nr_rand_pos": 10,
+                    "positive_fraction": 0.5,
+                    "condition_weights": {"x": 1},
+                },
+            ]:
+                self.assertRaises(
+                    ValueError, peaksql.BedDataSet, database, seq_length=5, **kwargs
+                )
+
+    def test_326_reseed_and_epochs(self):
+        def sites(dataset):
+            return [dataset._index_to_site(i) for i in range(len(dataset))]
+
+        for kwargs in [{}, {"positive_fraction": 0.5}]:
+            dataset = peaksql.BedDataSet(
+                DATABASE_BED, seq_length=5, nr_rand_pos=50, seed=1, **kwargs
+            )
+            first = sites(dataset)
+            assert first == sites(
+                peaksql.BedDataSet(
+                    DATABASE_BED, seq_length=5, nr_rand_pos=50, seed=1, **kwargs
+                )
+            )
+
+            # each epoch draws other positions, but the same for the same epoch
+            dataset.set_epoch(1)
+            second = sites(dataset)
+            assert len(second) == 50 and second != first
+            assert dataset.indices_to_sites(range(50))[1].tolist() == [
+                site[2] for site in second
+            ]
+            dataset.set_epoch(0)
+            assert sites(dataset) == first
+
+            dataset.reseed(2)
+            assert sites(dataset) == sites(
+                peaksql.BedDataSet(
+                    DATABASE_BED, seq_length=5, nr_rand_pos=50, seed=2, **kwargs
+                )
+            )
+
+        # without a seed the global random state decides
+        np.random.seed(0)
+        first = sites(peaksql.BedDataSet(DATABASE_BED, seq_length=5, nr_rand_pos=50))
+        np.random.seed(0)
+        assert first == sites(
+            peaksql.BedDataSet(DATABASE_BED, seq_length=5, nr_rand_pos=50)
+        )
+
+        # strided datasets have nothing to draw
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=5, stride=5)
+        first = sites(dataset)
+        dataset.set_epoch(3)
+        dataset.reseed(3)
+        assert sites(dataset) == first
+
+    def test_327_memory_index_long_intervals(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bed = os.path.join(tmpdir, "long.bed")
+            with open(bed, "w") as f:
+                f.write("chr1\t0\t40\nchr1\t3\t5\nchr1\t12\t20\nchr1\t30\t31\n")
+                f.write("chr2\t1\t2\nchr2\t5\t25\nchr2\t20\t24\n")
+            database = os.path.join(tmpdir, "long.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa")
+            db.add_data(bed, "assembly1")
+            db.close()
+
+            sql = peaksql.BedDataSet(database, seq_length=4, stride=1)
+            memory = peaksql.BedDataSet(
+                database, seq_length=4, stride=1, index="memory"
+            )
+            sites = [sql._index_to_site(index) for index in range(len(sql))]
+            np.testing.assert_array_equal(
+                sql.get_labels(sites), memory.get_labels(sites)
+            )
+
+            # the same overlaps as checking all the intervals for each window
+            index = memory.memory_index
+            offsets, chromosome_ids = map(
+                np.array,
+                zip(
+                    *[
+                        memory._database.get_offset_chromosomeid(assembly, chrom)
+                        for assembly, chrom, _, _ in sites
+                    ]
+                ),
+            )
+            chromstarts = offsets + [site[2] for site in sites]
+            chromends = offsets + [site[3] for site in sites]
+            windows, intervals = index.overlap(chromosome_ids, chromstarts, chromends)
+            expected = [
+                (window, interval)
+                for window in range(len(sites))
+                for interval in range(len(index))
+                if index.ends[interval] > chromstarts[window]
+                and chromends[window] >= index.starts[interval]
+                and index.chromosome_ids[interval] == chromosome_ids[window]
+            ]
+            assert sorted(zip(windows.tolist(), intervals.tolist())) == expected
+            assert np.all(np.diff(windows) >= 0)
+            sql.close()
+            memory.close()
+
+    def test_328_many_partitions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # 600 contigs, each with an interval, partitioned on chromosome
+            fasta = os.path.join(tmpdir, "contigs.fa")
+            bed = os.path.join(tmpdir, "contigs.bed")
+            with open(fasta, "w") as f, open(bed, "w") as g:
+                for contig in range(600):
+                    f.write(f">contig{contig}\nACGTACGTAC\n")
+                    g.write(f"contig{contig}\t{contig % 8}\t{contig % 8 + 2}\n")
+
+            labels = []
+            for partition_by in [None, ["chromosome"]]:
+                database = os.path.join(tmpdir, f"{partition_by}.sqlite")
+                db = peaksql.DataBase(database)
+                db.add_assembly(fasta, assembly="contigs", partition_by=partition_by)
+                db.add_data(bed, "contigs")
+                db.close()
+
+                dataset = peaksql.BedDataSet(database, seq_length=4, stride=4)
+                labels.append(dataset.get_batch(range(len(dataset)))[1])
+                np.testing.assert_array_equal(
+                    np.stack([dataset[index][1] for index in range(len(dataset))]),
+                    labels[-1],
+                )
+                dataset.close()
+            assert labels[0].any()
+            np.testing.assert_array_equal(labels[0], labels[1])
+
+            # 520 conditions, partitioned on condition
+            database = os.path.join(tmpdir, "conditions.sqlite")
+            db = peaksql.DataBase(database)
+            db.add_assembly("test/data/assembly1.fa", partition_by=["condition"])
+            conditions = [f"condition{condition}" for condition in range(520)]
+            db.add_data_many(
+                ["test/data/assembly1.bed"] * 520, "assembly1", conditions, processes=0
+            )
+            db.close()
+
+            dataset = peaksql.BedDataSet(database, seq_length=10, stride=10)
+            assert len(dataset._database.get_partitions("assembly1")) == 520
+            np.testing.assert_array_equal(dataset[0][1], [False] + [True] * 520)
+            np.testing.assert_array_equal(
+                dataset.get_batch(range(len(dataset)))[1],
+                np.stack([dataset[index][1] for index in range(len(dataset))]),
+            )
+            dataset.close()
@@ -1,4 +1,9 @@
+import gc
+import os
+import pickle
+import threading
 import unittest
+import numpy as np
 from torch.utils.data import DataLoader
 
 import peaksql
@@ -20,3 +25,151 @@ class TestMLIntegration(unittest.TestCase):
         for seq, label in dataloader:
             assert tuple(seq.shape) == (10, 3, 4,)
             assert tuple(label.shape) == (10, 1,)
+
+    def test_403_Integration_PyTorch_DataLoader_workers(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, nr_rand_pos=100, seq_length=3)
+        for context in ["fork", "spawn"]:
+            dataloader = DataLoader(
+                dataset,
+                batch_size=10,
+                num_workers=2,
+                multiprocessing_context=context,
+                worker_init_fn=dataset.worker_init_fn,
+            )
+            assert sum(len(seq) for seq, label in dataloader) == 100
+
+    def test_404_handles_not_pickled(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, nr_rand_pos=100, seq_length=3)
+        assert len(dataset.handles) == 1
+
+        unpickled = pickle.loads(pickle.dumps(dataset))
+        assert len(unpickled.handles) == 0
+        unpickled[0]
+        assert len(unpickled.handles) == 1
+
+    def test_405_handles_reused_between_threads(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, nr_rand_pos=100, seq_length=3)
+        for _ in range(5):
+            thread = threading.Thread(target=dataset.__getitem__, args=(0,))
+            thread.start()
+            thread.join()
+
+        # the main thread and (at most) one reused handle for all the other threads
+        assert len(dataset.handles) == 2
+        dataset.close()
+        assert len(dataset.handles) == 0
+
+    def test_406_shared_memory(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, stride=1, seq_length=3)
+        shared = peaksql.BedDataSet(
+            DATABASE_BED, stride=1, seq_length=3, index="memory", in_memory="shared"
+        )
+        shared_path = shared.handles.shared_path
+        assert os.path.isfile(shared_path)
+        assert set(shared.memory_index.shared) == set(shared.memory_index.ARRAYS)
+
+        dataloader = DataLoader(
+            shared, batch_size=10, num_workers=2, multiprocessing_context="spawn"
+        )
+        labels = np.concatenate([label.numpy() for seq, label in dataloader])
+        true_labels = np.stack([label for seq, label in dataset])
+        np.testing.assert_array_equal(labels, true_labels)
+
+        # the shared copy is removed once the dataset is gone
+        del shared, dataloader
+        gc.collect()
+        assert not os.path.isfile(shared_path)
+
+    def test_407_stats_workers(self):
+        dataset = peaksql.BedDataSet(
+            DATABASE_BED, nr_rand_pos=100, seq_length=3, stats=True
+        )
+        for context in ["fork", "spawn"]:
+            dataset.stats.reset()
+            dataloader = DataLoader(
+                dataset, batch_size=10, num_workers=2, multiprocessing_context=context
+            )
+            assert sum(len(seq) for seq, label in dataloader) == 100
+
+            workers = dataset.stats.workers()
+            assert set(workers) == {0, 1}
+            assert dataset.stats.report()["stages"]["onehot"]["calls"] == 100
+            assert (
+                sum(report["stages"]["onehot"]["calls"] for report in workers.values())
+                == 100
+            )
+
+    def test_408_batch_loader(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, stride=1, seq_length=3)
+        seqs, labels = map(np.stack, zip(*[dataset[i] for i in range(len(dataset))]))
+
+        loader = peaksql.BatchLoader(dataset, batch_size=7, num_threads=3, prefetch=2)
+        assert len(loader) == -(-len(dataset) // 7)
+        batches = list(loader)
+        assert len(batches) == len(loader)
+        assert all(len(batch_seqs) == 7 for batch_seqs, _ in batches[:-1])
+        np.testing.assert_array_equal(np.concatenate([s for s, _ in batches]), seqs)
+        np.testing.assert_array_equal(np.concatenate([l for _, l in batches]), labels)
+
+        # shuffled batches contain every sample once
+        loader = peaksql.BatchLoader(
+            dataset, batch_size=7, shuffle=True, drop_last=True
+        )
+        batches = list(loader)
+        assert len(batches) == len(loader) == len(dataset) // 7
+        batch_seqs = np.concatenate([s for s, _ in batches])
+        assert set(map(bytes, batch_seqs)) <= set(map(bytes, seqs))
+
+        # a sampler decides the order, and stopping early does not hang
+        loader = peaksql.BatchLoader(dataset, batch_size=2, sampler=[3, 1, 2])
+        first_seqs, first_labels = next(iter(loader))
+        np.testing.assert_array_equal(first_seqs, seqs[[3, 1]])
+        np.testing.assert_array_equal(first_labels, labels[[3, 1]])
+
+        self.assertRaises(ValueError, peaksql.BatchLoader, dataset, batch_size=0)
+
+    def test_409_block_shuffle_sampler(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, stride=1, seq_length=3)
+        for block_size, buffer in [(1, 1), (4, 2), (8, 3), (5, 100), (1000, 1)]:
+            sampler = peaksql.BlockShuffleSampler(dataset, block_size, buffer, seed=0)
+            indices = list(sampler)
+            assert len(sampler) == len(indices) == len(dataset)
+            assert sorted(indices) == list(range(len(dataset)))
+
+            # the indices of a group of (complete) blocks are shuffled together
+            if len(dataset) % block_size:
+                continue
+            group = block_size * buffer
+            for lower in range(0, len(indices), group):
+                blocks = {
+                    index // block_size for index in indices[lower : lower + group]
+                }
+                assert len(blocks) <= buffer
+
+        # the order is reproducible, and differs each iteration
+        sampler = peaksql.BlockShuffleSampler(dataset, 2, 2, seed=1)
+        first, second = list(sampler), list(sampler)
+        assert first != second
+        assert first == list(peaksql.BlockShuffleSampler(dataset, 2, 2, seed=1))
+
+        loader = peaksql.BatchLoader(dataset, batch_size=4, sampler=sampler)
+        assert sum(len(seqs) for seqs, _ in loader) == len(dataset)
+        dataloader = DataLoader(dataset, batch_size=4, sampler=sampler)
+        assert sum(len(seqs) for seqs, _ in dataloader) == len(dataset)
+
+    def test_410_epochs_persistent_workers(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, nr_rand_pos=40, seq_length=3, seed=0)
+        for context in ["fork", "spawn"]:
+            dataloader = DataLoader(
+                dataset,
+                batch_size=4,
+                num_workers=2,
+                persistent_workers=True,
+                multiprocessing_context=context,
+            )
+            for epoch in range(3):
+                dataset.set_epoch(epoch)
+                seqs = np.concatenate([seq.numpy() for seq, _ in dataloader])
+                np.testing.assert_array_equal(
+                    seqs, np.stack([seq for seq, _ in dataset])
+                )
@@ -0,0 +1,58 @@
+import sqlite3
+import unittest
+import numpy as np
+
+import peaksql.signal
+import peaksql.tables
+
+
+class TestSignal(unittest.TestCase):
+    """ A test class to test the signal tracks of peaksql """
+
+    def test_501_encode_decode(self):
+        values = np.array(
+            [0, 0, 0, 1.5, 1.5, 2, 0, 0, np.nan, np.nan], dtype=np.float32
+        )
+        np.testing.assert_array_equal(
+            peaksql.signal.decode(peaksql.signal.encode(values)), values
+        )
+
+        values = np.zeros(4096, dtype=np.float32)
+        assert len(peaksql.signal.encode(values)) < 64
+
+    def test_502_bin_intervals(self):
+        chunks = peaksql.signal.bin_intervals(
+            chrom_ids=[1, 1, 1, 2],
+            chromstarts=[10, 0, 3, 0],
+            chromends=[20, 5, 4, 8],
+            values=[2.0, 1.0, 0.0, 1.0],
+            bin_size=4,
+            chunk_size=2,
+        )
+        # chromosome 1 covers chunks 0 ([0, 8)) to 2 ([16, 24)), chromosome 2 chunk 0
+        assert sorted(chunks) == [(1, 0), (1, 1), (1, 2), (2, 0)]
+        np.testing.assert_array_equal(chunks[1, 0], [4.0, 1.0])
+        np.testing.assert_array_equal(chunks[1, 1], [4.0, 8.0])
+        np.testing.assert_array_equal(chunks[1, 2], [8.0, 0.0])
+        np.testing.assert_array_equal(chunks[2, 0], [4.0, 4.0])
+
+    def test_503_read_chunks(self):
+        connection = sqlite3.connect(":memory:")
+        if hasattr(connection, "setlimit"):  # python >= 3.11
+            # the default of sqlite before 3.32
+            connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE TABLE {peaksql.tables.SIG}")
+        cursor.executemany(
+            "INSERT INTO Signal VALUES(1, 1, 0, ?, ?)",
+            [
+                (chunk, peaksql.signal.encode(np.full(4, chunk, dtype=np.float32)))
+                for chunk in range(0, 4000, 2)
+            ],
+        )
+
+        # more chunks than sqlite allows variables in a single statement
+        chunks = dict(peaksql.signal.read_chunks(cursor, 1, 1, 0, range(3000)))
+        assert sorted(chunks) == list(range(0, 3000, 2))
+        np.testing.assert_array_equal(chunks[1234], [1234] * 4)
+        connection.close()
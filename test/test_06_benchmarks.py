@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+import unittest
+
+import peaksql.benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    """ A test class to test the benchmarks of peaksql """
+
+    def test_601_benchmarks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "results.json")
+            peaksql.benchmarks.main(
+                [
+                    "--chromosomes=2",
+                    "--chromosome-size=2000",
+                    "--intervals=100",
+                    "--seq-length=100",
+                    "--stride=50",
+                    "--items=10",
+                    "--num-workers=0",
+                    "--num-threads=2",
+                    "--batch-size=4",
+                    "--batches=2",
+                    f"--directory={tmpdir}",
+                    f"--output={output}",
+                ]
+            )
+            with open(output) as f:
+                results = json.load(f)
+
+        assert results["config"]["nr_intervals"] == 100
+        names = [result["name"] for result in results["results"]]
+        for name in [
+            "add_assembly.bed",
+            "add_data.narrowPeak",
+            "add_data.bdg",
+            "construct_BedDataSet_sql",
+            "getitem_NarrowPeakDataSet_memory",
+            "getitems_BedGraphDataSet_sql",
+            "batch_loader_2_threads",
+            "sampler_random",
+            "sampler_block",
+        ]:
+            assert name in names
+        for result in results["results"]:
+            if "items" in result:
+                assert result["items"] > 0 and result["seconds"] > 0
@@ -0,0 +1,78 @@
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from torch.utils.data import DataLoader
+
+import peaksql
+from test.test_02_database import DATABASE_BED, DATABASE_NWP
+
+
+class TestSharded(unittest.TestCase):
+    """ A test class to test exporting datasets to shards """
+
+    def test_701_export_onehot(self):
+        dataset = peaksql.BedDataSet(DATABASE_BED, seq_length=10, stride=3)
+        seqs, labels = map(np.stack, zip(*[dataset[i] for i in range(len(dataset))]))
+
+        for num_workers in [1, 2]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = dataset.export(tmpdir, shard_size=4, num_workers=num_workers)
+                sharded = peaksql.ShardedDataSet(path)
+                assert sharded.meta["nr_shards"] == -(-len(dataset) // 4)
+                assert len(sharded) == len(dataset)
+                assert sharded.conditions == list(dataset.conditions)
+
+                for i in range(len(sharded)):
+                    seq, label = sharded[i]
+                    np.testing.assert_array_equal(seq, seqs[i])
+                    np.testing.assert_array_equal(label, labels[i])
+                self.assertRaises(IndexError, sharded.__getitem__, len(sharded))
+
+                # consecutive indices within a shard are a view on the shard
+                batch_seqs, batch_labels = sharded.get_batch([4, 5, 6])
+                assert isinstance(batch_seqs, np.memmap)
+                np.testing.assert_array_equal(batch_seqs, seqs[4:7])
+                batch_seqs, batch_labels = sharded.get_batch([7, 2, 3])
+                np.testing.assert_array_equal(batch_seqs, seqs[[7, 2, 3]])
+                np.testing.assert_array_equal(batch_labels, labels[[7, 2, 3]])
+
+                # the shards are mapped again after pickling
+                unpickled = pickle.loads(pickle.dumps(sharded))
+                assert len(unpickled.shards) == 0
+                np.testing.assert_array_equal(unpickled[5][0], seqs[5])
+
+                dataloader = DataLoader(sharded, batch_size=5, num_workers=2)
+                np.testing.assert_array_equal(
+                    np.concatenate([label.numpy() for _, label in dataloader]), labels
+                )
+
+    def test_702_export_bases(self):
+        for dataset in [
+            peaksql.NarrowPeakDataSet(DATABASE_NWP, seq_length=7, stride=2),
+            peaksql.BedDataSet(DATABASE_BED, seq_length=10, nr_rand_pos=20, seed=0),
+        ]:
+            seqs, labels = map(
+                np.stack, zip(*[dataset[i] for i in range(len(dataset))])
+            )
+            with tempfile.TemporaryDirectory() as tmpdir:
+                dataset.export(tmpdir, shard_size=6, format="bases")
+                sharded = peaksql.ShardedDataSet(tmpdir)
+                np.testing.assert_array_equal(
+                    np.stack([seq for seq, _ in sharded.__getitems__(range(20))]),
+                    seqs[:20],
+                )
+                np.testing.assert_array_equal(
+                    sharded.get_batch(range(6))[1], labels[:6]
+                )
+
+                bases = peaksql.ShardedDataSet(tmpdir, onehot=False)
+                assert bases[0][0].dtype == np.uint8
+                assert bases[0][0].shape == (dataset.seq_length,)
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                dataset.export(tmpdir)
+                self.assertRaises(
+                    ValueError, peaksql.ShardedDataSet, tmpdir, onehot=False
+                )
+                self.assertRaises(ValueError, dataset.export, tmpdir, format="zarr")